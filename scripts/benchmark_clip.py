@@ -0,0 +1,76 @@
+import argparse
+import time
+import zlib
+
+import numpy as np
+import torch
+from transformers import CLIPConfig, CLIPModel
+
+from tiny_eqa.models.model_clip import ModelClip, ModelClipConfig
+
+
+class HashTokenizer:
+    """ Offline stand-in for the CLIP tokenizer, mapping words to ids by hash and ending each text with eos.
+    """
+    def __init__(self, vocab_size: int, bos=0, eos=1):
+        self.vocab_size, self.bos, self.eos = vocab_size, bos, eos
+
+    def __call__(self, texts: list[str], padding=True, return_tensors='pt') -> dict:
+        ids = [
+            [self.bos] + [2 + zlib.crc32(word.encode()) % (self.vocab_size - 2) for word in text.lower().split()] + [self.eos]
+            for text in texts
+        ]
+        length = max(len(x) for x in ids)
+        return {
+            'input_ids': torch.tensor([x + [self.eos] * (length - len(x)) for x in ids]),
+            'attention_mask': torch.tensor([[1] * len(x) + [0] * (length - len(x)) for x in ids]),
+        }
+
+
+def tiny_clip(vocab_size=4096) -> CLIPModel:
+    """ Randomly initialized CLIP with ViT-B/32 input resolution and small encoders.
+    """
+    torch.manual_seed(0)
+    layers = dict(hidden_size=256, intermediate_size=1024, num_hidden_layers=4, num_attention_heads=4)
+    config = CLIPConfig(
+        text_config=dict(vocab_size=vocab_size, max_position_embeddings=77, bos_token_id=0, eos_token_id=1, pad_token_id=1, **layers),
+        vision_config=dict(image_size=224, patch_size=32, **layers),
+        projection_dim=256,
+    )
+    return CLIPModel(config)
+
+
+if __name__ == '__main__':
+    """ Scores of list comprehensions like `[c.text_match(text) for c in clothes]`, one call per pair versus one engine call.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_crops', type=int, default=64)
+    parser.add_argument('-t', '--num_texts', type=int, default=4)
+    args = parser.parse_args()
+
+    model = tiny_clip()
+    tokenizer = HashTokenizer(model.config.text_config.vocab_size)
+    rng = np.random.default_rng(0)
+    crops = [rng.integers(0, 256, (rng.integers(16, 300), rng.integers(16, 300), 3), dtype=np.uint8) for _ in range(args.num_crops)]
+    texts = [f'something you would wear in the {season}' for season in ['winter', 'summer', 'rain', 'snow', 'desert', 'night'][:args.num_texts]]
+
+    def per_pair():
+        engine = ModelClip(ModelClipConfig(text_cache_size=0), model=model, tokenizer=tokenizer)
+        return torch.stack([torch.stack([engine([crop], [text])[0, 0] for crop in crops]) for text in texts], dim=1)
+
+    def batched():
+        engine = ModelClip(ModelClipConfig(), model=model, tokenizer=tokenizer)
+        return engine(crops, texts)
+
+    def cached():
+        return engine(crops, texts)
+
+    engine = ModelClip(ModelClipConfig(), model=model, tokenizer=tokenizer)
+    engine.encode_texts(texts)
+    results = {}
+    for name, fn in [('per pair', per_pair), ('batched', batched), ('batched, texts cached', cached)]:
+        start = time.perf_counter()
+        results[name] = fn()
+        elapsed = time.perf_counter() - start
+        print(f'{name:>22}: {elapsed:.2f}s, {args.num_crops * len(texts) / elapsed:.0f} pairs/s')
+    print(f'max abs difference: {(results["per pair"] - results["batched"]).abs().max():.2e}')
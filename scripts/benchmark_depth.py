@@ -0,0 +1,98 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from transformers import DepthAnythingConfig, DepthAnythingForDepthEstimation, Dinov2Config
+
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.agents.image_patch import ImagePatch
+from tiny_eqa.agents.image_patch_functions import image_compute_depth, image_set_sensor_depth
+from tiny_eqa.data.synthetic import intrinsics_from_fov, render_room, synthetic_trajectory
+from tiny_eqa.models.model_depth_anything import ModelDepthAnything, ModelDepthAnythingConfig
+
+
+IMAGE_SIZE = (480, 640)
+
+
+def tiny_depth_anything() -> DepthAnythingForDepthEstimation:
+    """ Randomly initialized metric Depth Anything with a small DINOv2 backbone and DPT head.
+    """
+    torch.manual_seed(0)
+    config = DepthAnythingConfig(
+        backbone_config=Dinov2Config(
+            hidden_size=64, num_hidden_layers=4, num_attention_heads=4, intermediate_size=128, image_size=518,
+            out_features=['stage1', 'stage2', 'stage3', 'stage4'], reshape_hidden_states=False,
+        ),
+        neck_hidden_sizes=[16, 32, 64, 64], reassemble_hidden_size=64, fusion_hidden_size=32, head_hidden_size=16,
+        depth_estimation_type='metric', max_depth=10,
+    )
+    return DepthAnythingForDepthEstimation(config)
+
+
+def exact_median(depth: np.ndarray) -> float:
+    """ Median of the valid pixels of a crop, the way a depth map without the table would compute it.
+    """
+    values = depth[depth > 0]
+    return float(np.median(values)) if len(values) else float('nan')
+
+
+if __name__ == '__main__':
+    """ ImagePatch.depth() calls/s over many crops per frame, inference per crop versus a cached depth map per frame with
+    its median table, with predicted and with sensor depth.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--num_frames', type=int, default=4)
+    parser.add_argument('-c', '--num_crops', type=int, default=100, help='crops per frame')
+    args = parser.parse_args()
+
+    model = tiny_depth_anything()
+    intrinsics = intrinsics_from_fov(IMAGE_SIZE)
+    frames = [render_room(pose, intrinsics, IMAGE_SIZE) for pose in synthetic_trajectory(args.num_frames)]
+    rng = np.random.default_rng(0)
+    boxes = []
+    for _ in range(args.num_frames * args.num_crops):
+        size = rng.integers(24, 160) * np.array([rng.uniform(1, 2), 1]) # object boxes up to 2:1
+        point1 = rng.uniform(0, 1, 2) * (np.array(IMAGE_SIZE[::-1]) - size)
+        boxes.append((point1, point1 + size))
+    boxes = np.array(boxes).reshape(args.num_frames, args.num_crops, 2, 2)
+
+    def per_crop():
+        engine = ModelDepthAnything(ModelDepthAnythingConfig(cache_size=0), model=model)
+        results = []
+        for (image, _), frame_boxes in zip(frames[:1], boxes): # one frame, inference per crop is slow
+            for (x1, y1), (x2, y2) in frame_boxes:
+                crop = np.ascontiguousarray(image[int(y1):int(y2), int(x1):int(x2)])
+                results.append(exact_median(engine.predict([crop])[0]))
+        return results
+
+    def per_frame(sensor: bool, table: bool):
+        engine = ModelDepthAnything(model=model)
+        register_model('ModelDepthAnything', engine)
+        results = []
+        for (image, depth), frame_boxes in zip(frames, boxes):
+            image = image.copy() # a new frame, as read from a sequence
+            if sensor:
+                image_set_sensor_depth(image, depth)
+            patch = ImagePatch(image)
+            for point1, point2 in frame_boxes:
+                crop = patch.crop(point1, point2)
+                results.append(crop.depth() if table else exact_median(np.asarray(image_compute_depth(crop))))
+        return results
+
+    per_frame(False, True) # warm up
+    runs = {
+        'inference per crop': per_crop,
+        'predicted, exact median': lambda: per_frame(False, False),
+        'predicted, table median': lambda: per_frame(False, True),
+        'sensor, exact median': lambda: per_frame(True, False),
+        'sensor, table median': lambda: per_frame(True, True),
+    }
+    results = {}
+    for name, run in runs.items():
+        start = time.perf_counter()
+        results[name] = np.array(run())
+        elapsed = time.perf_counter() - start
+        print(f'{name:>24}: {len(results[name]) / elapsed:8.0f} depth() calls/s')
+    error = np.abs(results['sensor, table median'] - results['sensor, exact median'])
+    print(f'table median error on sensor depth: mean {np.nanmean(error) * 100:.2f}cm, max {np.nanmax(error) * 100:.2f}cm')
@@ -0,0 +1,67 @@
+import argparse
+import copy
+import time
+
+import torch
+from torch import nn
+
+from tiny_eqa.models.model_dino import DinoModel, DinoModelConfig
+
+
+class TinyVit(nn.Module):
+    """ Randomly initialized stand-in for a dinov2 backbone, exposing the same `forward_features` interface.
+    """
+    def __init__(self, dim=192, depth=4, heads=3, patch_size=DinoModelConfig.PATCH_SIZE):
+        super().__init__()
+        self.patch_embed = nn.Conv2d(3, dim, kernel_size=patch_size, stride=patch_size)
+        self.blocks = nn.TransformerEncoder(
+            nn.TransformerEncoderLayer(dim, heads, dim_feedforward=4 * dim, batch_first=True, norm_first=True), depth, enable_nested_tensor=False,
+        )
+        self.norm = nn.LayerNorm(dim)
+
+    def forward_features(self, image: torch.Tensor) -> dict:
+        x = self.patch_embed(image).flatten(2).transpose(1, 2)
+        return {'x_norm_patchtokens': self.norm(self.blocks(x))}
+
+
+def benchmark(model: DinoModel, images: list[torch.Tensor], naive=False) -> float:
+    """ Returns frames/s of extracting features for all images, either with `extract_sequence` or one `__call__` per image.
+    """
+    start = time.perf_counter()
+    if naive:
+        for image in images:
+            model(image.unsqueeze(0))
+    else:
+        model.extract_sequence(images)
+    return len(images) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    """
+    """
+    parser = argparse.ArgumentParser(description='Benchmark DinoModel feature extraction throughput on CPU.')
+    parser.add_argument('-n', '--num_frames', type=int, default=64, help='Number of frames.')
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=(480, 640), help='Frame size (H, W).')
+    parser.add_argument('-b', '--batch_size', type=int, default=8, help='Micro-batch size.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Runs per config, of which the fastest is reported.')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    images = [torch.rand(3, *args.size) for _ in range(args.num_frames)]
+    backbone = TinyVit()
+
+    configs = {
+        'naive':    DinoModelConfig(),
+        'batched':  DinoModelConfig(batch_size=args.batch_size),
+        'prefetch': DinoModelConfig(batch_size=args.batch_size, prefetch=True),
+        'bfloat16': DinoModelConfig(batch_size=args.batch_size, dtype='bfloat16'),
+        'int8':     DinoModelConfig(batch_size=args.batch_size, quantize=True),
+        'compile':  DinoModelConfig(batch_size=args.batch_size, compile=True),
+    }
+    for name, config in configs.items():
+        model = DinoModel(config, device='cpu', model=copy.deepcopy(backbone))
+        benchmark(model, images[:config.batch_size], naive=name == 'naive') # warmup
+        fps = max(benchmark(model, images, naive=name == 'naive') for _ in range(args.repeats))
+        print(f'{name:>8}: {fps:.1f} frames/s')
+
+# python -m scripts.benchmark_dino -n 64 -b 8
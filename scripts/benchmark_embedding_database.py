@@ -0,0 +1,45 @@
+import tempfile
+import time
+
+import numpy as np
+
+from tiny_eqa.agents.scene_cache import EmbeddingDatabase
+
+
+DIM = 384 # sentence embedding dimension of e.g. all-MiniLM-L6-v2
+
+BATCH = 1000
+
+
+if __name__ == '__main__':
+    """ Insert, single and batched query latency, and memory-mapped load time of EmbeddingDatabase at increasing sizes.
+    """
+    rng = np.random.default_rng(0)
+    for dtype in ['float16', 'float32']:
+        for n in [10_000, 100_000, 1_000_000]:
+            database = EmbeddingDatabase(dtype=dtype)
+            start = time.perf_counter()
+            for _ in range(n // BATCH):
+                database.add(rng.standard_normal((BATCH, DIM), dtype=np.float32), [None] * BATCH)
+            insert = (time.perf_counter() - start) / n * 1e6
+
+            queries = rng.standard_normal((64, DIM), dtype=np.float32)
+            database.search(queries[:1], k=10) # warmup
+            start = time.perf_counter()
+            for query in queries[:16]:
+                database.search(query, k=10)
+            single = (time.perf_counter() - start) / 16 * 1e3
+            start = time.perf_counter()
+            database.search(queries, k=10)
+            batched = (time.perf_counter() - start) / len(queries) * 1e3
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                database.save(tmpdir)
+                start = time.perf_counter()
+                EmbeddingDatabase.load(tmpdir).search(queries[:1], k=10)
+                load = (time.perf_counter() - start) * 1e3
+            print(
+                f'{dtype} n={n:>9,}: insert {insert:.2f}us/entry, query {single:.2f}ms (single) '
+                f'{batched:.2f}ms/query (batch of {len(queries)}), mmap load + first query {load:.1f}ms'
+            )
+            del database
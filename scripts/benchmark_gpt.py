@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from types import SimpleNamespace
+
+from omegaconf import OmegaConf
+from openai import RateLimitError
+from openai.types.chat import ChatCompletion
+
+from tiny_eqa.agents.agent import Agent
+from tiny_eqa.models.model_gpt import estimate_tokens
+
+
+PROGRAM = """```python
+def execute_command(scene) -> str:
+    scene_patch = ScenePatch(scene)
+    return bool_to_yesno(scene_patch.exists('door'))
+```"""
+
+
+class FakeTransport:
+    """ Stand-in for the chat completions endpoint, with a latency per uncached prompt token, a token rate limit, and
+    prompt caching of message prefixes of at least 1024 tokens seen before.
+    """
+    def __init__(self, latency=0.05, seconds_per_token=2e-6, completion_tokens=60, seconds_per_completion_token=2e-3, tokens_per_minute=None):
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.completion_tokens = completion_tokens
+        self.seconds_per_completion_token = seconds_per_completion_token
+        self.tokens_per_minute = tokens_per_minute
+        self.available, self.last = tokens_per_minute, time.monotonic()
+        self.requests = 0
+        self.rejected = 0
+        self.prefixes = set()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def cache_prefixes(self, messages: list[dict]) -> int:
+        """ Returns the tokens of the longest cached message prefix, and caches all prefixes of `messages`.
+        """
+        cached, hasher = 0, hashlib.sha256()
+        for i, message in enumerate(messages):
+            hasher.update(json.dumps(message, sort_keys=True).encode())
+            key = hasher.hexdigest()
+            tokens = estimate_tokens(messages[:i + 1])
+            if key in self.prefixes and tokens >= 1024:
+                cached = tokens
+            self.prefixes.add(key)
+        return cached
+
+    async def __call__(self, model: str, messages: list[dict], max_tokens: int) -> ChatCompletion:
+        self.requests += 1
+        prompt_tokens = estimate_tokens(messages)
+        tokens = prompt_tokens + self.completion_tokens
+        if self.tokens_per_minute: # replenished continuously like the OpenAI limits
+            now = time.monotonic()
+            self.available = min(self.tokens_per_minute, self.available + (now - self.last) * self.tokens_per_minute / 60)
+            self.last = now
+            if self.available < tokens:
+                self.rejected += 1
+                response = SimpleNamespace(request=None, status_code=429, headers={}) # fields of the http response read by openai
+                raise RateLimitError('Rate limit reached', response=response, body=None)
+            self.available -= tokens
+        cached_tokens = self.cache_prefixes(messages)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        uncached_tokens = prompt_tokens - cached_tokens
+        await asyncio.sleep(self.latency + uncached_tokens * self.seconds_per_token + self.completion_tokens * self.seconds_per_completion_token)
+        return ChatCompletion.model_validate({
+            'id': f'fake-{self.requests}', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': PROGRAM}}],
+            'usage': {
+                'prompt_tokens': prompt_tokens, 'completion_tokens': self.completion_tokens, 'total_tokens': tokens,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens},
+            },
+        })
+
+
+if __name__ == '__main__':
+    """ Throughput of Agent.process over many tasks at increasing concurrency, against a fake endpoint.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_tasks', type=int, default=64)
+    parser.add_argument('-r', '--tokens_per_minute', type=int, default=60_000, help='server side limit of the rate limited runs')
+    parser.add_argument('-l', '--limited_tasks', type=int, default=32, help='tasks of the rate limited runs')
+    args = parser.parse_args()
+
+    tasks = [f'Is there a door in the room? ({i})' for i in range(args.num_tasks)]
+    agent = Agent(OmegaConf.create({}))
+    start = time.perf_counter()
+    for task in tasks[:8]:
+        agent.model.transport = FakeTransport()
+        agent.process(task)
+    print(f'{"sequential":>34}: {8 / (time.perf_counter() - start):6.1f} tasks/s')
+
+    runs = [(max_concurrency, None, None, args.num_tasks) for max_concurrency in [1, 4, 16, 64]] + [
+        (16, args.tokens_per_minute, None, args.limited_tasks),
+        (16, args.tokens_per_minute, args.tokens_per_minute, args.limited_tasks),
+    ]
+    for max_concurrency, limit, client_limit, num_tasks in runs:
+        gpt = dict(max_concurrency=max_concurrency, tokens_per_minute=client_limit, backoff_base=0.5)
+        agent = Agent(OmegaConf.create({'gpt': gpt}))
+        agent.model.transport = transport = FakeTransport(tokens_per_minute=limit)
+        start = time.perf_counter()
+        try:
+            programs = agent.process_batch(tasks[:num_tasks])
+            result = f'{len(programs) / (time.perf_counter() - start):6.1f} tasks/s'
+        except RateLimitError:
+            result = f'failed after {time.perf_counter() - start:.1f}s'
+        name = f'{num_tasks} tasks, concurrency {max_concurrency}' + (', server limit' if limit else '') + (' + client limit' if client_limit else '')
+        print(f'{name:>34}: {result}, {transport.rejected} requests rate limited')
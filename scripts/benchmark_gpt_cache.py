@@ -0,0 +1,49 @@
+import argparse
+import tempfile
+import time
+
+from omegaconf import OmegaConf
+
+from tiny_eqa.agents.agent import Agent
+from scripts.benchmark_gpt import FakeTransport
+
+
+if __name__ == '__main__':
+    """ Latency and hit rate of rerunning program generation for a benchmark split with the response cache.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_tasks', type=int, default=64)
+    parser.add_argument('-u', '--unique_tasks', type=int, default=48, help='distinct questions among the tasks')
+    args = parser.parse_args()
+
+    tasks = [f'Is there a door in the room? ({i % args.unique_tasks})' for i in range(args.num_tasks)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        def run(name: str, mode: str, **config):
+            agent = Agent(OmegaConf.create({
+                'gpt': {'max_concurrency': 16}, 'gpt_cache': {'path': f'{tmpdir}/gpt.sqlite', 'config': {'mode': mode, **config}},
+            }))
+            agent.model.transport = transport = FakeTransport()
+            start = time.perf_counter()
+            try:
+                agent.process_batch(tasks)
+                result = f'{time.perf_counter() - start:5.2f}s'
+            except KeyError:
+                result = 'failed'
+            stats = agent.model.cache.stats
+            print(
+                f'{name:>22}: {result}, {transport.requests:3d} requests sent, hit rate {stats.hit_rate:.2f}, '
+                f'{stats.expired} expired, {stats.evictions} evicted, {len(agent.model.cache)} cached'
+            )
+            agent.model.cache.close()
+
+        run('no cache', 'off')
+        run('first run', 'readwrite')
+        run('rerun', 'readwrite')
+        run('rerun, replay', 'replay')
+        run('rerun, refresh', 'write')
+        time.sleep(1.0)
+        run('rerun, 0.5s ttl', 'readwrite', ttl=0.5)
+        run('refresh, 16kB', 'write', max_bytes=16 * 2**10)
+        run('rerun, 16kB', 'readwrite', max_bytes=16 * 2**10)
+        tasks.append('A question never asked before')
+        run('new task, replay', 'replay')
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+from PIL import Image
+
+from tiny_eqa.models.model_gpt import Conversation, HistoryPolicy, ModelGptAsync, ModelGptInput
+from scripts.benchmark_gpt import FakeTransport
+
+
+FOLLOW_UPS = [
+    'Executing the program failed with IndexError: list index out of range. Fix the program.',
+    'The agent moved, this is the new view. Also return the distance to the closest door.',
+]
+
+
+async def run_task(model: ModelGptAsync, conversation: Conversation, prompt: str, task: str, frames: list[Image.Image]):
+    """ One task: program generation with a frame of the scene, followed by alternating repair and refinement turns
+    with a new frame.
+    """
+    input = ModelGptInput()
+    input.extend(([prompt] if prompt else []) + [task, frames[0]])
+    await model(input, conversation)
+    for i, frame in enumerate(frames[1:]):
+        input = ModelGptInput()
+        input.extend([FOLLOW_UPS[i % 2]] + ([frame] if i % 2 else []))
+        await model(input, conversation)
+
+
+if __name__ == '__main__':
+    """ Tokens sent per task with one shared conversation versus a handle per task with the prompt as system prefix.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_tasks', type=int, default=8)
+    parser.add_argument('-t', '--turns', type=int, default=8, help='turns per task')
+    parser.add_argument('-m', '--max_tokens', type=int, default=2048, help='history tokens of the bounded policies')
+    args = parser.parse_args()
+
+    with open('prompts/viper_eqa.txt') as f:
+        prompt = f.read()
+    rng = np.random.default_rng(0)
+    frames = [Image.fromarray(rng.integers(0, 256, (968, 1296, 3), dtype=np.uint8)) for _ in range(args.turns)]
+    tasks = [f'Is there a door in the room? ({i})' for i in range(args.num_tasks)]
+
+    async def shared():
+        # before: the model object holds one history, and every task sends the prompt in its first message
+        conversation = Conversation(policy=HistoryPolicy(strategy='keep', keep_images=args.num_tasks * args.turns))
+        for task in tasks:
+            await run_task(model, conversation, prompt, task, frames)
+
+    async def handles(policy: HistoryPolicy):
+        for task in tasks:
+            await run_task(model, model.conversation(system=prompt, policy=policy), None, task, frames)
+
+    runs = {
+        'shared history': shared,
+        'handles, keep': lambda: handles(HistoryPolicy(strategy='keep', keep_images=args.turns)),
+        'handles, keep 1 image': lambda: handles(HistoryPolicy(strategy='keep')),
+        'handles, truncate': lambda: handles(HistoryPolicy(strategy='truncate', max_tokens=args.max_tokens)),
+        'handles, summarize': lambda: handles(HistoryPolicy(strategy='summarize', max_tokens=args.max_tokens)),
+    }
+    for name, run in runs.items():
+        model = ModelGptAsync('gpt-4o', transport=FakeTransport())
+        start = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        transport = model.transport
+        print(
+            f'{name:>22}: {transport.prompt_tokens / len(tasks):8.0f} prompt tokens/task, '
+            f'{transport.cached_tokens / transport.prompt_tokens:.0%} cached, '
+            f'{(transport.prompt_tokens - transport.cached_tokens) / len(tasks):6.0f} uncached tokens/task, {elapsed / len(tasks) * 1e3:.0f}ms/task'
+        )
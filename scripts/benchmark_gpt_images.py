@@ -0,0 +1,87 @@
+import argparse
+import base64
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from tiny_eqa.data.synthetic import intrinsics_from_fov, render_room, synthetic_trajectory
+from tiny_eqa.models.model_gpt import (
+    ImageEncoder, ImageEncoderConfig, ModelGptInput, encode_base64, image_tokens,
+)
+
+
+IMAGE_SIZE = (968, 1296) # ScanNet color frames
+
+
+def encode_naive(inputs: list) -> list[dict]:
+    """ Encoding before the fast path: every image converted and saved at full size, one by one.
+    """
+    content = []
+    for input in inputs:
+        if isinstance(input, str):
+            content.append({'type': 'text', 'text': input})
+        else:
+            content.append({'type': 'image_url', 'image_url': {'url': f'data:image/jpeg;base64,{encode_base64(input)}'}})
+    return content
+
+
+def payload(content: list[dict]) -> tuple[int, int]:
+    """ Returns the image bytes and image tokens of a request.
+    """
+    nbytes, tokens = 0, 0
+    for part in content:
+        if part['type'] == 'image_url':
+            data = base64.b64decode(part['image_url']['url'].split(',', 1)[1])
+            nbytes += len(part['image_url']['url'])
+            with Image.open(io.BytesIO(data)) as image:
+                tokens += image_tokens(*image.size)
+    return nbytes, tokens
+
+
+if __name__ == '__main__':
+    """ Encode time and payload size of multi-turn requests about scan frames, before and after the encoding fast path.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--frames', type=int, default=8, help='frames per request')
+    parser.add_argument('-q', '--questions', type=int, default=4, help='questions about the same frames')
+    args = parser.parse_args()
+
+    poses = synthetic_trajectory(args.frames * 2)
+    intrinsics = intrinsics_from_fov(IMAGE_SIZE)
+    rng = np.random.default_rng(0)
+    frames = [ # with sensor noise, which makes JPEG sizes closer to real frames
+        Image.fromarray((render_room(pose, intrinsics, IMAGE_SIZE)[0] + rng.normal(0, 6, (*IMAGE_SIZE, 3))).clip(0, 255).astype(np.uint8))
+        for pose in poses
+    ]
+    # each question sends scan frames and crops of them, most frames were also sent with the previous question
+    requests = [
+        [f'Question {i}'] + frames[i * args.frames // 4:][:args.frames] + [frame.crop((200, 100, 600, 400)) for frame in frames[:2]]
+        for i in range(args.questions)
+    ]
+
+    runs = {
+        'naive': None,
+        'fast path': ImageEncoderConfig(),
+        'fast path, 60kB': ImageEncoderConfig(max_bytes=60_000),
+        'fast path, 255 tokens': ImageEncoderConfig(max_tokens=255),
+    }
+    for name, config in runs.items():
+        encoder = ImageEncoder(config) if config else None
+        times, sizes = [], []
+        for inputs in requests:
+            start = time.perf_counter()
+            if encoder is None:
+                content = encode_naive(inputs)
+            else:
+                input = ModelGptInput(encoder=encoder)
+                input.extend(inputs)
+                content = input.content
+            times.append(time.perf_counter() - start)
+            sizes.append(payload(content))
+        nbytes, tokens = np.mean(sizes, axis=0)
+        print(
+            f'{name:>22}: first request {times[0] * 1e3:6.1f}ms, later requests {np.mean(times[1:]) * 1e3:6.1f}ms, '
+            f'{nbytes / 1e6:.2f}MB and {tokens:.0f} image tokens per request'
+        )
@@ -0,0 +1,100 @@
+import argparse
+import time
+import zlib
+
+import torch
+from transformers import BertConfig, GroundingDinoConfig, GroundingDinoForObjectDetection, SwinConfig
+
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.agents.image_patch import ImagePatch
+from tiny_eqa.agents.lazy import lazy_mode, resolve
+from tiny_eqa.data.synthetic import intrinsics_from_fov, render_room, synthetic_trajectory
+from tiny_eqa.models.model_grounding_dino import ModelGroundingDino, ModelGroundingDinoConfig
+
+
+IMAGE_SIZE = (240, 320)
+
+
+class BertHashTokenizer:
+    """ Offline stand-in for the BERT tokenizer of Grounding DINO, with its special token ids and words hashed to ids.
+    """
+    cls_token_id, sep_token_id = 101, 102
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        return {'.': 1012, '?': 1029}[token]
+
+    def __call__(self, texts: list[str], add_special_tokens=False) -> dict:
+        return {'input_ids': [[2000 + zlib.crc32(word.encode()) % (self.vocab_size - 2000) for word in text.split()] for text in texts]}
+
+
+def tiny_grounding_dino(vocab_size=4096) -> GroundingDinoForObjectDetection:
+    """ Randomly initialized Grounding DINO with a small Swin backbone, BERT text encoder and fusion transformer.
+    """
+    torch.manual_seed(0)
+    config = GroundingDinoConfig(
+        backbone_config=SwinConfig(
+            embed_dim=32, depths=[1, 1, 2, 1], num_heads=[1, 2, 4, 8], out_features=['stage2', 'stage3', 'stage4'],
+        ),
+        text_config=BertConfig(vocab_size=vocab_size, hidden_size=64, num_hidden_layers=1, num_attention_heads=4, intermediate_size=128),
+        d_model=64, num_queries=100, encoder_layers=1, decoder_layers=2, encoder_ffn_dim=128, decoder_ffn_dim=128,
+        encoder_attention_heads=4, decoder_attention_heads=4,
+    )
+    return GroundingDinoForObjectDetection(config)
+
+
+def program(patches: list[ImagePatch]) -> tuple:
+    """ Finds cabinets, chairs and doors in every frame, then checks again whether each frame has a door.
+    """
+    cabinets = [patch.find('cabinet') for patch in patches]
+    chairs = [patch.find('chair') for patch in patches]
+    doors = [patch.find('door') for patch in patches]
+    counts = sum(len(x) for x in cabinets), sum(len(x) for x in chairs), sum(len(x) for x in doors)
+    return counts, [patch.exists('door') for patch in patches]
+
+
+if __name__ == '__main__':
+    """ Forwards and latency of a program finding several objects over a sequence, one forward per (label, frame) versus
+    multi-label prompts over micro-batches of frames with the (frame, label) cache.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_frames', type=int, default=16)
+    parser.add_argument('-b', '--batch_size', type=int, default=4)
+    args = parser.parse_args()
+
+    model = tiny_grounding_dino()
+    tokenizer = BertHashTokenizer(model.config.text_config.vocab_size)
+    intrinsics = intrinsics_from_fov(IMAGE_SIZE)
+    frames = [render_room(pose, intrinsics, IMAGE_SIZE)[0] for pose in synthetic_trajectory(args.num_frames)]
+    config = dict(image_size=IMAGE_SIZE[0], max_image_size=IMAGE_SIZE[1])
+
+    engine = ModelGroundingDino(ModelGroundingDinoConfig(**config), model=model, tokenizer=tokenizer)
+    register_model('ModelGroundingDino', engine)
+    program([ImagePatch(frames[0])]) # warm up
+
+    runs = [
+        ('per call', ModelGroundingDinoConfig(**config, batch_size=1, cache_size=0), False),
+        ('per call, cache', ModelGroundingDinoConfig(**config, batch_size=1), False),
+        ('lazy, cache', ModelGroundingDinoConfig(**config, batch_size=args.batch_size), True),
+        ('lazy, cache, rerun', None, True),
+    ]
+    for name, engine_config, lazy in runs:
+        if engine_config is not None:
+            engine = ModelGroundingDino(engine_config, model=model, tokenizer=tokenizer)
+            register_model('ModelGroundingDino', engine)
+        forwards, hits, misses = engine.stats.forwards, engine.stats.hits, engine.stats.misses
+        patches = [ImagePatch(frame) for frame in frames]
+        start = time.perf_counter()
+        if lazy:
+            with lazy_mode():
+                result = resolve(program(patches))
+        else:
+            result = program(patches)
+        elapsed = time.perf_counter() - start
+        hits, misses = engine.stats.hits - hits, engine.stats.misses - misses
+        print(
+            f'{name:>20}: {elapsed:6.2f}s, {engine.stats.forwards - forwards:3d} forwards, '
+            f'hit rate {hits / max(hits + misses, 1):.2f}, found {result[0]} cabinets, chairs, doors'
+        )
@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+
+from tiny_eqa.agents.embedding_index import IVFConfig
+from tiny_eqa.agents.scene_cache import EmbeddingDatabase
+
+
+N, DIM, K = 100_000, 384, 10
+
+
+if __name__ == '__main__':
+    """ Build time, recall and QPS of the IVF and IVF-PQ backends of EmbeddingDatabase against exact search, on
+    clustered embeddings.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((2000, DIM), dtype=np.float32)
+    data = centers[rng.integers(len(centers), size=N)] + 0.5 * rng.standard_normal((N, DIM), dtype=np.float32)
+    queries = centers[rng.integers(len(centers), size=256)] + 0.5 * rng.standard_normal((256, DIM), dtype=np.float32)
+
+    def qps(database, **kwargs):
+        """ QPS of one query per search call, and of all queries in one call. """
+        start = time.perf_counter()
+        for query in queries:
+            database.search(query, k=K, **kwargs)
+        single = len(queries) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        database.search(queries, k=K, **kwargs)
+        return f'{single:.0f} QPS single, {len(queries) / (time.perf_counter() - start):.0f} QPS batched'
+
+    exact = EmbeddingDatabase()
+    exact.add(data, [None] * N)
+    _, reference = exact.search(queries, k=K)
+    print(f'exact: {qps(exact)}')
+
+    for name, config in [('ivf', IVFConfig()), ('ivf-pq', IVFConfig(pq_subspaces=48))]:
+        database = EmbeddingDatabase(backend='ivf', ivf=config)
+        start = time.perf_counter()
+        for batch in np.split(data, 100):
+            database.add(batch, [None] * len(batch))
+        print(f'{name}: built in {time.perf_counter() - start:.1f}s')
+        for nprobe in [1, 4, 16, 64]:
+            _, ids = database.search(queries, k=K, nprobe=nprobe)
+            recall = np.mean([len(np.intersect1d(a, b)) / K for a, b in zip(ids, reference)])
+            print(f'    nprobe={nprobe:>3}: recall@{K} {recall:.3f}, {qps(database, nprobe=nprobe)}')
@@ -0,0 +1,37 @@
+import argparse
+import tempfile
+import time
+
+from tiny_eqa.data.keyframes import KeyframeConfig
+from tiny_eqa.data.sequence_reader import ScannetFrameSequenceReader
+from tiny_eqa.data.synthetic import write_synthetic_scannet
+
+
+NUM_MODELS = 4 # per-frame calls of DinoModel, ModelClip, ModelGroundingDino, ModelLlava
+
+
+if __name__ == '__main__':
+    """ Frames kept and model calls saved by keyframe selection on a synthetic scan, for several configurations.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_frames', type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_synthetic_scannet(tmpdir, num_frames=args.num_frames, image_size=(480, 640), depth_size=(240, 320))
+        sequence = ScannetFrameSequenceReader(tmpdir).sequence()
+
+        for config in [
+            KeyframeConfig(),
+            KeyframeConfig(max_overlap=0.6, max_hash_distance=20),
+            KeyframeConfig(max_frames=50),
+        ]:
+            start = time.perf_counter()
+            keyframes, ids = sequence.keyframes(config)
+            elapsed = time.perf_counter() - start
+            saved = (len(sequence) - len(keyframes)) * NUM_MODELS
+            print(
+                f'{config}\n'
+                f'    kept {len(keyframes)}/{len(sequence)} frames in {elapsed:.2f}s, '
+                f'saving {saved} model calls ({1 - len(keyframes) / len(sequence):.0%})'
+            )
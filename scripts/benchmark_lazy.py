@@ -0,0 +1,86 @@
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from tiny_eqa.agents import scene_patch_functions
+from tiny_eqa.agents.agent import Program
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.data.sequence_reader import read_scannet_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet
+from tiny_eqa.models.model_clip import ModelClip, ModelClipConfig
+from scripts.benchmark_clip import HashTokenizer, tiny_clip
+from scripts.benchmark_visibility import random_instances
+
+
+PROGRAMS = {
+    'best match': """
+def execute_command(scene):
+    scene_patch = ScenePatch(scene)
+    objects = scene_patch.find('object1') + scene_patch.find('object2') + scene_patch.find('object3')
+    match_scores = [patch.text_match('something you would wear in the winter') for patch in objects]
+    return objects[np.argmax(match_scores)]
+""",
+    'threshold': """
+def execute_command(scene):
+    scene_patch = ScenePatch(scene)
+    texts = ['a wooden chair', 'a metal chair', 'a fluffy stool']
+    objects = (scene_patch.find('object0') + scene_patch.find('object5'))[:16]
+    scores = [scene_patch.crop(patch.point1, patch.point2).text_match(text) for patch in objects for text in texts]
+    return bool_to_yesno(sum(scores) / len(scores) > 0.5)
+""",
+    'render': """
+def execute_command(scene):
+    scene_patch = ScenePatch(scene)
+    objects = scene_patch.find('object1')[:3] + scene_patch.find('object4')[:3]
+    views = [render(a.center, b.center) for a in objects for b in objects if a is not b]
+    crops = [view.crop(view.center - 40, view.center + 40) for view in views]
+    scores = [crop.text_match('a cooking stove') - view.text_match('a kitchen') for view, crop in zip(views, crops)]
+    return max(scores)
+""",
+}
+
+
+if __name__ == '__main__':
+    """ Forward passes and latency of sample programs with calls executed one by one versus deferred and batched.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_frames', type=int, default=200)
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    model = tiny_clip()
+    tokenizer = HashTokenizer(model.config.text_config.vocab_size)
+    forwards = []
+    model.vision_model.register_forward_hook(lambda *_: forwards.append('image'))
+    model.text_model.register_forward_hook(lambda *_: forwards.append('text'))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_synthetic_scannet(tmpdir, num_frames=args.num_frames, image_size=(240, 320), depth_size=(240, 320))
+        scene = read_scannet_sequence(tmpdir)
+        # labels repeat so `find` returns several patches
+        instances = random_instances(60)
+        instances.labels = [f'object{i % 6}' for i in range(len(instances.labels))]
+        scene.instances = instances
+        scene_patch_functions.SCENE_FIND_LABELS = True # random instances are not in the frames, find them by label
+
+        for name, code in PROGRAMS.items():
+            program = Program(code)
+            register_model('ModelClip', ModelClip(ModelClipConfig(), model=model, tokenizer=tokenizer))
+            program.execute_command(scene) # warm up visibility and view caches
+            results = {}
+            for lazy in [False, True]:
+                latencies = []
+                for _ in range(args.repeats):
+                    register_model('ModelClip', ModelClip(ModelClipConfig(), model=model, tokenizer=tokenizer))
+                    forwards.clear()
+                    start = time.perf_counter()
+                    results[lazy] = program.execute_command(scene, lazy=lazy)
+                    latencies.append(time.perf_counter() - start)
+                print(
+                    f'{name:>10}, {"lazy" if lazy else "eager":>5}: {forwards.count("image"):3d} image + {forwards.count("text"):2d} text forwards, '
+                    f'{np.median(latencies) * 1e3:7.1f}ms'
+                )
+            eager, lazy = [result if isinstance(result, str) else getattr(result, 'center', result) for result in results.values()]
+            print(f'{"":>10}  same result: {eager == lazy if isinstance(eager, str) else np.allclose(eager, lazy, atol=1e-4)}')
@@ -0,0 +1,62 @@
+import time
+
+import numpy as np
+import torch
+
+from tiny_eqa.data.synthetic import intrinsics_from_fov, render_room, synthetic_trajectory
+from tiny_eqa.utils.geometry import InstanceVoxels, lift_masks
+
+
+NUM_FRAMES, SIZE, ROOM, TILE = 64, (240, 320), np.array([6, 5, 3]), 1.0
+
+
+def tile_ids(points: np.ndarray) -> np.ndarray:
+    """ Instances are 1m tiles of the room's walls, floor and ceiling.
+    """
+    distances = np.concatenate([np.abs(points), np.abs(points - ROOM)], axis=-1)
+    wall = np.argmin(distances, axis=-1)
+    tiles = np.clip(np.floor(points / TILE).astype(int), 0, None)
+    tiles[np.eye(3, dtype=bool)[wall % 3]] = 0 # tile along the wall plane only
+    dims = np.ceil(ROOM / TILE).astype(int)
+    return ((wall * dims[0] + tiles[..., 0]) * dims[1] + tiles[..., 1]) * dims[2] + tiles[..., 2]
+
+
+if __name__ == '__main__':
+    """ Throughput and accuracy of lifting per frame 2D instance masks to the 3D instances of a scene.
+    """
+    # scene instance segmentation from a dense point sample of the room surfaces, a few centimeters thick like a
+    # reconstructed mesh, so voxels on both sides of the exact surface are occupied
+    rng = np.random.default_rng(0)
+    surface = rng.uniform(0, 1, (400_000, 3)) * ROOM
+    axis = rng.integers(3, size=len(surface))
+    surface[np.arange(len(surface)), axis] = rng.integers(2, size=len(surface)) * ROOM[axis] + rng.uniform(-0.03, 0.03, len(surface))
+    _, instance_ids = np.unique(tile_ids(surface), return_inverse=True)
+    tile_to_instance = dict(zip(tile_ids(surface), instance_ids))
+    scene = InstanceVoxels.from_points(torch.from_numpy(surface).float(), torch.from_numpy(instance_ids), voxel_size=0.05)
+
+    # frames with one mask per visible tile, as a detector would produce
+    intrinsics = intrinsics_from_fov(SIZE)
+    poses = synthetic_trajectory(NUM_FRAMES, room=tuple(ROOM))
+    depths, masks, truth = [], [], []
+    for pose in poses:
+        _, depth = render_room(pose, intrinsics, SIZE, room=tuple(ROOM))
+        v, u = np.mgrid[0:SIZE[0], 0:SIZE[1]] + 0.5
+        points = (np.stack([u, v, np.ones_like(u)], -1) @ np.linalg.inv(intrinsics).T) * depth[..., None] @ pose[:3, :3].T + pose[:3, 3]
+        tiles = tile_ids(points)
+        visible, mask = np.unique(tiles, return_inverse=True)
+        masks.append(mask.reshape(SIZE) + len(truth))
+        truth.extend(tile_to_instance.get(tile, -1) for tile in visible)
+        depths.append(depth)
+    depths = torch.from_numpy(np.stack(depths))
+    masks = torch.from_numpy(np.stack(masks))
+    intrinsics = torch.from_numpy(intrinsics).float()
+    poses = torch.from_numpy(poses)
+
+    start = time.perf_counter()
+    instances, shares = lift_masks(depths, intrinsics, poses, masks, scene, num_masks=len(truth))
+    elapsed = time.perf_counter() - start
+    accuracy = (instances.numpy() == np.array(truth)).mean()
+    print(
+        f'lifted {len(truth)} masks from {NUM_FRAMES} frames ({depths.numel() / 1e6:.1f}M points) in {elapsed:.2f}s: '
+        f'{depths.numel() / elapsed / 1e6:.1f}M points/s, accuracy {accuracy:.3f}, mean vote share {shares.mean():.3f}'
+    )
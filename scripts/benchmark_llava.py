@@ -0,0 +1,87 @@
+import argparse
+import time
+import zlib
+
+import numpy as np
+import torch
+from transformers import CLIPVisionConfig, LlamaConfig, LlavaConfig, LlavaForConditionalGeneration
+
+from tiny_eqa.models.model_llava import ModelLlava, ModelLlavaConfig
+
+
+class LlamaHashTokenizer:
+    """ Offline stand-in for the LLaVA tokenizer, mapping words to ids by hash, with Llama's special token ids.
+    """
+    pad_token_id, bos_token_id, eos_token_id = 0, 1, 2
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+
+    def __call__(self, text: str, add_special_tokens=False) -> dict:
+        return {'input_ids': [4 + zlib.crc32(word.encode()) % (self.vocab_size - 4) for word in text.split()]}
+
+    def decode(self, ids: list[int], skip_special_tokens=True) -> str:
+        return ' '.join(f'w{i}' for i in ids if not (skip_special_tokens and i < 4))
+
+
+def tiny_llava(vocab_size=4096) -> LlavaForConditionalGeneration:
+    """ Randomly initialized LLaVA with a small CLIP vision tower (64 vision tokens) and Llama language model.
+    """
+    torch.manual_seed(0)
+    config = LlavaConfig(
+        vision_config=CLIPVisionConfig(
+            image_size=112, patch_size=14, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+        ),
+        text_config=LlamaConfig(
+            vocab_size=vocab_size, hidden_size=256, intermediate_size=512, num_hidden_layers=4, num_attention_heads=4,
+            num_key_value_heads=4, max_position_embeddings=8192, pad_token_id=0, bos_token_id=1, eos_token_id=2,
+        ),
+        image_token_index=3,
+    )
+    return LlavaForConditionalGeneration(config)
+
+
+if __name__ == '__main__':
+    """ Time to first token and decoding throughput of several questions about the same crops, with the prefix KV cache
+    recomputed per question versus kept per image, sequentially and batched.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--num_images', type=int, default=2)
+    parser.add_argument('-q', '--num_questions', type=int, default=8, help='questions per image')
+    parser.add_argument('-t', '--max_new_tokens', type=int, default=16)
+    args = parser.parse_args()
+
+    model = tiny_llava()
+    tokenizer = LlamaHashTokenizer(model.config.text_config.vocab_size)
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (rng.integers(64, 300), rng.integers(64, 300), 3), dtype=np.uint8) for _ in range(args.num_images)]
+    subjects = ['chair', 'table', 'door', 'window', 'lamp', 'sofa', 'shelf', 'picture']
+    questions = [f'What color is the {subjects[i % len(subjects)]} next to the wall{" on the left" * (i % 3)}?' for i in range(args.num_questions)]
+
+    def run(reuse_prefix: bool, batched: bool, max_new_tokens: int):
+        engine = ModelLlava(ModelLlavaConfig(reuse_prefix=reuse_prefix), model=model, tokenizer=tokenizer)
+        outputs = []
+        start = time.perf_counter()
+        for image in images:
+            if batched:
+                outputs += engine.generate(image, questions, max_new_tokens)
+            else:
+                outputs += [engine.generate(image, [question], max_new_tokens)[0] for question in questions]
+        return time.perf_counter() - start, outputs, engine.stats
+
+    run(True, True, 2) # warm up
+    reference = None
+    for name, reuse_prefix, batched in [
+        ('no reuse, sequential', False, False),
+        ('reuse, sequential', True, False),
+        ('reuse, batched', True, True),
+    ]:
+        ttft, _, _ = run(reuse_prefix, batched, 1)
+        elapsed, outputs, stats = run(reuse_prefix, batched, args.max_new_tokens)
+        reference = reference or outputs
+        # batched questions all get their first token at the end of the batch
+        ttft = ttft / (args.num_images if batched else args.num_images * args.num_questions)
+        print(
+            f'{name:>22}: TTFT {ttft * 1e3:6.1f}ms, {stats.generated_tokens / elapsed:6.1f} tokens/s, '
+            f'{stats.prefill_tokens} prefill tokens, same answers: {outputs == reference}'
+        )
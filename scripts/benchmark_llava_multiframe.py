@@ -0,0 +1,58 @@
+import argparse
+import time
+
+from tiny_eqa.data.synthetic import intrinsics_from_fov, render_room, synthetic_trajectory
+from tiny_eqa.models.model_clip import ModelClip
+from tiny_eqa.models.model_llava_multiframe import ModelLlavaMultiframe, ModelLlavaMultiframeConfig
+from scripts.benchmark_clip import HashTokenizer, tiny_clip
+from scripts.benchmark_llava import LlamaHashTokenizer, tiny_llava
+
+
+IMAGE_SIZE = (240, 320)
+
+
+def kv_bytes(engine: ModelLlavaMultiframe) -> int:
+    """ Bytes of the prefix KV caches held by the engine.
+    """
+    return sum(k.nbytes + v.nbytes for prefix in engine.cache.values() for k, v in prefix.kv)
+
+
+if __name__ == '__main__':
+    """ Latency and prefix KV cache memory of questions about increasingly many scan frames, with every frame's full vision
+    tokens versus pooled frames packed into a token budget by CLIP relevance.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--frame_counts', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('-q', '--num_questions', type=int, default=4)
+    parser.add_argument('-t', '--max_new_tokens', type=int, default=8)
+    args = parser.parse_args()
+
+    model = tiny_llava()
+    tokenizer = LlamaHashTokenizer(model.config.text_config.vocab_size)
+    clip_model = tiny_clip()
+    clip = ModelClip(model=clip_model, tokenizer=HashTokenizer(clip_model.config.text_config.vocab_size))
+    intrinsics = intrinsics_from_fov(IMAGE_SIZE)
+    all_frames = [render_room(pose, intrinsics, IMAGE_SIZE)[0] for pose in synthetic_trajectory(max(args.frame_counts))]
+    objects = ['chair', 'table', 'door', 'window', 'lamp', 'sofa', 'shelf', 'picture']
+    rounds = [
+        [f'What color is the {objects[(i + j) % len(objects)]}?' for i in range(args.num_questions)] for j in range(2)
+    ]
+
+    runs = {
+        'all frames, 64 tokens': dict(frame_tokens=64, max_tokens=10**9),
+        'budget, 16 tokens': dict(frame_tokens=16, max_tokens=128),
+    }
+    for name, config in runs.items():
+        for num_frames in args.frame_counts:
+            frames = all_frames[:num_frames]
+            engine = ModelLlavaMultiframe(ModelLlavaMultiframeConfig(**config), model=model, tokenizer=tokenizer, clip=clip)
+            times = []
+            for questions in rounds: # the second round reuses the frames' cached encodings
+                start = time.perf_counter()
+                engine.generate_frames(frames, questions, args.max_new_tokens)
+                times.append(time.perf_counter() - start)
+            length = max(prefix.length for prefix in engine.cache.values())
+            print(
+                f'{name:>22}, {num_frames:3d} frames: {times[0]:6.2f}s, then {times[1]:6.2f}s, '
+                f'{length:5d} prefix tokens, {kv_bytes(engine) / 2**20:7.1f}MB prefix KV'
+            )
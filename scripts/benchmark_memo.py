@@ -0,0 +1,102 @@
+import argparse
+import random
+import tempfile
+import time
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from tiny_eqa.agents import scene_patch_functions
+from tiny_eqa.agents.agent import Agent, Program
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.data.sequence_reader import read_scannet_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet
+from tiny_eqa.models.model_clip import ModelClip, ModelClipConfig
+from scripts.benchmark_clip import HashTokenizer, tiny_clip
+from scripts.benchmark_visibility import random_instances
+
+
+OBJECTS = ['chair', 'table', 'door', 'cabinet', 'bed', 'sofa']
+
+TEMPLATES = [
+    """
+def execute_command({scene}) -> str:
+    {patch} = ScenePatch({scene})
+    return bool_to_yesno({patch}.exists('{a}'))
+""",
+    """
+def execute_command({scene}) -> ScenePatch:
+    {patch} = ScenePatch({scene})
+    {items} = {patch}.find('{a}')
+    {scores} = [{item}.text_match('a ' + '{b}' + ' next to the {a}') for {item} in {items}]
+    return {items}[np.argmax({scores})]
+""",
+    """
+def execute_command({scene}) -> str:
+    {patch} = ScenePatch({scene})
+    {items} = {patch}.find('{a}') + {patch}.find('{b}')
+    {scores} = [{item}.text_match('something {b}') for {item} in {items}]
+    return bool_to_yesno(max({scores}) > 0.5)
+""",
+]
+
+
+class ReplayAgent(Agent):
+    """ Agent answering tasks with fixed programs instead of generating them.
+    """
+    def __init__(self, config: OmegaConf, programs: dict[str, str]):
+        super().__init__(config)
+        self.programs = programs
+
+    def process(self, task: str) -> Program:
+        return Program(self.programs[task])
+
+
+def sample_split(num_tasks: int, seed=0) -> dict[str, str]:
+    """ Questions about one scene, as generated programs that repeat up to variable names and formatting.
+    """
+    rng = random.Random(seed)
+    programs = {}
+    for i in range(num_tasks):
+        a, b = rng.sample(OBJECTS, 2)
+        names = {key: rng.choice([key, f'{key}_{i}', key[0], f'my_{key}']) for key in ['scene', 'patch', 'items', 'item', 'scores']}
+        program = rng.choice(TEMPLATES).format(a=a, b=b, **names)
+        programs[f'task {i}'] = program.replace('    ', ' ' * rng.choice([2, 4]))
+    return programs
+
+
+if __name__ == '__main__':
+    """ Model calls and latency over a split of questions about one scene, with and without memoization.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_tasks', type=int, default=200)
+    args = parser.parse_args()
+
+    model = tiny_clip()
+    tokenizer = HashTokenizer(model.config.text_config.vocab_size)
+    forwards = []
+    model.vision_model.register_forward_hook(lambda *_: forwards.append('image'))
+
+    programs = sample_split(args.num_tasks)
+    print(f'{len(programs)} tasks, {len(set(programs.values()))} distinct programs')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_synthetic_scannet(tmpdir, num_frames=100, image_size=(240, 320), depth_size=(240, 320))
+        scene = read_scannet_sequence(tmpdir)
+        instances = random_instances(30)
+        instances.labels = [OBJECTS[i % len(OBJECTS)] for i in range(len(instances.labels))]
+        scene.instances = instances
+        scene_patch_functions.SCENE_FIND_LABELS = True # random instances are not in the frames, find them by label
+
+        results = {}
+        for name, memo in [('no memo', None), ('memo', {})]:
+            agent = ReplayAgent(OmegaConf.create({'memo': memo}), programs)
+            register_model('ModelClip', ModelClip(ModelClipConfig(), model=model, tokenizer=tokenizer))
+            forwards.clear()
+            start = time.perf_counter()
+            results[name] = [agent(task, scene) for task in programs]
+            elapsed = time.perf_counter() - start
+            print(f'{name:>8}: {len(forwards):4d} image forwards, {elapsed:.2f}s')
+            if agent.memo is not None:
+                print(f'{"":>8}  {agent.memo.stats}')
+        same = all(a is b or np.all(a == b) or np.allclose(a.center, b.center) for a, b in zip(*results.values()))
+        print(f'same results: {same}')
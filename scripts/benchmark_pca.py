@@ -0,0 +1,52 @@
+import time
+from typing import Callable
+
+import torch
+from sklearn.decomposition import PCA
+
+from tiny_eqa.utils.math import StreamingPCA, pca_fit, pca_transform
+
+
+def timeit(name: str, fn: Callable):
+    """ Prints the wall time of one call of `fn`.
+    """
+    start = time.perf_counter()
+    fn()
+    print(f'{name:>28}: {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    """ PCA of DINO features per frame with sklearn versus torch, and with one basis shared by all frames, and agreement
+    of the torch subspaces with sklearn.
+    """
+    torch.manual_seed(0)
+    num_frames, num_patches, dim = 32, 34 * 45, 1024 # dinov2_vitl14 features of 480x640 frames with downsample 1
+    spectrum = torch.logspace(1, -1, 64) # decaying spectrum so the top components are well defined
+    features = (torch.randn(num_frames * num_patches, 64) * spectrum) @ torch.randn(64, dim) + 0.1 * torch.randn(num_frames * num_patches, dim)
+    features = features / features.norm(dim=-1, keepdim=True)
+    frames = features.reshape(num_frames, num_patches, dim)
+
+    def sklearn_per_frame():
+        for frame in frames:
+            x = frame.detach().cpu().numpy()
+            PCA(n_components=3).fit(x).transform(x)
+
+    def streaming_shared():
+        pca = StreamingPCA(dim)
+        for frame in frames:
+            pca.partial_fit(frame)
+        basis = pca.basis(3)
+        for frame in frames:
+            basis.transform(frame)
+
+    timeit('sklearn, per frame', sklearn_per_frame)
+    timeit('pca_transform, per frame', lambda: [pca_transform(frame, 3) for frame in frames])
+    timeit('pca_fit once, shared basis', lambda: pca_fit(features, 3).transform(features))
+    timeit('StreamingPCA, shared basis', streaming_shared)
+
+    # agreement of subspaces with sklearn on a single frame
+    reference = torch.from_numpy(PCA(n_components=3).fit(frames[0].numpy()).components_).float()
+    streaming = StreamingPCA(dim)
+    streaming.partial_fit(frames[0])
+    for name, basis in [('pca_fit', pca_fit(frames[0], 3)), ('StreamingPCA', streaming.basis(3))]:
+        print(f'{name} |cos| to sklearn components: {(basis.components @ reference.T).diagonal().abs().numpy().round(4)}')
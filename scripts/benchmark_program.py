@@ -0,0 +1,70 @@
+import argparse
+import ast
+import random
+import time
+
+from tiny_eqa.agents.program import (
+    PROGRAM_CACHE, ProgramBudget, ProgramInstrumenter, ProgramTimeout, compile_program, program_namespace, validate_program,
+)
+
+
+PROGRAMS = [
+    """
+def execute_command(scene) -> str:
+    # Are there both cabinets and chairs in the scene
+    scene_patch = ScenePatch(scene)
+    condition1 = scene_patch.exists('cabinets')
+    condition2 = scene_patch.exists('chairs')
+    return bool_to_yesno(condition1 and condition2)
+""",
+    """
+def execute_command(scene) -> ScenePatch:
+    scene_patch = ScenePatch(scene)
+    text = 'Something you would wear in the winter.'
+    clothes = scene_patch.find('clothes')
+    match_scores = [clothes.text_match(text) for clothes in clothes]
+    return clothes[np.argmax(match_scores)]
+""",
+    """
+def execute_command(scene) -> str:
+    scene_patch = ScenePatch(scene)
+    door = scene_patch.find('door')[0]
+    kitchen_stove = scene_patch.find('kitchen stove')[0]
+    view = render(door.center, kitchen_stove.center)
+    return view.simple_qa('Is anything cooking?')
+""",
+]
+
+
+if __name__ == '__main__':
+    """ Latency of compiling generated programs with the compile cache versus parsing, validating and compiling each time.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_programs', type=int, default=2000)
+    args = parser.parse_args()
+
+    # reruns of a benchmark see the same programs, sometimes differing in formatting only
+    variants = [program.replace('    ', ' ' * indent) for program in PROGRAMS for indent in [4, 2, 8]]
+    calls = [random.Random(i).choice(variants) for i in range(args.num_programs)]
+
+    start = time.perf_counter()
+    for code in calls:
+        tree = ast.parse(code)
+        validate_program(tree)
+        compile(ast.fix_missing_locations(ProgramInstrumenter().visit(tree)), '<program>', 'exec')
+    fresh = (time.perf_counter() - start) / len(calls)
+    start = time.perf_counter()
+    for code in calls:
+        compile_program(code)
+    cached = (time.perf_counter() - start) / len(calls)
+    print(f'fresh parse: {fresh * 1e6:.1f}us/program, compile cache: {cached * 1e6:.1f}us/program ({len(PROGRAM_CACHE)} entries)')
+
+    for name, body in [('loop', 'while True:\n        pass'), ('builtin', 'return sum(range(10 ** 8))')]:
+        for max_steps, timeout in [(10_000, 60.0), (10 ** 9, 0.5)]:
+            namespace = program_namespace(ProgramBudget(max_steps, timeout))
+            exec(compile_program(f'def execute_command(scene):\n    {body}\n'), namespace)
+            start = time.perf_counter()
+            try:
+                namespace['execute_command'](None)
+            except ProgramTimeout as e:
+                print(f'runaway {name} stopped after {(time.perf_counter() - start) * 1e3:.1f}ms: {e}')
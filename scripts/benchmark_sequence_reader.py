@@ -0,0 +1,56 @@
+import argparse
+import tempfile
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+from tiny_eqa.data.sequence_reader import MemmapFrameSequenceReader, ScannetFrameSequenceReader, pack_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet
+
+
+def memory_status(field: str) -> float:
+    """ Returns a memory field of /proc/self/status, e.g. VmRSS or VmHWM (peak RSS), in MB.
+    """
+    with open('/proc/self/status') as f:
+        line = next(line for line in f if line.startswith(f'{field}:'))
+    return int(line.split()[1]) / 1024
+
+
+def benchmark(reader_class: type, path: Path, passes=2) -> tuple[float, float]:
+    """ Returns frames/s of streaming all frames `passes` times, and the increase of peak RSS in MB while streaming.
+    """
+    with open('/proc/self/clear_refs', 'w') as f: # resets the peak RSS, which would otherwise include the parent's
+        f.write('5')
+    baseline = memory_status('VmRSS')
+    reader = reader_class(path)
+    start = time.perf_counter()
+    for _ in range(passes):
+        for frame in reader.stream():
+            pass
+    fps = passes * len(reader) / (time.perf_counter() - start)
+    return fps, memory_status('VmHWM') - baseline
+
+
+if __name__ == '__main__':
+    """ Streaming throughput and peak memory of decoding a ScanNet export versus reading the packed memory-mapped store.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_frames', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path_scene = Path(tmpdir) / 'scene'
+        path_store = Path(tmpdir) / 'store'
+        write_synthetic_scannet(path_scene, num_frames=args.num_frames, image_size=(968, 1296), depth_size=(480, 640))
+
+        start = time.perf_counter()
+        pack_sequence(ScannetFrameSequenceReader(path_scene), path_store)
+        print(f'pack: {time.perf_counter() - start:.2f}s')
+
+        # each reader runs in a freshly spawned process, so the memory of rendering the scene and of the other reader is
+        # not counted
+        context = get_context('spawn')
+        for reader_class, path in [(ScannetFrameSequenceReader, path_scene), (MemmapFrameSequenceReader, path_store)]:
+            with context.Pool(1) as pool:
+                fps, rss = pool.apply(benchmark, (reader_class, path))
+            print(f'{reader_class.__name__}: {fps:.1f} frames/s, peak RSS +{rss:.0f} MB')
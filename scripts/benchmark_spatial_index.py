@@ -0,0 +1,51 @@
+import argparse
+import time
+
+import numpy as np
+
+from tiny_eqa.utils.spatial_index import InstanceIndex
+
+
+ROOM = np.array([50, 50, 5])
+
+
+if __name__ == '__main__':
+    """ Latency of the containment queries of ScenePatch programs with InstanceIndex versus a linear scan over all
+    instances.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_instances', type=int, default=10_000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(0, 1, (args.num_instances, 3)) * ROOM
+    sizes = rng.uniform(0.1, 1.5, (args.num_instances, 3))
+    bboxes = np.stack([centers - sizes / 2, centers + sizes / 2], axis=1)
+
+    start = time.perf_counter()
+    index = InstanceIndex(bboxes)
+    print(f'build: {(time.perf_counter() - start) * 1e3:.1f}ms for {args.num_instances} instances')
+
+    def scan_contained(point1, point2):
+        return np.flatnonzero(np.all((centers >= point1) & (centers <= point2), axis=1))
+
+    def nested_crops(contained, depth=3, branching=3, size=8):
+        """ Emulates programs like `for table in patch.find('table'): for cup in table.crop(...).find('cup'): ...` """
+        queries = 0
+        frontier = [(np.zeros(3), ROOM.astype(float))]
+        for _ in range(depth):
+            children = []
+            for point1, point2 in frontier:
+                ids = contained(point1, point2)
+                queries += 1
+                for i in ids[:branching]:
+                    children.append((centers[i] - size / 2, centers[i] + size / 2))
+            frontier = children
+            size /= 2
+        return queries
+
+    for name, contained in [('linear scan', scan_contained), ('InstanceIndex', index.contained)]:
+        start = time.perf_counter()
+        queries = sum(nested_crops(contained) for _ in range(20))
+        print(f'{name:>14}: nested crop programs {(time.perf_counter() - start) / queries * 1e6:.1f}us/query')
+
@@ -0,0 +1,47 @@
+import time
+
+import torch
+
+from tiny_eqa.utils.spatial_quantization import pool_superpixel_features
+
+
+def grid_superpixels(batch: int, H: int, W: int, num_segments: int, seed=0) -> torch.Tensor:
+    """ Jittered grid superpixels with roughly `num_segments` segments per image, standing in for SLIC.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    rows = int((num_segments * H / W) ** 0.5)
+    cols = num_segments // rows
+    v = torch.arange(H).view(1, H, 1) + torch.randint(0, H // rows, (batch, 1, W), generator=generator)
+    u = torch.arange(W).view(1, 1, W) + torch.randint(0, W // cols, (batch, H, 1), generator=generator)
+    return (v * rows // (H + H // rows)) * cols + (u * cols // (W + W // cols))
+
+
+def pool_loop(features: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """ Per label reference implementation.
+    """
+    B, h, w, dim = features.shape
+    upsampled = torch.nn.functional.interpolate(features.permute(0, 3, 1, 2), size=labels.shape[1:], mode='nearest')
+    outputs = []
+    for b in range(B):
+        for label in torch.unique(labels[b]):
+            outputs.append(upsampled[b][:, labels[b] == label].mean(dim=-1))
+    return torch.stack(outputs)
+
+
+if __name__ == '__main__':
+    """ Vectorized superpixel feature pooling versus a per label loop, on DINO sized features of two frames.
+    """
+    torch.manual_seed(0)
+    B, H, W, dim = 2, 480, 640, 1024
+    features = torch.randn(B, H // 14, W // 14, dim)
+    labels = grid_superpixels(B, H, W, 2048)
+
+    start = time.perf_counter()
+    regions = pool_superpixel_features(features, labels, normalize=False)
+    elapsed = time.perf_counter() - start
+    print(f'vectorized: {len(regions)} regions, {len(regions.adjacency)} adjacent pairs in {elapsed:.3f}s')
+
+    start = time.perf_counter()
+    reference = pool_loop(features, labels)
+    print(f'per label loop: {time.perf_counter() - start:.3f}s')
+    print(f'max abs error: {(regions.features - reference).abs().max():.2e}')
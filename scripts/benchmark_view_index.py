@@ -0,0 +1,81 @@
+import argparse
+import time
+
+import numpy as np
+
+from tiny_eqa.data.synthetic import intrinsics_from_fov, look_at
+from tiny_eqa.utils.spatial_index import ViewIndex
+
+
+IMAGE_SIZE = (480, 640)
+
+ROOM = np.array([6, 5, 3])
+
+
+def walkthrough(num_frames: int, seed=0) -> np.ndarray:
+    """ Handheld scan wandering through the room while looking around, like a ScanNet sequence.
+    """
+    rng = np.random.default_rng(seed)
+    position = ROOM / 2
+    yaw, poses = 0.0, []
+    for _ in range(num_frames):
+        position = np.clip(position + rng.normal(0, 0.02, 3) * [1, 1, 0.2], [0.3, 0.3, 1.0], ROOM - [0.3, 0.3, 1.0])
+        yaw += rng.normal(0, 0.05)
+        pitch = np.sin(yaw * 3) * 0.4
+        poses.append(look_at(position, position + [np.cos(yaw), np.sin(yaw), pitch]))
+    return np.stack(poses)
+
+
+def scan(index: ViewIndex, camera: np.ndarray, target: np.ndarray) -> int:
+    """ Naive view selection: loops over all frames for one render call, preferring frames facing the target.
+    """
+    best, best_facing = None, None
+    for i, (center, direction) in enumerate(zip(index.centers, index.directions)):
+        to_target = target - center
+        cos_target = direction @ to_target / max(np.linalg.norm(to_target), 1e-6)
+        visibility = np.clip((cos_target - index.cos_fov[i]) / (1 - index.cos_fov[i]), 0, 1)
+        view = target - camera
+        cos_view = direction @ view / max(np.linalg.norm(view), 1e-6)
+        score = visibility + index.direction_weight * cos_view - index.distance_weight * np.linalg.norm(center - camera)
+        if best is None or score > best[0]:
+            best = (score, i)
+        if cos_target >= index.cos_max_angle and (best_facing is None or score > best_facing[0]):
+            best_facing = (score, i)
+    return (best_facing or best)[1]
+
+
+if __name__ == '__main__':
+    """ Latency of selecting the view for many render calls on a long synthetic scan.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_frames', type=int, default=10_000)
+    parser.add_argument('-q', '--queries', type=int, default=1000)
+    parser.add_argument('-s', '--scan_queries', type=int, default=20, help='queries answered by the (slow) linear scan')
+    args = parser.parse_args()
+
+    poses = walkthrough(args.num_frames)
+    # render calls look from one object to another, both seen somewhere in the scan, e.g. `render(door.center, stove.center)`
+    rng = np.random.default_rng(0)
+    seen = poses[rng.integers(len(poses), size=(2, args.queries))]
+    objects = seen[..., :3, 3] + seen[..., :3, 2] * rng.uniform(0.5, 2.5, (2, args.queries, 1))
+    cameras, targets = np.clip(objects, 0, ROOM)
+
+    start = time.perf_counter()
+    index = ViewIndex(poses, intrinsics_from_fov(IMAGE_SIZE), IMAGE_SIZE)
+    print(f'build: {(time.perf_counter() - start) * 1e3:.1f}ms for {len(poses)} frames')
+
+    start = time.perf_counter()
+    reference = np.array([scan(index, camera, target) for camera, target in zip(cameras[:args.scan_queries], targets)])
+    print(f'   linear scan: {(time.perf_counter() - start) / args.scan_queries * 1e6:.1f}us/query')
+
+    start = time.perf_counter()
+    for camera, target in zip(cameras, targets):
+        index.query(camera, target)
+    print(f'  index, 1 by 1: {(time.perf_counter() - start) / args.queries * 1e6:.1f}us/query')
+
+    for k in [1, 5]:
+        start = time.perf_counter()
+        frames, scores = index.query(cameras, targets, k=k)
+        print(f' index, batched: {(time.perf_counter() - start) / args.queries * 1e6:.1f}us/query (top {k})')
+    agreement = (frames[:args.scan_queries, 0] == reference).mean()
+    print(f'top 1 agreement with linear scan: {agreement:.3f}')
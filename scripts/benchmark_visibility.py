@@ -0,0 +1,82 @@
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torchvision
+
+from tiny_eqa.agents.scene_patch import ScenePatch
+from tiny_eqa.agents.scene_patch_functions import SCENE_VISIBILITY, scene_visibility
+from tiny_eqa.data.sequence import SceneInstances
+from tiny_eqa.data.sequence_reader import read_scannet_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet
+
+
+ROOM = np.array([6, 5, 3])
+
+
+def random_instances(n: int, seed=0) -> SceneInstances:
+    """ Furniture sized boxes scattered over the room.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = rng.uniform(0.3, 1.2, (n, 3))
+    lower = rng.uniform(0, 1, (n, 3)) * (ROOM - sizes)
+    lower[:, 2] = 0
+    return SceneInstances(np.stack([lower, lower + sizes], axis=1), [f'object{i}' for i in range(n)])
+
+
+def detect(detector: torch.nn.Module, scene, frames) -> float:
+    """ Runs a stand-in per frame detector over `frames` of the scene, returning the wall-clock time.
+    """
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for frame in scene[np.asarray(frames)].stream():
+            detector(torch.from_numpy(np.array(frame.image)).permute(2, 0, 1)[None].float() / 255)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    """ Frames skipped by the frustum precheck and detector time saved for crops of decreasing size.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num_frames', type=int, default=200)
+    parser.add_argument('-q', '--queries', type=int, default=3, help='crops per size that are run through the detector')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    detector = torchvision.models.resnet18().eval()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_synthetic_scannet(tmpdir, num_frames=args.num_frames, image_size=(240, 320), depth_size=(240, 320))
+        scene = read_scannet_sequence(tmpdir)
+        scene.instances = random_instances(200)
+        scene_patch = ScenePatch(scene, np.zeros(3), ROOM)
+        latency = detect(detector, scene, np.arange(8)) / 8
+        print(f'{len(scene)} frames, detector stand-in {latency * 1e3:.1f}ms/frame')
+
+        crops = {
+            'room':        [(np.zeros(3), ROOM)],
+            'half room':   [(np.array([x, 0, 0]), np.array([x + 3, 5, 3])) for x in [0, 1.5, 3]],
+            'object':      [tuple(bbox) for bbox in scene.instances.bboxes[:50]],
+        }
+        for name, boxes in crops.items():
+            patches = [scene_patch.crop(*box) for box in boxes]
+            SCENE_VISIBILITY.clear()
+            start = time.perf_counter()
+            visibilities = [scene_visibility(patch) for patch in patches]
+            cold = (time.perf_counter() - start) / len(patches)
+            start = time.perf_counter()
+            for patch in patches:
+                scene_visibility(patch)
+            cached = (time.perf_counter() - start) / len(patches)
+
+            kept = np.mean([len(visibility) for visibility in visibilities])
+            queried = range(min(args.queries, len(patches)))
+            time_all = np.mean([detect(detector, scene, np.arange(len(scene))) for _ in queried]) if name == 'room' else latency * len(scene)
+            time_culled = np.mean([detect(detector, scene, visibilities[i].frames.numpy()) for i in queried])
+            print(
+                f'{name:>10}: {kept:6.1f}/{len(scene)} frames kept ({1 - kept / len(scene):.0%} skipped), '
+                f'precheck {cold * 1e3:.2f}ms cold / {cached * 1e6:.1f}us cached, '
+                f'detector {time_all:.2f}s -> {time_culled:.2f}s per query'
+            )
@@ -1,22 +1,58 @@
+import asyncio
+import re
+from contextlib import nullcontext
 from dataclasses import dataclass, field
+from functools import cached_property
 from omegaconf import OmegaConf
 
+from tiny_eqa.agents.lazy import lazy_mode, resolve
+from tiny_eqa.agents.memo import ProgramMemo
+from tiny_eqa.agents.program import ProgramBudget, canonicalize_program, compile_program, program_namespace
+from tiny_eqa.agents.scene_patch_functions import scene_context
 from tiny_eqa.data.sequence import FrameSequence
-from tiny_eqa.models.model_gpt import ModelGptInput, ModelGpt, unpack_content
+from tiny_eqa.models.model_gpt import (
+    HistoryPolicy, ModelGptInput, ModelGpt, ModelGptAsync, ModelGptAsyncConfig, unpack_content,
+)
+from tiny_eqa.models.model_gpt_cache import GptResponseCache, GptResponseCacheConfig
+
+
+def extract_code(content: str) -> str:
+    """
+    Returns the code of a model reply, which may be wrapped in a markdown code block.
+    """
+    match = re.search(r'```(?:python)?\n(.*?)```', content, re.DOTALL)
+    return match.group(1) if match else content
 
 
 class Program:
     """
     """
-    def __init__(self, code: str):
+    def __init__(self, code: str, max_steps=100_000, timeout=60.0):
+        """
+        `code` defines `execute_command(scene)` using the agent API. It is validated and compiled once, raising
+        `ProgramError` if it references anything outside of the API. Each execution is limited to `max_steps` loop
+        iterations and function calls and `timeout` seconds, raising `ProgramTimeout` otherwise.
         """
+        self.code = code
+        self.compiled = compile_program(code)
+        self.max_steps = max_steps
+        self.timeout = timeout
+
+    @cached_property
+    def canonical(self) -> str:
+        """
+        Canonical source of the program, shared by programs differing only in names, formatting or constant expressions.
         """
-        self.function = eval(code) # TODO parse
+        return canonicalize_program(self.code)
 
-    def execute_command(self, sequence: FrameSequence):
+    def execute_command(self, sequence: FrameSequence, lazy=False):
         """
+        If `lazy`, model calls of the API return futures that are run in batches when their values are needed.
         """
-        return function(sequence)
+        namespace = program_namespace(ProgramBudget(self.max_steps, self.timeout))
+        exec(self.compiled, namespace)
+        with scene_context(sequence), lazy_mode() if lazy else nullcontext():
+            return resolve(namespace['execute_command'](sequence))
 
 
 class Agent:
@@ -24,19 +60,67 @@ class Agent:
     """
     def __init__(self, config: OmegaConf):
         """
+        Results of programs and of model backed API calls are memoized per scene, with `ProgramMemo` arguments taken
+        from `config.memo`. Setting `config.memo` to None disables memoization. GPT responses are cached on disk at
+        `config.gpt_cache.path` if given, with `GptResponseCacheConfig` options from `config.gpt_cache.config`.
         """
         self.config = config
+        memo = config.get('memo', {})
+        self.memo = ProgramMemo(**memo) if memo is not None else None
+        cache = config.get('gpt_cache')
+        self.model = ModelGptAsync(
+            config.get('model', 'gpt-4-turbo'),
+            ModelGptAsyncConfig(**config.get('gpt', {})),
+            cache=GptResponseCache(cache.path, GptResponseCacheConfig(**cache.get('config', {}))) if cache else None,
+        )
+
+    @cached_property
+    def prompt(self) -> str:
+        """
+        API prompt generated by `scripts/generate_prompts.py`.
+        """
+        with open(self.config.get('prompt', 'prompts/viper_eqa.txt')) as f:
+            return f.read()
 
     def __call__(self, task: str, sequence: FrameSequence):
         """
         """
         program = self.process(task)
-        return program.execute_command(sequence)
+        return self.execute(program, sequence)
+
+    def execute(self, program: Program, sequence: FrameSequence, lazy=False):
+        """
+        Executes `program` on `sequence`, reusing memoized results of equivalent programs and API calls on the scene.
+        """
+        if self.memo is None:
+            return program.execute_command(sequence, lazy=lazy)
+        return self.memo.run(sequence, program.canonical, lambda: program.execute_command(sequence, lazy=lazy))
 
     def process(self, task: str) -> Program:
         """
         """
-        pass
+        return self.process_batch([task])[0]
+
+    def process_batch(self, tasks: list[str]) -> list[Program]:
+        """
+        Generates the programs of `tasks` concurrently.
+        """
+        async def process_all():
+            try:
+                return await asyncio.gather(*[self.process_async(task) for task in tasks])
+            finally:
+                await self.model.close() # the client's connections end with the event loop
+        return asyncio.run(process_all())
+
+    async def process_async(self, task: str) -> Program:
+        """
+        Generates the program of `task` in a new conversation, whose system prefix is the API prompt.
+        """
+        conversation = self.model.conversation(system=self.prompt, policy=HistoryPolicy(**self.config.get('history', {})))
+        input = ModelGptInput()
+        input.append(task)
+        response = await self.model(input, conversation, max_tokens=self.config.get('max_tokens', 512))
+        return Program(extract_code(unpack_content(response)))
 
     def reset(self):
         """
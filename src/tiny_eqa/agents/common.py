@@ -1,6 +1,6 @@
 from collections import namedtuple
 
-from src.tiny_eqa.agents.common_functions import *
+from tiny_eqa.agents.common_functions import *
 
 
 Point2D = np.ndarray[2]
@@ -1,6 +1,9 @@
+from collections import Counter
+
 import numpy as np
 
 from tiny_eqa.models import *
+from tiny_eqa.models.model_base import Model
 
 
 def function_content_qa(question: str) -> str:
@@ -9,7 +12,29 @@ def function_content_qa(question: str) -> str:
     pass
 
 
-def run_model(model_class: str, *args, **kwargs) -> str:
+MODELS = {} # model class name -> model instance used by the agent API
+
+MODEL_CALLS = Counter() # model class name -> engine calls of the agent API, counted by `get_model`
+
+
+def register_model(model_class: str, model: Model):
+    """
+    Sets the instance of `model_class`, e.g. 'ModelClip', that backs the agent API.
+    """
+    MODELS[model_class] = model
+
+
+def get_model(model_class: str) -> Model:
+    """
+    Returns the registered instance of `model_class`, for one engine call.
+    """
+    assert model_class in MODELS, f'No {model_class} registered, see register_model'
+    MODEL_CALLS[model_class] += 1
+    return MODELS[model_class]
+
+
+def run_model(model_class: str, *args, **kwargs):
     """
+    Calls the registered instance of `model_class`.
     """
-    pass
\ No newline at end of file
+    return get_model(model_class)(*args, **kwargs)
\ No newline at end of file
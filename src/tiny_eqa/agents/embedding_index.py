@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
+
+
+@dataclass
+class IVFConfig:
+    """
+    """
+
+    """ Number of inverted lists (coarse k-means clusters). """
+    num_lists: int = 256
+
+    """ Number of lists scanned per query. Higher values trade latency for recall. """
+    nprobe: int = 8
+
+    """ Number of entries required before the coarse quantizer is trained. Searches are exact until then. """
+    min_train: int = 8192
+
+    """ Maximum number of entries sampled to train k-means. """
+    max_train: int = 65536
+
+    """ Number of k-means iterations. """
+    iterations: int = 10
+
+    """ Number of product quantization subspaces, each encoded in one byte. 0 scans exact embeddings instead. """
+    pq_subspaces: int = 0
+
+    """ Number of best product quantization candidates rescored with exact embeddings. """
+    rerank: int = 64
+
+
+def kmeans(data: NumpyTensor['n', 'dim'], k: int, iterations: int, seed=0, spherical=False) -> NumpyTensor['k', 'dim']:
+    """
+    Returns k-means centroids of `data`, initialized from random samples. With `spherical`, points are assigned by
+    maximum dot product and centroids are normalized, which clusters normalized embeddings by cosine similarity.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    data = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))
+    centroids = data[torch.randperm(len(data), generator=generator)[:k]].clone()
+    for _ in range(iterations):
+        assignment = (data @ centroids.T).argmax(dim=1) if spherical else torch.cdist(data, centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, data)
+        counts = torch.bincount(assignment, minlength=k)
+        empty = counts == 0 # reseed empty clusters from random samples
+        centroids = torch.where(empty[:, None], data[torch.randint(len(data), (k,), generator=generator)], sums / counts.clamp(min=1)[:, None])
+        if spherical:
+            centroids = centroids / centroids.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    return centroids.numpy()
+
+
+def merge_topk(
+    scores: TorchTensor['m', 'k'], ids: TorchTensor['m', 'k'], rows: TorchTensor['r'], new_scores: TorchTensor['r', 'n'], new_ids: TorchTensor['r', 'n']
+):
+    """
+    Merges candidates into the running top k `scores` and `ids` of the queries `rows`, in place.
+    """
+    merged, order = torch.cat([scores[rows], new_scores], dim=1).topk(scores.shape[1], dim=1)
+    scores[rows] = merged
+    ids[rows] = torch.cat([ids[rows], new_ids], dim=1).gather(1, order)
+
+
+class InvertedList:
+    """
+    Growable array of entry ids assigned to one coarse cluster.
+    """
+    def __init__(self, capacity=16):
+        """
+        """
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def extend(self, ids: NumpyTensor['n']):
+        """
+        """
+        if self.size + len(ids) > len(self.ids):
+            grown = np.empty(max(2 * len(self.ids), self.size + len(ids)), dtype=np.int64)
+            grown[:self.size] = self.ids[:self.size]
+            self.ids = grown
+        self.ids[self.size:self.size + len(ids)] = ids
+        self.size += len(ids)
+
+    def view(self) -> NumpyTensor['size']:
+        """
+        """
+        return self.ids[:self.size]
+
+
+class IVFIndex:
+    """
+    Inverted file index over the rows of an `EmbeddingDatabase`, with optional product quantized codes. The coarse
+    quantizer is trained with spherical k-means, and entries and queries are assigned to lists by cosine similarity to
+    the normalized centroids, the metric of the database. New entries are assigned to the nearest trained centroid, so
+    adds never retrain the index.
+    """
+    def __init__(self, config: IVFConfig = None):
+        """
+        """
+        self.config = config or IVFConfig()
+        self.centroids = None
+        self.codebooks = None # (subspaces, 256, dim / subspaces)
+        self.codes = np.empty((0, self.config.pq_subspaces), dtype=np.uint8)
+        self.lists = []
+
+    @property
+    def trained(self) -> bool:
+        """
+        """
+        return self.centroids is not None
+
+    def train(self, embeddings: NumpyTensor['n', 'dim']):
+        """
+        Trains the coarse quantizer and product quantizer on a sample of `embeddings` and indexes all of them.
+        """
+        sample = embeddings[np.random.default_rng(0).permutation(len(embeddings))[:self.config.max_train]].astype(np.float32)
+        num_lists = min(self.config.num_lists, len(sample))
+        self.centroids = kmeans(sample, num_lists, self.config.iterations, spherical=True)
+        self.lists = [InvertedList() for _ in range(num_lists)]
+        if self.config.pq_subspaces:
+            M = self.config.pq_subspaces
+            assert sample.shape[1] % M == 0, 'Embedding dimension must be divisible by pq_subspaces'
+            self.codebooks = np.stack([
+                kmeans(subspace, min(256, len(sample)), self.config.iterations) for subspace in np.split(sample, M, axis=1)
+            ])
+            self.codes = np.empty((0, M), dtype=np.uint8)
+        self.add(np.arange(len(embeddings)), embeddings)
+
+    def add(self, ids: NumpyTensor['n'], embeddings: NumpyTensor['n', 'dim']):
+        """
+        """
+        if not self.trained or len(ids) == 0:
+            return
+        embeddings = torch.from_numpy(np.ascontiguousarray(embeddings, dtype=np.float32))
+        assignment = (embeddings @ torch.from_numpy(self.centroids).T).argmax(dim=1).numpy()
+        order = np.argsort(assignment, kind='stable')
+        boundaries = np.flatnonzero(np.diff(assignment[order])) + 1
+        for group in np.split(order, boundaries):
+            self.lists[assignment[group[0]]].extend(ids[group])
+
+        if self.codebooks is not None:
+            if ids.max() >= len(self.codes):
+                codes = np.zeros((max(2 * len(self.codes), ids.max() + 1), self.codebooks.shape[0]), dtype=np.uint8)
+                codes[:len(self.codes)] = self.codes
+                self.codes = codes
+            self.codes[ids] = self.encode(embeddings.numpy())
+
+    def encode(self, embeddings: NumpyTensor['n', 'dim']) -> NumpyTensor['n', 'subspaces']:
+        """
+        """
+        subspaces = np.split(embeddings, len(self.codebooks), axis=1)
+        return np.stack([
+            torch.cdist(torch.from_numpy(x), torch.from_numpy(codebook)).argmin(dim=1).numpy()
+            for x, codebook in zip(subspaces, self.codebooks)
+        ], axis=1).astype(np.uint8)
+
+    def search(
+        self,
+        queries: NumpyTensor['m', 'dim'],
+        k: int,
+        embeddings: NumpyTensor['N', 'dim'],
+        alive: NumpyTensor['N'],
+        nprobe: int = None,
+    ) -> tuple[NumpyTensor['m', 'k'], NumpyTensor['m', 'k']]:
+        """
+        Returns approximate cosine similarities and ids of the top `k` alive entries for each (normalized) query, scanning
+        the `nprobe` lists with the closest centroids. Lists are scanned once for all queries probing them, with one
+        matrix multiply per list. With product quantization, the `rerank` best candidates by approximate score are
+        rescored with the exact embeddings.
+        """
+        nprobe = min(nprobe or self.config.nprobe, len(self.lists))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        pq = self.codebooks is not None
+        size = self.config.rerank if pq else k # candidates kept per query while scanning
+
+        scores = torch.full((len(queries), size), -torch.inf)
+        ids = torch.full((len(queries), size), -1, dtype=torch.long)
+        queries = torch.from_numpy(np.ascontiguousarray(queries, dtype=np.float32))
+        if pq:
+            M = len(self.codebooks)
+            tables = torch.einsum('qmd,mcd->mcq', queries.reshape(len(queries), M, -1), torch.from_numpy(self.codebooks).float())
+            tables = tables.reshape(M * 256, len(queries)) # score of each (subspace, code) for each query
+            offsets = torch.arange(M) * 256
+
+        # group (query, list) probes by list
+        flat_lists = probes.ravel()
+        flat_queries = np.repeat(np.arange(len(queries)), nprobe)
+        order = np.argsort(flat_lists, kind='stable')
+        boundaries = np.flatnonzero(np.diff(flat_lists[order])) + 1
+        for group in np.split(order, boundaries):
+            candidates = self.lists[flat_lists[group[0]]].view()
+            candidates = candidates[alive[candidates]]
+            if len(candidates) == 0:
+                continue
+            rows = torch.from_numpy(flat_queries[group])
+            if pq:
+                codes = torch.from_numpy(self.codes[candidates].astype(np.int64)) + offsets # (n, M) rows of `tables`
+                candidate_scores = torch.nn.functional.embedding_bag(codes, tables[:, rows], mode='sum').T # (r, n)
+            else:
+                candidate_scores = queries[rows] @ torch.from_numpy(embeddings[candidates]).float().T
+            candidate_ids = torch.from_numpy(candidates).expand(len(rows), -1)
+            if candidate_scores.shape[1] > size:
+                candidate_scores, top = candidate_scores.topk(size, dim=1)
+                candidate_ids = candidate_ids.gather(1, top)
+            merge_topk(scores, ids, rows, candidate_scores, candidate_ids)
+
+        if pq: # exact rescoring of the reranked candidates
+            valid = ids >= 0
+            vectors = torch.from_numpy(embeddings[ids.clamp(min=0).numpy()]).float() # (m, rerank, dim)
+            scores = torch.where(valid, torch.einsum('qrd,qd->qr', vectors, queries), -torch.inf)
+            scores, order = scores.topk(min(k, size), dim=1)
+            ids = ids.gather(1, order)
+            if k > size:
+                scores = torch.cat([scores, torch.full((len(queries), k - size), -torch.inf)], dim=1)
+                ids = torch.cat([ids, torch.full((len(queries), k - size), -1, dtype=torch.long)], dim=1)
+        ids[torch.isinf(scores)] = -1
+        return scores.numpy(), ids.numpy()
+
+    def remap(self, mapping: NumpyTensor['N']):
+        """
+        Applies the id remapping returned by `EmbeddingDatabase.compact`, dropping removed ids.
+        """
+        for inverted_list in self.lists:
+            ids = mapping[inverted_list.view()]
+            inverted_list.size = 0
+            inverted_list.extend(ids[ids >= 0])
+        if self.codebooks is not None:
+            n = min(len(mapping), len(self.codes))
+            kept = mapping[:n] >= 0
+            codes = np.zeros_like(self.codes)
+            codes[mapping[:n][kept]] = self.codes[:n][kept]
+            self.codes = codes
+
+    def save(self, path: Path | str):
+        """
+        """
+        if not self.trained:
+            return
+        np.savez(
+            path,
+            centroids=self.centroids,
+            codebooks=np.empty(0) if self.codebooks is None else self.codebooks,
+            codes=self.codes,
+            list_ids=np.concatenate([inverted_list.view() for inverted_list in self.lists]),
+            list_sizes=np.array([inverted_list.size for inverted_list in self.lists]),
+        )
+
+    @classmethod
+    def load(cls, path: Path | str, config: IVFConfig = None) -> IVFIndex:
+        """
+        """
+        index = cls(config)
+        if not Path(path).exists():
+            return index
+        state = np.load(path)
+        index.centroids = state['centroids']
+        index.codebooks = state['codebooks'] if state['codebooks'].size else None
+        index.codes = state['codes']
+        index.lists = [InvertedList() for _ in range(len(index.centroids))]
+        for inverted_list, ids in zip(index.lists, np.split(state['list_ids'], np.cumsum(state['list_sizes'])[:-1])):
+            inverted_list.extend(ids)
+        return index
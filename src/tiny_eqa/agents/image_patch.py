@@ -13,9 +13,9 @@ class ImagePatch:
         # Implementation specific to ImagePatch
         self.image = image
         self.height, self.width = self.image.shape[:2]
-        self.point1 = point1 or np.zeros(2)
-        self.point2 = point2 or (self.width, self.height)
-        self.center = (point1 + point2) / 2
+        self.point1 = np.zeros(2) if point1 is None else np.asarray(point1)
+        self.point2 = np.array([self.width, self.height]) if point2 is None else np.asarray(point2)
+        self.center = (self.point1 + self.point2) / 2
 
     def crop(self, point1: Point2D, point2: Point2D) -> ImagePatch:
         # Implementation specific to ImagePatch
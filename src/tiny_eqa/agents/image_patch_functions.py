@@ -1,36 +1,146 @@
+import weakref
+
 import numpy as np
 from omegaconf import OmegaConf
 
+from tiny_eqa.agents.common_functions import get_model, run_model
+from tiny_eqa.agents.lazy import batchable
+from tiny_eqa.models.model_depth_anything import DepthCrop, image_to_depth
+
 
 class ImagePatch: # typing w/o circular imports
     pass
 
 
+IMAGE_SENSOR_DEPTHS = {} # id of a frame image -> (weak reference to the image, sensor depth, image to depth pixels)
+
+
+def image_set_sensor_depth(image: np.ndarray, depth: np.ndarray, intrinsics: np.ndarray = None, intrinsics_depth: np.ndarray = None):
+    """
+    Attaches the sensor depth of a frame, e.g. of a ScanNet sequence, to its image, so patches of the image use it
+    instead of predicted depth. Patches are mapped to depth pixels through the intrinsics if given, and otherwise by the
+    ratio of the resolutions. It is dropped with the image.
+    """
+    key = id(image)
+    transform = image_to_depth(intrinsics, intrinsics_depth) if intrinsics is not None else None
+    IMAGE_SENSOR_DEPTHS[key] = (weakref.ref(image, lambda _: IMAGE_SENSOR_DEPTHS.pop(key, None)), depth, transform)
+
+
+def image_sensor_depth(image: np.ndarray) -> tuple[np.ndarray, np.ndarray] | tuple[None, None]:
+    """
+    Returns the sensor depth attached to an image and its map of image to depth pixels, if any.
+    """
+    entry = IMAGE_SENSOR_DEPTHS.get(id(image))
+    return entry[1:] if entry is not None and entry[0]() is image else (None, None)
+
+
+def image_crop(image: ImagePatch) -> np.ndarray:
+    """
+    Returns the pixels of the patch as a view of the full image.
+    """
+    (x1, y1), (x2, y2) = np.floor(image.point1).astype(int), np.ceil(image.point2).astype(int)
+    return image.image[max(y1, 0):y2, max(x1, 0):x2]
+
+
+def image_detections(image: ImagePatch, boxes: np.ndarray) -> list[ImagePatch]:
+    """
+    Returns patches of the detected boxes in the full image whose center lies inside the patch, clipped to the patch.
+    """
+    patches = []
+    for box in boxes:
+        center = (box[:2] + box[2:]) / 2
+        if np.all(center >= image.point1) and np.all(center <= image.point2):
+            patches.append(image.crop(np.maximum(box[:2], image.point1), np.minimum(box[2:], image.point2)))
+    return patches
+
+
+def image_find_batch(calls: list[tuple[ImagePatch, str]]) -> list[list[ImagePatch]]:
+    """
+    Detects the objects of all deferred `image_find` calls in one Grounding DINO engine call over their distinct frames
+    and object names. Detection runs on full frames, so patches of the same frame share the engine's cached detections.
+    """
+    frames = {id(image.image): image.image for image, _ in calls}
+    detections = get_model('ModelGroundingDino')(list(frames.values()), [object_name for _, object_name in calls])
+    detections = dict(zip(frames, detections))
+    return [
+        image_detections(image, detections[id(image.image)][object_name].boxes.numpy()) for image, object_name in calls
+    ]
+
+
+@batchable(image_find_batch)
 def image_find(image: ImagePatch, object_name: str) -> list[ImagePatch]:
     """
     """
-    pass
+    return image_find_batch([(image, object_name)])[0]
+
+
+CHECK_CONDITION_QUESTION = 'Is the {object_name} {condition}? Answer yes or no.' # question of check_condition calls
+
+
+def answer_is_yes(answer: str) -> bool:
+    """
+    Whether a yes/no answer of the VLM is affirmative.
+    """
+    return answer.strip().lower().startswith('yes')
+
+
+def image_check_condition_batch(calls: list[tuple[ImagePatch, str, str]]) -> list[bool]:
+    """
+    Asks whether the object has the property for all deferred `image_check_condition` calls in one LLaVA engine call.
+    """
+    answers = image_simple_qa_batch([
+        (image, CHECK_CONDITION_QUESTION.format(object_name=object_name, condition=condition))
+        for image, object_name, condition in calls
+    ])
+    return [answer_is_yes(answer) for answer in answers]
 
 
+@batchable(image_check_condition_batch)
 def image_check_condition(image: ImagePatch, object_name: str, condition: str) -> bool:
     """
     """
-    pass
+    return image_check_condition_batch([(image, object_name, condition)])[0]
 
 
+def image_text_match_batch(calls: list[tuple[ImagePatch, str]]) -> list[float]:
+    """
+    Scores all (patch, text) pairs of deferred `image_text_match` calls in one CLIP engine call.
+    """
+    images, texts = zip(*calls)
+    return get_model('ModelClip').match([image_crop(image) for image in images], list(texts)).tolist()
+
+
+@batchable(image_text_match_batch)
 def image_text_match(image: ImagePatch, text: str) -> float:
     """
     """
-    pass
+    return image_text_match_batch([(image, text)])[0]
+
 
+SIMPLE_QA_QUESTION = 'What is this?' # question of simple_qa calls without one
 
+
+def image_simple_qa_batch(calls: list[tuple[ImagePatch, str]]) -> list[str]:
+    """
+    Answers all questions of deferred `image_simple_qa` calls in one LLaVA engine call, which prefills each distinct crop
+    once and decodes its questions together.
+    """
+    return get_model('ModelLlava')(
+        [image_crop(image) for image, _ in calls], [question or SIMPLE_QA_QUESTION for _, question in calls],
+    )
+
+
+@batchable(image_simple_qa_batch)
 def image_simple_qa(image: ImagePatch, question: str = None) -> str:
     """
     """
-    pass
+    return image_simple_qa_batch([(image, question)])[0]
 
 
-def image_compute_depth(image: ImagePatch) -> np.ndarray:
+def image_compute_depth(image: ImagePatch) -> DepthCrop:
     """
+    Returns the depth of the patch as a view of the cached depth map of its full frame, whose `median` is computed from
+    the map's precomputed table. Sensor depth attached to the frame is used without inference.
     """
-    pass
\ No newline at end of file
+    depth_map = run_model('ModelDepthAnything', image.image, *image_sensor_depth(image.image))
+    return depth_map.crop(image.point1, image.point2)
\ No newline at end of file
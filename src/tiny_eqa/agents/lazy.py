@@ -0,0 +1,219 @@
+import functools
+import operator
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable
+
+import numpy as np
+
+
+class Lazy:
+    """
+    Future of an agent API call or of an expression over other futures. Model calls are deferred to the `LazyBatcher`
+    that created them and run in one batch per function when any value is needed, e.g. by `if`, comparisons, `argmax` or
+    `bool_to_yesno`. Arithmetic on futures builds new futures without forcing them.
+    """
+    def __init__(self, batcher: 'LazyBatcher', function: Callable, args: tuple, batched=False):
+        """
+        """
+        self.batcher = batcher
+        self.function = function
+        self.args = args
+        self.batched = batched
+        self.done = False
+        self.result = None
+
+    def ready(self) -> bool:
+        """
+        Whether all model calls this future depends on are resolved.
+        """
+        return all(arg.done or (not arg.batched and arg.ready()) for arg in lazy_args(self.args))
+
+    @property
+    def value(self) -> Any:
+        """
+        """
+        if not self.done:
+            if self.batched:
+                self.batcher.flush()
+            else:
+                self.result = self.function(*resolve(self.args))
+                self.done = True
+        return self.result
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __float__(self):
+        return float(self.value)
+
+    def __int__(self):
+        return int(self.value)
+
+    def __index__(self):
+        return operator.index(self.value)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return repr(self.value) if self.done else f'Lazy({self.function.__name__})'
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __getitem__(self, key):
+        return self.value[resolve(key)]
+
+    def __contains__(self, item):
+        return resolve(item) in self.value
+
+    def __getattr__(self, name):
+        if name.startswith('__'): # e.g. copy or pickle protocol lookups
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.value, dtype=dtype)
+
+    def __format__(self, spec):
+        return format(self.value, spec)
+
+
+def _operator(function: Callable, reflected=False) -> Callable:
+    """
+    Returns a dunder method building the future of `function` applied to the operands.
+    """
+    def method(self, *others):
+        args = (others[0], self) if reflected else (self, *others)
+        return Lazy(self.batcher, function, args)
+    return method
+
+
+for _name, _function in [
+    ('add', operator.add), ('sub', operator.sub), ('mul', operator.mul), ('truediv', operator.truediv),
+    ('floordiv', operator.floordiv), ('mod', operator.mod), ('pow', operator.pow),
+]:
+    setattr(Lazy, f'__{_name}__', _operator(_function))
+    setattr(Lazy, f'__r{_name}__', _operator(_function, reflected=True))
+for _name, _function in [
+    ('neg', operator.neg), ('pos', operator.pos), ('abs', operator.abs),
+    # comparisons return futures too, and are forced by `if`, `and`, `or` and `not` through __bool__
+    ('eq', operator.eq), ('ne', operator.ne), ('lt', operator.lt), ('le', operator.le), ('gt', operator.gt), ('ge', operator.ge),
+]:
+    setattr(Lazy, f'__{_name}__', _operator(_function))
+
+
+def lazy_args(args: Any) -> list[Lazy]:
+    """
+    Returns the futures directly referenced by (nested lists, tuples or dicts of) arguments.
+    """
+    if isinstance(args, Lazy):
+        return [args]
+    if isinstance(args, (list, tuple)):
+        return [lazy for arg in args for lazy in lazy_args(arg)]
+    if isinstance(args, dict):
+        return lazy_args(list(args.values()))
+    return []
+
+
+def resolve(value: Any) -> Any:
+    """
+    Replaces futures in (nested lists, tuples or dicts of) `value` by their values.
+    """
+    if isinstance(value, Lazy):
+        return resolve(value.value)
+    if isinstance(value, list):
+        return [resolve(x) for x in value]
+    if isinstance(value, tuple):
+        return tuple(resolve(x) for x in value)
+    if isinstance(value, dict):
+        return {k: resolve(v) for k, v in value.items()}
+    return value
+
+
+class LazyBatcher:
+    """
+    Collects deferred calls of batchable agent API functions, and on `flush` runs each function's batched implementation
+    once over all of its ready calls, repeating until calls depending on other calls are resolved too.
+    """
+    def __init__(self):
+        """
+        """
+        self.pending = []
+        self.flushes = 0
+        self.batches = Counter() # function name -> number of batched calls
+
+    def defer(self, function: Callable, args: tuple) -> Lazy:
+        """
+        """
+        lazy = Lazy(self, function, args, batched=True)
+        self.pending.append(lazy)
+        return lazy
+
+    def flush(self):
+        """
+        """
+        if not self.pending:
+            return
+        self.flushes += 1
+        token = LAZY_BATCHER.set(None) # batched implementations run eagerly
+        try:
+            while self.pending:
+                groups, waiting = {}, []
+                for lazy in self.pending:
+                    if lazy.ready():
+                        groups.setdefault(lazy.function, []).append(lazy)
+                    else:
+                        waiting.append(lazy)
+                assert groups, 'Deferred calls have cyclic dependencies'
+                self.pending = waiting
+                for function, calls in groups.items():
+                    results = function.batch([resolve(lazy.args) for lazy in calls])
+                    self.batches[function.__name__] += 1
+                    for lazy, result in zip(calls, results):
+                        lazy.result, lazy.done = result, True
+        finally:
+            LAZY_BATCHER.reset(token)
+
+
+LAZY_BATCHER = ContextVar('lazy_batcher', default=None)
+
+
+@contextmanager
+def lazy_mode(batcher: LazyBatcher = None):
+    """
+    Makes batchable agent API functions return futures collected by `batcher` within the context.
+    """
+    batcher = batcher or LazyBatcher()
+    token = LAZY_BATCHER.set(batcher)
+    try:
+        yield batcher
+    finally:
+        batcher.flush()
+        LAZY_BATCHER.reset(token)
+
+
+def batchable(batch: Callable[[list[tuple]], list] = None):
+    """
+    Decorates an agent API function so that in `lazy_mode` its calls are deferred and run through `batch`, which maps a
+    list of argument tuples to the list of results. Without `batch`, deferred calls run one by one at flush time.
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args):
+            batcher = LAZY_BATCHER.get()
+            if batcher is None:
+                return function(*args)
+            return batcher.defer(wrapper, args)
+
+        wrapper.batch = batch or (lambda calls: [function(*args) for args in calls])
+        return wrapper
+    return decorator
@@ -0,0 +1,123 @@
+import functools
+import hashlib
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from tiny_eqa.agents.common_functions import MODEL_CALLS
+from tiny_eqa.agents.lazy import Lazy
+from tiny_eqa.agents.scene_cache import patch_key
+
+
+@dataclass
+class ProgramMemoStats:
+    """
+    """
+    program_hits: int = 0
+    program_misses: int = 0
+    call_hits: int = 0
+    call_misses: int = 0
+    """ Engine calls (see `get_model`) that memoized programs and API calls would have made. API calls whose model
+        call was deferred count as one, although their batch may be shared with other calls. """
+    calls_avoided: int = 0
+    evictions: int = 0
+
+
+class ProgramMemo:
+    """
+    Memoizes results of programs per (scene, canonical program), and results of model backed API calls on ScenePatches,
+    e.g. `scene_patch.find('door')`, per (scene, patch, arguments), so they are shared by all programs on a scene. Both
+    are bounded with least recently used eviction, and dropped with the scene.
+    """
+    def __init__(self, max_programs=1024, max_calls=16384):
+        """
+        """
+        self.max_programs = max_programs
+        self.max_calls = max_calls
+        self.programs = weakref.WeakKeyDictionary() # Scene -> OrderedDict[program hash, (result, engine calls)]
+        self.calls = weakref.WeakKeyDictionary() # Scene -> OrderedDict[(function, patch, args), (result, engine calls)]
+        self.stats = ProgramMemoStats()
+
+    def run(self, scene: Any, canonical: str, execute: Callable[[], Any]) -> Any:
+        """
+        Returns the memoized result of the program with canonical source `canonical` on `scene`, or the result of
+        `execute`, which runs it.
+        """
+        cache = self.programs.setdefault(scene, OrderedDict())
+        key = hashlib.sha256(canonical.encode()).hexdigest()
+        if key in cache:
+            cache.move_to_end(key)
+            result, calls = cache[key]
+            self.stats.program_hits += 1
+            self.stats.calls_avoided += calls
+            return result
+        self.stats.program_misses += 1
+        calls = MODEL_CALLS.total()
+        with memo_context(self):
+            result = execute()
+        cache[key] = (result, MODEL_CALLS.total() - calls)
+        self.evict(cache, self.max_programs)
+        return result
+
+    def call(self, function: Callable, args: tuple) -> Any:
+        """
+        Returns the memoized result of API `function` called with a ScenePatch and hashable arguments `args`.
+        """
+        scene_patch, *rest = args
+        if not all(isinstance(arg, (str, int, float, bool, type(None))) for arg in rest): # e.g. futures
+            return function(*args)
+        cache = self.calls.setdefault(scene_patch.scene, OrderedDict())
+        key = (function.__name__, patch_key(scene_patch.point1, scene_patch.point2), *rest)
+        if key in cache:
+            cache.move_to_end(key)
+            result, calls = cache[key]
+            self.stats.call_hits += 1
+            self.stats.calls_avoided += calls
+        else:
+            self.stats.call_misses += 1
+            calls = MODEL_CALLS.total()
+            result = function(*args)
+            calls = MODEL_CALLS.total() - calls + (isinstance(result, Lazy) and not result.done)
+            cache[key] = (result, calls)
+            self.evict(cache, self.max_calls)
+        if isinstance(result, Lazy) and result.done:
+            result = result.result
+        return list(result) if isinstance(result, list) else result # programs may modify returned lists
+
+    def evict(self, cache: OrderedDict, size: int):
+        """
+        """
+        while len(cache) > size:
+            cache.popitem(last=False)
+            self.stats.evictions += 1
+
+
+CURRENT_MEMO = ContextVar('memo', default=None)
+
+
+@contextmanager
+def memo_context(memo: ProgramMemo):
+    """
+    Makes memoized API functions use `memo` within the context.
+    """
+    token = CURRENT_MEMO.set(memo)
+    try:
+        yield memo
+    finally:
+        CURRENT_MEMO.reset(token)
+
+
+def memoized(function: Callable) -> Callable:
+    """
+    Decorates a model backed API function of ScenePatch to use the current `ProgramMemo`, if any.
+    """
+    @functools.wraps(function)
+    def wrapper(*args):
+        memo = CURRENT_MEMO.get()
+        if memo is None:
+            return function(*args)
+        return memo.call(function, args)
+    return wrapper
@@ -0,0 +1,415 @@
+import ast
+import builtins
+import functools
+import hashlib
+import math
+import time
+import typing
+from collections import OrderedDict
+from types import CodeType, ModuleType
+
+import numpy as np
+
+from tiny_eqa.agents import common, image_patch, scene_patch
+
+
+class ProgramError(Exception):
+    """
+    Raised for generated code that uses anything outside of the agent API, or that does not define `execute_command`.
+    """
+    pass
+
+
+class ProgramTimeout(ProgramError):
+    """
+    Raised when an executing program exceeds its step or time budget.
+    """
+    pass
+
+
+def restricted_module(name: str, module: ModuleType, names: list[str]) -> ModuleType:
+    """
+    Returns a module exposing only `names` of `module`, so programs cannot reach its submodules or imports, e.g.
+    `typing.sys` or `numpy.ctypeslib`. Its name is not importable, as `from numpy import lib` would otherwise fall back
+    to `sys.modules['numpy.lib']`.
+    """
+    restricted = ModuleType(f'<program {name}>')
+    for attribute in names:
+        setattr(restricted, attribute, getattr(module, attribute))
+    return restricted
+
+
+PROGRAM_NUMPY = restricted_module('numpy', np, [ # pure array functions, without file io, memory mapping or ctypes
+    'abs', 'all', 'any', 'arange', 'argmax', 'argmin', 'argsort', 'array', 'asarray', 'clip', 'concatenate', 'cos',
+    'cross', 'cumsum', 'diff', 'dot', 'e', 'exp', 'inf', 'isclose', 'linspace', 'log', 'max', 'maximum', 'mean', 'median',
+    'min', 'minimum', 'ndarray', 'ones', 'pi', 'prod', 'round', 'sign', 'sin', 'sort', 'sqrt', 'stack', 'std', 'sum',
+    'unique', 'where', 'zeros',
+])
+PROGRAM_NUMPY.linalg = restricted_module('numpy.linalg', np.linalg, ['norm'])
+
+PROGRAM_TYPING = restricted_module('typing', typing, ['Any', 'Dict', 'List', 'Optional', 'Tuple', 'Union'])
+
+PROGRAM_API = {
+    'ScenePatch': scene_patch.ScenePatch,
+    'ImagePatch': image_patch.ImagePatch,
+    'render': scene_patch.render,
+    'bool_to_yesno': common.bool_to_yesno,
+    'content_qa': common.content_qa,
+    'Point2D': common.Point2D,
+    'Point3D': common.Point3D,
+    'Scene': scene_patch.Scene,
+    'np': PROGRAM_NUMPY,
+    'math': math,
+    **vars(PROGRAM_TYPING),
+}
+
+PROGRAM_MODULES = {'math': math, 'numpy': PROGRAM_NUMPY, 'typing': PROGRAM_TYPING} # e.g. `import numpy as np`
+
+PROGRAM_ATTRIBUTES = { # attributes programs may access, anything else, e.g. frames of generators, is rejected
+    *[name for cls in [scene_patch.ScenePatch, image_patch.ImagePatch] for name in dir(cls) if not name.startswith('_')],
+    'center', 'depth', 'height', 'image', 'point1', 'point2', 'scene', 'width', # patch attributes
+    *[name for module in [*PROGRAM_MODULES.values(), PROGRAM_NUMPY.linalg] for name in vars(module) if name[0] != '_'],
+    # arrays, without attributes reaching ctypes, the array's memory or files
+    'T', 'all', 'any', 'argmax', 'argmin', 'argsort', 'astype', 'clip', 'copy', 'cumsum', 'dot', 'flatten', 'item', 'max',
+    'mean', 'min', 'ndim', 'prod', 'reshape', 'round', 'shape', 'size', 'sort', 'std', 'sum', 'tolist',
+    # lists, dicts, sets and strings, without str.format, which accesses attributes named in the string
+    'add', 'append', 'capitalize', 'count', 'difference', 'discard', 'endswith', 'extend', 'get', 'index', 'insert',
+    'intersection', 'isdigit', 'items', 'join', 'keys', 'lower', 'lstrip', 'pop', 'remove', 'replace', 'reverse',
+    'rstrip', 'setdefault', 'split', 'startswith', 'strip', 'title', 'union', 'update', 'upper', 'values',
+}
+
+PROGRAM_BUILTINS = [
+    'abs', 'all', 'any', 'bool', 'dict', 'enumerate', 'filter', 'float', 'int', 'isinstance', 'len', 'list', 'map', 'max',
+    'min', 'print', 'range', 'reversed', 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'zip',
+    'Exception', 'IndexError', 'KeyError', 'TypeError', 'ValueError', 'ZeroDivisionError',
+]
+
+PROGRAM_CACHE = OrderedDict() # hash of source or normalized source -> code object
+
+PROGRAM_CACHE_SIZE = 4096
+
+
+def program_import(name: str, globals=None, locals=None, fromlist=(), level=0):
+    """
+    Replacement of `__import__` for executing programs, restricted to `PROGRAM_MODULES`.
+    """
+    if name not in PROGRAM_MODULES or level != 0:
+        raise ProgramError(f'Programs may not import {name}')
+    for attribute in fromlist or ():
+        if not hasattr(PROGRAM_MODULES[name], attribute):
+            raise ProgramError(f'Programs may not import {attribute} from {name}')
+    return PROGRAM_MODULES[name]
+
+
+def validate_program(tree: ast.Module):
+    """
+    Checks that the program only defines `execute_command` and references names of the agent API, safe builtins, or
+    names it assigns itself, and only attributes of `PROGRAM_ATTRIBUTES`. Dunder names and strings containing '__', e.g.
+    subscripts of dunder keys, are rejected, which also protects the instrumentation names.
+    """
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.Import, ast.ImportFrom)) and not (
+            isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) # docstrings
+        ):
+            raise ProgramError(f'Unexpected top level statement on line {node.lineno}, programs only define execute_command')
+    if not any(isinstance(node, ast.FunctionDef) and node.name == 'execute_command' for node in tree.body):
+        raise ProgramError('Program does not define execute_command')
+
+    assigned = assigned_names(tree)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Global, ast.Nonlocal, ast.AsyncFunctionDef, ast.Await, ast.AsyncFor, ast.AsyncWith)):
+            raise ProgramError(f'{type(node).__name__} is not allowed, line {node.lineno}')
+        if isinstance(node, ast.Attribute) and node.attr not in PROGRAM_ATTRIBUTES:
+            raise ProgramError(f'Access to attribute {node.attr} is not allowed, line {node.lineno}')
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and '__' in node.value:
+            raise ProgramError(f'Strings containing __ are not allowed, line {node.lineno}')
+        if isinstance(node, ast.Name) and (node.id.startswith('__') or (
+            node.id not in assigned and node.id not in PROGRAM_API and node.id not in PROGRAM_BUILTINS
+        )):
+            raise ProgramError(f'Name {node.id} is not part of the API, line {node.lineno}')
+        if isinstance(node, ast.Import) and any(alias.name not in PROGRAM_MODULES for alias in node.names):
+            raise ProgramError(f'Programs may only import {", ".join(PROGRAM_MODULES)}, line {node.lineno}')
+        if isinstance(node, ast.ImportFrom) and node.module not in PROGRAM_MODULES:
+            raise ProgramError(f'Programs may only import {", ".join(PROGRAM_MODULES)}, line {node.lineno}')
+
+
+class ProgramInstrumenter(ast.NodeTransformer):
+    """
+    Counts steps of executing programs: every loop iteration, comprehension item and function call calls `__step__`.
+    """
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> ast.FunctionDef:
+        self.generic_visit(node)
+        node.body.insert(0, step_statement())
+        return node
+
+    def visit_While(self, node: ast.While) -> ast.While:
+        self.generic_visit(node)
+        node.body.insert(0, step_statement())
+        return node
+
+    def visit_For(self, node: ast.For) -> ast.For:
+        self.generic_visit(node)
+        node.iter = step_iterator(node.iter)
+        return node
+
+    def visit_comprehension(self, node: ast.comprehension) -> ast.comprehension:
+        self.generic_visit(node)
+        node.iter = step_iterator(node.iter)
+        return node
+
+
+def step_statement() -> ast.Expr:
+    """
+    """
+    return ast.Expr(ast.Call(ast.Name('__step__', ast.Load()), [], []))
+
+
+def step_iterator(iterable: ast.expr) -> ast.Call:
+    """
+    """
+    return ast.Call(ast.Name('__steps__', ast.Load()), [iterable], [])
+
+
+def normalize_program(code: str) -> tuple[ast.Module, str]:
+    """
+    Returns the parsed program and its normalized source, independent of formatting and comments.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        raise ProgramError(f'Program does not parse: {e}') from e
+    return tree, ast.unparse(tree)
+
+
+def compile_program(code: str) -> CodeType:
+    """
+    Returns the validated and instrumented code object of a program, cached by hash of the normalized source.
+    """
+    key = hashlib.sha256(code.encode()).hexdigest()
+    if key in PROGRAM_CACHE: # same text is the common case of reruns, skipping the parse
+        PROGRAM_CACHE.move_to_end(key)
+        return PROGRAM_CACHE[key]
+    tree, source = normalize_program(code)
+    normalized_key = hashlib.sha256(source.encode()).hexdigest()
+    if normalized_key not in PROGRAM_CACHE:
+        validate_program(tree)
+        tree = ast.fix_missing_locations(ProgramInstrumenter().visit(tree))
+        PROGRAM_CACHE[normalized_key] = compile(tree, '<program>', 'exec')
+    PROGRAM_CACHE[key] = PROGRAM_CACHE[normalized_key]
+    PROGRAM_CACHE.move_to_end(normalized_key)
+    while len(PROGRAM_CACHE) > PROGRAM_CACHE_SIZE:
+        PROGRAM_CACHE.popitem(last=False)
+    return PROGRAM_CACHE[key]
+
+
+class ProgramCanonicalizer(ast.NodeTransformer):
+    """
+    Rewrites a program to a canonical form: names the program assigns are renamed in order of first occurrence,
+    constant expressions are folded, and docstrings and annotations are dropped.
+    """
+    MAX_FOLDED_LENGTH = 1024 # folded strings longer than this are kept as expressions, e.g. 'a' * 10**9
+
+    def __init__(self, assigned: set[str]):
+        """
+        """
+        self.names = {}
+        self.assigned = assigned - {'execute_command'}
+        self.functions = set()
+
+    def rename(self, name: str) -> str:
+        """
+        """
+        if name not in self.assigned:
+            return name
+        return self.names.setdefault(name, f'v{len(self.names)}')
+
+    def visit_Name(self, node: ast.Name) -> ast.Name:
+        node.id = self.rename(node.id)
+        return node
+
+    def visit_arg(self, node: ast.arg) -> ast.arg:
+        node.arg, node.annotation = self.rename(node.arg), None
+        return node
+
+    def visit_alias(self, node: ast.alias) -> ast.alias:
+        node.asname = self.rename(node.asname or node.name)
+        return node
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler) -> ast.ExceptHandler:
+        node.name = node.name and self.rename(node.name)
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> ast.FunctionDef:
+        self.functions.add(node.name)
+        node.name, node.returns = self.rename(node.name), None
+        if node.body and isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Constant):
+            node.body = node.body[1:] or [ast.Pass()]
+        return self.generic_visit(node)
+
+    def visit_AnnAssign(self, node: ast.AnnAssign) -> ast.AST:
+        if node.value is None:
+            return None
+        return self.visit(ast.Assign([node.target], node.value))
+
+    def visit_Call(self, node: ast.Call) -> ast.Call:
+        if isinstance(node.func, ast.Name) and node.func.id in self.functions: # keyword arguments of renamed helpers
+            for keyword in node.keywords:
+                keyword.arg = keyword.arg and self.rename(keyword.arg)
+        return self.generic_visit(node)
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.expr:
+        return self.fold(self.generic_visit(node), lambda: eval_operator(node.op, node.left.value, node.right.value), node.left, node.right)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.expr:
+        return self.fold(self.generic_visit(node), lambda: eval_operator(node.op, node.operand.value), node.operand)
+
+    def fold(self, node: ast.expr, evaluate: typing.Callable, *operands: ast.expr) -> ast.expr:
+        """
+        Replaces `node` by the constant it evaluates to if all `operands` are constants.
+        """
+        if not all(isinstance(operand, ast.Constant) for operand in operands):
+            return node
+        if any(isinstance(operand.value, (str, bytes)) and len(operand.value) > self.MAX_FOLDED_LENGTH for operand in operands):
+            return node
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Mult, ast.Pow)) and any(
+            isinstance(operand.value, (int, float)) and abs(operand.value) > self.MAX_FOLDED_LENGTH for operand in operands
+        ):
+            return node
+        try:
+            value = evaluate()
+        except Exception:
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+
+OPERATORS = {
+    ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b, ast.Div: lambda a, b: a / b,
+    ast.FloorDiv: lambda a, b: a // b, ast.Mod: lambda a, b: a % b, ast.Pow: lambda a, b: a ** b,
+    ast.USub: lambda a: -a, ast.UAdd: lambda a: +a, ast.Not: lambda a: not a,
+}
+
+
+def eval_operator(op: ast.operator | ast.unaryop, *values):
+    """
+    """
+    return OPERATORS[type(op)](*values)
+
+
+def assigned_names(tree: ast.AST) -> set[str]:
+    """
+    Returns the names a program binds: variables, arguments, functions, import aliases and exception names.
+    """
+    assigned = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            assigned.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            assigned.add(node.name)
+        elif isinstance(node, ast.arg):
+            assigned.add(node.arg)
+        elif isinstance(node, ast.alias):
+            assigned.add(node.asname or node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            assigned.add(node.name)
+    return assigned
+
+
+@functools.lru_cache(maxsize=PROGRAM_CACHE_SIZE)
+def canonicalize_program(code: str) -> str:
+    """
+    Returns the canonical source of a program, equal for programs that differ only in formatting, comments, docstrings,
+    annotations, variable names or constant expressions.
+    """
+    tree, _ = normalize_program(code)
+    tree = ast.fix_missing_locations(ProgramCanonicalizer(assigned_names(tree)).visit(tree))
+    return ast.unparse(tree)
+
+
+class ProgramBudget:
+    """
+    Step and time budget of one program execution. Loop iterations, comprehension items and function calls take a step,
+    and so do the items of a `range` iterated by a builtin, so e.g. `sum(range(n))` is bounded too. The time budget is
+    checked at steps, so a program may overrun `timeout` by the duration of one call that does not take steps, e.g. a
+    model call or a numpy operation.
+    """
+    def __init__(self, max_steps=100_000, timeout=60.0):
+        """
+        """
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.steps = 0
+        self.deadline = time.perf_counter() + timeout
+
+    def step(self):
+        """
+        """
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise ProgramTimeout(f'Program exceeded {self.max_steps} steps')
+        if time.perf_counter() > self.deadline:
+            raise ProgramTimeout(f'Program exceeded {self.timeout}s')
+
+    def steps_of(self, iterable: typing.Iterable) -> typing.Iterator:
+        """
+        """
+        if isinstance(iterable, ProgramRange): # steps per item itself
+            return iter(iterable)
+        return self.steps_of_items(iterable)
+
+    def steps_of_items(self, iterable: typing.Iterable) -> typing.Iterator:
+        """
+        """
+        for x in iterable:
+            self.step()
+            yield x
+
+
+class ProgramRange:
+    """
+    Replacement of the `range` builtin for executing programs, taking a step per item also when iterated by a builtin,
+    e.g. `sum(range(n))`, whose iterations do not take steps otherwise.
+    """
+    def __init__(self, budget: ProgramBudget, *args):
+        """
+        """
+        self._budget = budget
+        self._range = args[0] if len(args) == 1 and isinstance(args[0], range) else range(*args)
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return self._budget.steps_of_items(self._range)
+
+    def __reversed__(self) -> typing.Iterator[int]:
+        return self._budget.steps_of_items(reversed(self._range))
+
+    def __len__(self) -> int:
+        return len(self._range)
+
+    def __getitem__(self, index: int | slice) -> 'int | ProgramRange':
+        item = self._range[index]
+        return ProgramRange(self._budget, item) if isinstance(item, range) else item
+
+    def __contains__(self, x) -> bool:
+        return x in self._range
+
+    def __eq__(self, other) -> bool:
+        return self._range == (other._range if isinstance(other, ProgramRange) else other)
+
+    def __hash__(self) -> int:
+        return hash(self._range)
+
+    def __repr__(self) -> str:
+        return repr(self._range)
+
+
+def program_namespace(budget: ProgramBudget) -> dict:
+    """
+    Returns the restricted globals programs are executed with.
+    """
+    namespace = dict(PROGRAM_API)
+    namespace['__builtins__'] = {name: getattr(builtins, name) for name in PROGRAM_BUILTINS} | {
+        '__import__': program_import, 'range': functools.partial(ProgramRange, budget),
+    }
+    namespace['__step__'] = budget.step
+    namespace['__steps__'] = budget.steps_of
+    return namespace
+
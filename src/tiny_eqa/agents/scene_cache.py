@@ -1,18 +1,258 @@
-from dataclasses import dataclass, field
+from __future__ import annotations
 
+import json
+import os
+import warnings
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Literal
 
-class ImagePatch: # typing w/o circular imports
-    pass
+import numpy as np
+import torch
 
-
-class ScenePatch: # typing w/o circular imports
-    pass
+from tiny_eqa.agents.embedding_index import IVFConfig, IVFIndex
+from tiny_eqa.data.common import NumpyTensor
 
 
 class EmbeddingDatabase:
     """
+    Normalized embeddings, e.g. of questions or conditions, and their cached values, e.g. answers, for similarity based
+    reuse. Embeddings are rows of a contiguous preallocated matrix that grows geometrically, and removed rows are
+    tombstoned until `compact` is called.
+
+    Search is exact by default. The 'ivf' backend searches an approximate `IVFIndex` instead once enough entries exist
+    to train it. A `readonly` database, e.g. memory-mapped by several processes, can only be searched.
     """
-    pass
+    SEARCH_CHUNK = 2**18 # rows scored per matrix multiply, bounding memory of the score matrix
+
+    def __init__(
+        self,
+        dim: int = None,
+        dtype: Literal['float16', 'float32'] = 'float32',
+        capacity=1024,
+        backend: Literal['exact', 'ivf'] = 'exact',
+        ivf: IVFConfig = None,
+        readonly=False,
+    ):
+        """
+        """
+        self.readonly = readonly
+        self.backend = backend
+        self.index = IVFIndex(ivf) if backend == 'ivf' else None
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.size = 0 # number of rows in use, including tombstones
+        self.embeddings = None if dim is None else np.empty((capacity, dim), dtype=self.dtype)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.values = []
+
+    def __len__(self) -> int:
+        """
+        """
+        return int(self.alive[:self.size].sum())
+
+    @property
+    def nbytes(self) -> int:
+        """
+        """
+        return 0 if self.embeddings is None else self.embeddings.nbytes
+
+    def reserve(self, capacity: int):
+        """
+        Grows storage to at least `capacity` rows, at least doubling it to amortize copies.
+        """
+        if self.embeddings is None:
+            capacity = max(capacity, self.capacity)
+        elif capacity <= self.capacity:
+            return
+        else:
+            capacity = max(capacity, 2 * self.capacity)
+        embeddings = np.empty((capacity, self.dim), dtype=self.dtype)
+        alive = np.zeros(capacity, dtype=bool)
+        if self.embeddings is not None:
+            embeddings[:self.size] = self.embeddings[:self.size]
+            alive[:self.size] = self.alive[:self.size]
+        self.embeddings, self.alive, self.capacity = embeddings, alive, capacity
+
+    def add(self, embeddings: NumpyTensor['n', 'dim'], values: list) -> NumpyTensor['n']:
+        """
+        Adds embeddings (normalized on insert) with their values, returning their ids. Zero embeddings have no direction
+        and are rejected.
+        """
+        assert not self.readonly, 'Cannot modify a readonly EmbeddingDatabase'
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        assert len(embeddings) == len(values), 'Number of embeddings and values must match'
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        assert np.all(norms > 0), 'Cannot add zero embeddings'
+        self.dim = self.dim or embeddings.shape[1]
+        self.reserve(self.size + len(embeddings))
+
+        ids = np.arange(self.size, self.size + len(embeddings))
+        self.embeddings[ids] = embeddings / norms
+        self.alive[ids] = True
+        self.values.extend(values)
+        self.size += len(embeddings)
+        if self.index is not None:
+            if self.index.trained:
+                self.index.add(ids, self.embeddings[ids])
+            elif self.size >= self.index.config.min_train:
+                self.index.train(self.embeddings[:self.size])
+        return ids
+
+    def search(
+        self, queries: NumpyTensor['m', 'dim'], k=1, exact=False, nprobe: int = None
+    ) -> tuple[NumpyTensor['m', 'k'], NumpyTensor['m', 'k']]:
+        """
+        Returns cosine similarities and ids of the top `k` entries for each query, with ids -1 where fewer than `k`
+        entries exist. With the 'ivf' backend, `nprobe` overrides the number of lists scanned and `exact` forces exact
+        search.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12) # zero queries score 0
+        if self.index is not None and self.index.trained and not exact:
+            return self.index.search(queries, k, self.embeddings, self.alive, nprobe=nprobe)
+
+        queries = torch.from_numpy(queries)
+        scores = torch.full((len(queries), k), -torch.inf)
+        ids = torch.full((len(queries), k), -1, dtype=torch.long)
+        if self.embeddings is None:
+            return scores.numpy(), ids.numpy()
+
+        queries = queries.to(getattr(torch, self.dtype.name))
+        with warnings.catch_warnings(): # readonly memmaps are only read, never written through the tensors
+            warnings.filterwarnings('ignore', 'The given NumPy array is not writable')
+            for start in range(0, self.size, self.SEARCH_CHUNK):
+                end = min(start + self.SEARCH_CHUNK, self.size)
+                chunk_scores = (queries @ torch.from_numpy(self.embeddings[start:end]).T).float()
+                chunk_scores[:, ~torch.from_numpy(self.alive[start:end])] = -torch.inf
+                chunk_scores, chunk_ids = chunk_scores.topk(min(k, end - start), dim=1)
+                scores, order = torch.cat([scores, chunk_scores], dim=1).topk(k, dim=1)
+                ids = torch.cat([ids, chunk_ids + start], dim=1).gather(1, order)
+        ids[torch.isinf(scores)] = -1
+        return scores.numpy(), ids.numpy()
+
+    def lookup(self, query: NumpyTensor['dim'], threshold: float):
+        """
+        Returns the value of the most similar entry if its similarity is at least `threshold`, otherwise None.
+        """
+        scores, ids = self.search(query, k=1)
+        return self.values[ids[0, 0]] if ids[0, 0] >= 0 and scores[0, 0] >= threshold else None
+
+    def remove(self, ids: NumpyTensor['n']):
+        """
+        Tombstones entries. Their rows are reclaimed by `compact`.
+        """
+        assert not self.readonly, 'Cannot modify a readonly EmbeddingDatabase'
+        self.alive[ids] = False
+        for i in np.atleast_1d(ids):
+            self.values[i] = None
+
+    def compact(self) -> NumpyTensor['size']:
+        """
+        Removes tombstoned rows and shrinks storage to fit, returning the new id of each old id (-1 for removed ones).
+        """
+        assert not self.readonly, 'Cannot modify a readonly EmbeddingDatabase'
+        if self.embeddings is None:
+            return np.full(self.size, -1)
+        alive = self.alive[:self.size]
+        mapping = np.full(self.size, -1)
+        mapping[alive] = np.arange(alive.sum())
+
+        size = int(alive.sum())
+        embeddings = np.empty((max(size, 1), self.dim), dtype=self.dtype)
+        embeddings[:size] = self.embeddings[:self.size][alive]
+        self.values = [value for value, keep in zip(self.values, alive) if keep]
+        self.embeddings, self.capacity, self.size = embeddings, len(embeddings), size
+        self.alive = np.zeros(self.capacity, dtype=bool)
+        self.alive[:size] = True
+        if self.index is not None:
+            self.index.remap(mapping)
+        return mapping
+
+    def save(self, path: Path | str):
+        """
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'embeddings.npy', np.empty((0, self.dim or 0), self.dtype) if self.embeddings is None else self.embeddings[:self.size])
+        np.save(path / 'alive.npy', self.alive[:self.size])
+        with open(path / 'values.json', 'w') as f:
+            json.dump(self.values, f)
+        with open(path / 'config.json', 'w') as f:
+            json.dump({'backend': self.backend, 'ivf': None if self.index is None else asdict(self.index.config)}, f)
+        if self.index is not None:
+            self.index.save(path / 'index.npz')
+
+    @classmethod
+    def load(cls, path: Path | str, mmap=True, ivf: IVFConfig = None, readonly=False) -> EmbeddingDatabase:
+        """
+        Loads a database saved by `save`, with its backend and IVF config unless `ivf` is given. With `mmap`, embeddings
+        are memory-mapped, so pages are shared with other processes and the file is never modified: read-only if
+        `readonly`, otherwise copy-on-write.
+        """
+        path = Path(path)
+        embeddings = np.load(path / 'embeddings.npy', mmap_mode=('r' if readonly else 'c') if mmap else None)
+        if (path / 'config.json').exists():
+            with open(path / 'config.json') as f:
+                config = json.load(f)
+            backend = 'ivf' if ivf is not None else config['backend']
+            ivf = ivf or (IVFConfig(**config['ivf']) if config['ivf'] is not None else None)
+        else: # saved without a config, ivf if trained
+            backend = 'ivf' if ivf is not None or (path / 'index.npz').exists() else 'exact'
+        database = cls(
+            dim=embeddings.shape[1] or None, dtype=embeddings.dtype.name, capacity=len(embeddings), backend=backend, readonly=readonly,
+        )
+        if backend == 'ivf':
+            database.index = IVFIndex.load(path / 'index.npz', ivf)
+        database.embeddings = embeddings if database.dim else None
+        database.alive = np.load(path / 'alive.npy')
+        database.size = len(embeddings)
+        with open(path / 'values.json') as f:
+            database.values = json.load(f)
+        return database
+
+
+PatchKey = tuple[float, float, float, float, float, float] # (point1, point2) of a ScenePatch
+
+
+def patch_key(point1: NumpyTensor[3], point2: NumpyTensor[3]) -> PatchKey:
+    """
+    Returns a hashable key identifying the ScenePatch with corners `point1` and `point2`.
+    """
+    return tuple(round(float(x), 4) for x in (*point1, *point2))
+
+
+@dataclass
+class ViewRef:
+    """
+    Reference to a crop of a frame in the scene's frame store, standing in for an ImagePatch without holding pixels.
+    """
+
+    """ Index of the frame in the original sequence. """
+    frame: int
+    """ Top left corner of the crop in the frame. """
+    point1: tuple[int, int]
+    """ Bottom right corner of the crop in the frame. """
+    point2: tuple[int, int]
+
+    def crop(self, image: NumpyTensor['H', 'W', 3]) -> NumpyTensor['h', 'w', 3]:
+        """
+        Returns the crop as a view into `image`, the frame's image.
+        """
+        (x1, y1), (x2, y2) = self.point1, self.point2
+        return image[y1:y2, x1:x2]
+
+
+PATCH_DATABASE_CAPACITY = 64 # patches receive few conditions and questions, so their databases start small
+
+
+def patch_database() -> EmbeddingDatabase:
+    """
+    Returns an empty database for the conditions or questions of one patch.
+    """
+    return EmbeddingDatabase(capacity=PATCH_DATABASE_CAPACITY)
 
 
 @dataclass
@@ -20,19 +260,135 @@ class ScenePatchData:
     """
     """
 
-    """ """
+    """ Object name the patch was found as. """
     name: str = None
-    """ """
-    views: list[ImagePatch] = None
-    """ """
-    conditions: EmbeddingDatabase = field(default_factory=EmbeddingDatabase)
-    """ """
-    questions : EmbeddingDatabase = field(default_factory=EmbeddingDatabase)
+    """ Frame crops observing the patch. """
+    views: list[ViewRef] = field(default_factory=list)
+    """ Embeddings of checked conditions and their results. """
+    conditions: EmbeddingDatabase = field(default_factory=patch_database)
+    """ Embeddings of asked questions and their answers. """
+    questions : EmbeddingDatabase = field(default_factory=patch_database)
+
+    VIEW_BYTES = 64 # approximate size of a ViewRef
+
+    @property
+    def nbytes(self) -> int:
+        """
+        """
+        return self.conditions.nbytes + self.questions.nbytes + self.VIEW_BYTES * len(self.views)
+
+
+@dataclass
+class SceneCacheStats:
+    """
+    """
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
 
 
-@ dataclass
 class SceneCache:
     """
+    Per scene cache of patch data, bounded by `max_bytes` with least recently used eviction.
+
+    A cache saved with `save` can be loaded by any number of worker processes with `load(readonly=True)`. Embeddings are
+    then memory-mapped read-only, so the processes share the same pages instead of each holding a copy, and neither the
+    cache nor its databases can be modified.
+
+    The agent API does not populate or read a SceneCache, it is a library for callers keeping patch data across runs.
     """
-    name2patch: dict[str, ScenePatch]
-    patch2data: dict[ScenePatch, ScenePatchData]
\ No newline at end of file
+    def __init__(self, max_bytes: int = 2**30, readonly=False):
+        """
+        """
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.name2patch: dict[str, PatchKey] = {}
+        self.patch2data: OrderedDict[PatchKey, ScenePatchData] = OrderedDict()
+        self.nbytes = 0
+        self.stats = SceneCacheStats()
+
+    def __contains__(self, key: PatchKey) -> bool:
+        """
+        """
+        return key in self.patch2data
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.patch2data)
+
+    def get(self, key: PatchKey) -> ScenePatchData | None:
+        """
+        """
+        if key not in self.patch2data:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self.patch2data.move_to_end(key)
+        return self.patch2data[key]
+
+    def put(self, key: PatchKey, data: ScenePatchData):
+        """
+        Inserts or replaces the data of a patch, evicting least recently used patches if over `max_bytes`.
+        """
+        assert not self.readonly, 'Cannot modify a readonly SceneCache'
+        if key in self.patch2data:
+            self.nbytes -= self.patch2data[key].nbytes
+        self.patch2data[key] = data
+        self.patch2data.move_to_end(key)
+        if data.name is not None:
+            self.name2patch[data.name] = key
+        self.nbytes += data.nbytes
+        self.evict()
+
+    def update(self, key: PatchKey):
+        """
+        Recomputes the size of a patch after its data was modified in place, e.g. after adding answers.
+        """
+        self.put(key, self.patch2data[key])
+
+    def evict(self):
+        """
+        """
+        while self.nbytes > self.max_bytes and len(self.patch2data) > 1:
+            key, data = self.patch2data.popitem(last=False)
+            self.nbytes -= data.nbytes
+            if self.name2patch.get(data.name) == key:
+                del self.name2patch[data.name]
+            self.stats.evictions += 1
+
+    def save(self, path: Path | str):
+        """
+        Saves the cache of one scene to directory `path`.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        patches = []
+        for i, (key, data) in enumerate(self.patch2data.items()):
+            data.conditions.save(path / f'{i:06d}' / 'conditions')
+            data.questions .save(path / f'{i:06d}' / 'questions')
+            patches.append({'key': key, 'name': data.name, 'views': [asdict(view) for view in data.views]})
+        with open(path / 'meta.json.tmp', 'w') as f:
+            json.dump({'patches': patches, 'name2patch': list(self.name2patch.items())}, f)
+        os.replace(path / 'meta.json.tmp', path / 'meta.json')
+
+    @classmethod
+    def load(cls, path: Path | str, max_bytes: int = 2**30, readonly=True) -> SceneCache:
+        """
+        Loads a cache saved by `save`. Embeddings are memory-mapped, read-only if `readonly`, and otherwise copied on write.
+        """
+        path = Path(path)
+        cache = cls(max_bytes=max_bytes)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        for i, patch in enumerate(meta['patches']):
+            cache.put(tuple(patch['key']), ScenePatchData(
+                name=patch['name'],
+                views=[ViewRef(view['frame'], tuple(view['point1']), tuple(view['point2'])) for view in patch['views']],
+                conditions=EmbeddingDatabase.load(path / f'{i:06d}' / 'conditions', readonly=readonly),
+                questions =EmbeddingDatabase.load(path / f'{i:06d}' / 'questions',  readonly=readonly),
+            ))
+        cache.name2patch = {name: tuple(key) for name, key in meta['name2patch'] if tuple(key) in cache.patch2data}
+        cache.stats = SceneCacheStats()
+        cache.readonly = readonly
+        return cache
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import numpy as np
 
-from src.tiny_eqa.data import Scene
+from tiny_eqa.data import Scene
 from tiny_eqa.agents.common import *
 from tiny_eqa.agents.image_patch import ImagePatch
 from tiny_eqa.agents.scene_patch_functions import *
@@ -24,10 +24,11 @@ class ScenePatch:
                 The bottom right corner of the crop.
         """
         self.scene = scene
-        self.height, self.width, self.depth = self.scene.shape
-        self.point1 = point1 or np.zeros(3)
-        self.point2 = point2 or (self.width, self.height, self.depth)
-        self.center = (point1 + point2) / 2
+        bounds = scene_bounds(scene) if point1 is None or point2 is None else None
+        self.point1 = bounds[0] if point1 is None else np.asarray(point1)
+        self.point2 = bounds[1] if point2 is None else np.asarray(point2)
+        self.width, self.height, self.depth = np.abs(self.point2 - self.point1)
+        self.center = (self.point1 + self.point2) / 2
 
     def crop(self, point1: Point3D, point2: Point3D) -> ScenePatch:
         """ Returns a new ScenePatch cropped from the current ScenePatch.
@@ -38,7 +39,7 @@ class ScenePatch:
             point2: Point3D
                 The bottom right corner of the new crop.
         """
-        return ScenePatch(self.scene, self.point1, self.point2)
+        return ScenePatch(self.scene, point1, point2)
     
     def distance(self, patch: ScenePatch) -> float:
         """ Returns the distance between the centers of two ScenePatches.
@@ -1,42 +1,255 @@
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 import numpy as np
+import torch
 from omegaconf import OmegaConf
 
 from tiny_eqa.agents.common import *
-from src.tiny_eqa.data.sequence import *
-from tiny_eqa.agents.image_patch_functions import ImagePatch
+from tiny_eqa.data.sequence import *
+from tiny_eqa.agents.image_patch import ImagePatch
+from tiny_eqa.agents.image_patch_functions import (
+    CHECK_CONDITION_QUESTION, SIMPLE_QA_QUESTION, answer_is_yes, image_set_sensor_depth,
+)
+from tiny_eqa.agents.lazy import batchable
+from tiny_eqa.agents.memo import memoized
+from tiny_eqa.agents.scene_cache import patch_key
+from tiny_eqa.models.model_depth_anything import image_to_depth
+from tiny_eqa.utils.geometry import BoxVisibility, InstanceVoxels, box_visibility, lift_masks
+from tiny_eqa.utils.spatial_index import InstanceIndex, ViewIndex
 
 
 class ScenePatch: # typing w/o circular imports
     pass
 
 
+SCENE_INDICES = weakref.WeakKeyDictionary() # SceneInstances -> InstanceIndex
+
+SCENE_VOXELS = weakref.WeakKeyDictionary() # SceneInstances -> InstanceVoxels
+
+SCENE_FIND_LABELS = False # find instances by their ground truth labels, an oracle, instead of detecting them
+
+SCENE_FIND_FRAMES = 16 # frames seeing most of a patch in which `find` detects objects
+
+SCENE_FIND_MIN_SHARE = 0.5 # share of the lifted voxels of a detection an instance needs to be found
+
+SCENE_VISIBILITY = weakref.WeakKeyDictionary() # Scene -> OrderedDict[(box, min_fraction), BoxVisibility]
+
+SCENE_VISIBILITY_SIZE = 1024 # cached boxes per scene
+
+SCENE_VIEW_INDICES = weakref.WeakKeyDictionary() # Scene -> ViewIndex
+
+SCENE_QA_VIEWS = 8 # views of a patch given to simple_qa
+
+CURRENT_SCENE = ContextVar('scene', default=None) # scene of the executing program, for scene-less API calls e.g. render
+
+
+@contextmanager
+def scene_context(scene: Scene):
+    """
+    Sets the scene used by API functions that do not take a scene argument, e.g. `render`, while a program executes.
+    """
+    token = CURRENT_SCENE.set(scene)
+    try:
+        yield scene
+    finally:
+        CURRENT_SCENE.reset(token)
+
+
+def scene_instance_index(scene: Scene) -> InstanceIndex:
+    """
+    Returns the spatial index over the 3D instances of a scene, built once per scene and cached.
+    """
+    instances = scene.instances
+    assert instances is not None, \
+        'Scene has no 3D instances, e.g. read a ScanNet scan with its annotations by read_scannet_sequence'
+    if instances not in SCENE_INDICES:
+        SCENE_INDICES[instances] = InstanceIndex(instances.bboxes)
+    return SCENE_INDICES[instances]
+
+
+def scene_instance_voxels(scene: Scene) -> InstanceVoxels:
+    """
+    Returns the voxelized 3D instances of a scene that detections are lifted to, built once per scene and cached.
+    """
+    instances = scene.instances
+    if instances not in SCENE_VOXELS:
+        SCENE_VOXELS[instances] = InstanceVoxels.from_boxes(torch.from_numpy(np.asarray(instances.bboxes, dtype=np.float64)))
+    return SCENE_VOXELS[instances]
+
+
+def scene_bounds(scene: Scene) -> NumpyTensor[2, 3]:
+    """
+    Returns the bounding box of the scene's instances, or of its camera centers if no instances are known.
+    """
+    if scene.instances is not None:
+        return scene_instance_index(scene).bounds
+    centers = scene.poses[:, :3, 3]
+    return np.stack([centers.min(axis=0), centers.max(axis=0)])
+
+
+def scene_visibility(scene: ScenePatch, min_fraction=0.05) -> BoxVisibility:
+    """
+    Returns the frames of the scene whose frustum sees the patch box, with visible fractions and projected 2D boxes, so
+    per frame models only run on those frames. Results are cached per (scene, box) with LRU eviction.
+    """
+    cache = SCENE_VISIBILITY.setdefault(scene.scene, OrderedDict())
+    key = (*np.round(scene.point1, 4), *np.round(scene.point2, 4), min_fraction)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    visibility = box_visibility(
+        torch.from_numpy(np.asarray(scene.point1, dtype=np.float64)),
+        torch.from_numpy(np.asarray(scene.point2, dtype=np.float64)),
+        torch.from_numpy(scene.scene.poses),
+        torch.from_numpy(scene.scene.intrinsics),
+        scene.scene.image_size,
+        min_fraction=min_fraction,
+    )
+    cache[key] = visibility
+    if len(cache) > SCENE_VISIBILITY_SIZE:
+        cache.popitem(last=False)
+    return visibility
+
+
+def object_name_forms(object_name: str) -> set[str]:
+    """
+    Returns the lower case forms of an object name with its last word as written and singularized, so that names match
+    labels regardless of case and number, e.g. 'Kitchen Cabinets' matches 'kitchen cabinet'.
+    """
+    *words, last = object_name.lower().replace('_', ' ').split() or ['']
+    forms = {last}
+    if len(last) > 3 and last.endswith('s') and not last.endswith('ss'):
+        forms.add(last[:-1])
+    if len(last) > 4 and last.endswith(('ches', 'shes', 'sses', 'xes', 'zes')):
+        forms.add(last[:-2])
+    if len(last) > 4 and last.endswith('ies'):
+        forms.add(last[:-3] + 'y')
+    if len(last) > 4 and last.endswith('ves'):
+        forms |= {last[:-3] + 'f', last[:-3] + 'fe'}
+    return {' '.join([*words, form]) for form in forms}
+
+
+def scene_detect(scene: ScenePatch, object_name: str) -> NumpyTensor['m']:
+    """
+    Detects the object with Grounding DINO in the frames seeing most of the patch, back-projects the pixels of each
+    detection with the sensor depth and votes them into the 3D instances of the scene. Returns the sorted ids of the
+    instances won by at least one detection. Frames whose frustum misses the patch are never detected in, and only
+    detections overlapping the projected patch box are lifted.
+    """
+    visibility = scene_visibility(scene)
+    order = torch.sort(torch.argsort(visibility.fractions, descending=True, stable=True)[:SCENE_FIND_FRAMES]).values
+    frames = [scene.scene[int(visibility.frames[i])] for i in order]
+    if not frames:
+        return np.empty(0, dtype=np.int64)
+    detections = get_model('ModelGroundingDino')([frame.image for frame in frames], [object_name])
+
+    # box masks at depth resolution, numbered across frames, painted in ascending score so the best box wins overlaps
+    depth = torch.from_numpy(np.stack([frame.depth for frame in frames]).astype(np.float32))
+    masks = torch.full(depth.shape, -1, dtype=torch.long)
+    num_masks = 0
+    for i, (frame, frame_detections, (px1, py1, px2, py2)) in enumerate(zip(frames, detections, visibility.bboxes[order].tolist())):
+        transform = image_to_depth(frame.intrinsics, frame.intrinsics_depth)
+        for box in frame_detections[object_name].boxes.numpy()[::-1]:
+            if box[2] < px1 or box[0] > px2 or box[3] < py1 or box[1] > py2:
+                continue
+            (x1, x2), (y1, y2) = (transform @ [[box[0], box[2]], [box[1], box[3]], [1, 1]])[:2]
+            masks[i, max(int(y1), 0):int(np.ceil(y2)), max(int(x1), 0):int(np.ceil(x2))] = num_masks
+            num_masks += 1
+    if num_masks == 0:
+        return np.empty(0, dtype=np.int64)
+    instances, shares = lift_masks(
+        depth,
+        torch.from_numpy(np.stack([frame.intrinsics_depth for frame in frames])).float(),
+        torch.from_numpy(np.stack([frame.pose for frame in frames])).float(),
+        masks,
+        scene_instance_voxels(scene.scene),
+        num_masks,
+    )
+    return np.unique(instances[(instances >= 0) & (shares >= SCENE_FIND_MIN_SHARE)].numpy())
+
+
+@memoized
 def scene_find(scene: ScenePatch, object_name: str) -> list[ScenePatch]:
     """
-    look thru all images, if found object in image, (can do bbox projection as precheck) get depth, deproject to 3D and compute which 3D label it corresponds to
+    Returns patches of the instances centered inside the patch that detections of the object are lifted to (see
+    `scene_detect`). If `SCENE_FIND_LABELS`, instances are instead matched by their ground truth labels, an oracle.
+    """
+    ids = scene_instance_index(scene.scene).contained(scene.point1, scene.point2) # rather than a scan over all instances
+    instances = scene.scene.instances
+    if SCENE_FIND_LABELS:
+        forms = object_name_forms(object_name)
+        ids = [i for i in ids if forms & object_name_forms(instances.labels[i])]
+    else:
+        ids = np.intersect1d(ids, scene_detect(scene, object_name)) if len(ids) else ids
+    return [scene.crop(*instances.bboxes[i]) for i in ids]
+
 
-    take all 3D labels and compute center/bbox, check if each of those centers are within the scene bbox
+def scene_views(scene: ScenePatch, max_views=4) -> list[np.ndarray]:
     """
-    pass
+    Returns crops of the projected patch box in the frames seeing most of the patch.
+    """
+    visibility = scene_visibility(scene)
+    crops = []
+    for i in torch.argsort(visibility.fractions, descending=True, stable=True)[:max_views]:
+        x1, y1, x2, y2 = visibility.bboxes[i].tolist()
+        image = scene.scene[int(visibility.frames[i])].image
+        crops.append(image[int(y1):int(np.ceil(y2)) + 1, int(x1):int(np.ceil(x2)) + 1])
+    return crops
 
 
-def scene_check_condition(scene: ScenePatch, object_name: str, condition: str) -> bool:
+def scene_text_match_batch(calls: list[tuple[ScenePatch, str]]) -> list[float]:
     """
-    first call scene find, next for each of those labels in scene patch, check if condition is true (look at 2d crops derived from labels)
-    
-    database caches find crops for scene patches
+    Scores the views of all patches of deferred `scene_text_match` calls in one CLIP engine call, averaging per patch.
     """
-    pass
+    views = [scene_views(scene) for scene, _ in calls]
+    texts, inverse = np.unique([text for _, text in calls], return_inverse=True)
+    scores = run_model('ModelClip', [crop for crops in views for crop in crops], list(texts))
+    results, start = [], 0
+    for crops, i in zip(views, inverse.reshape(-1)):
+        results.append(float(scores[start:start + len(crops), i].mean()) if crops else 0.0)
+        start += len(crops)
+    return results
 
 
+@memoized
+@batchable(scene_text_match_batch)
 def scene_text_match(scene: ScenePatch, text: str) -> float:
     """
     if entire scene/find crops use that else use bbox of projected bbox, mean of clip scores (fast, batch no cache)
     
     for batching dont forget rescale crop
     """
-    pass
+    crops = scene_views(scene)
+    if not crops:
+        return 0.0
+    return float(run_model('ModelClip', crops, [text]).mean())
 
 
+def scene_simple_qa_batch(calls: list[tuple[ScenePatch, str]]) -> list[str]:
+    """
+    Answers the questions of deferred `scene_simple_qa` calls with one LLaVA engine call per patch, so questions about the
+    same patch share its prefill. The engine gets the views seeing most of the patch, of which a multiframe engine packs
+    the most relevant ones into its token budget.
+    """
+    groups = {} # patch -> positions of its calls
+    for i, (scene, _) in enumerate(calls):
+        groups.setdefault(patch_key(scene.point1, scene.point2), []).append(i)
+    results = [''] * len(calls)
+    for positions in groups.values():
+        views = scene_views(calls[positions[0]][0], max_views=SCENE_QA_VIEWS)
+        if not views:
+            continue
+        answers = get_model('ModelLlava').answer_frames(views, [calls[i][1] or SIMPLE_QA_QUESTION for i in positions])
+        for i, answer in zip(positions, answers):
+            results[i] = answer
+    return results
+
+
+@memoized
+@batchable(scene_simple_qa_batch)
 def scene_simple_qa(scene: ScenePatch, question: str = None) -> str:
     """
     if entire scene/find crops use that else bbox of projected bbox, vlm decoding
@@ -45,11 +258,54 @@ def scene_simple_qa(scene: ScenePatch, question: str = None) -> str:
 
     for batching dont forget rescale crops
     """
-    pass
+    return scene_simple_qa_batch([(scene, question)])[0]
+
+
+def scene_check_condition_batch(calls: list[tuple[ScenePatch, str, str]]) -> list[bool]:
+    """
+    Asks whether the object has the property for all deferred `scene_check_condition` calls as yes/no questions about the
+    views of each patch, batched as `scene_simple_qa`.
+    """
+    answers = scene_simple_qa_batch([
+        (scene, CHECK_CONDITION_QUESTION.format(object_name=object_name, condition=condition))
+        for scene, object_name, condition in calls
+    ])
+    return [answer_is_yes(answer) for answer in answers]
+
+
+@memoized
+@batchable(scene_check_condition_batch)
+def scene_check_condition(scene: ScenePatch, object_name: str, condition: str) -> bool:
+    """
+    """
+    return scene_check_condition_batch([(scene, object_name, condition)])[0]
+
+
+def scene_view_index(scene: Scene) -> ViewIndex:
+    """
+    Returns the view selection index over the camera poses of a scene, built once per scene and cached.
+    """
+    if scene not in SCENE_VIEW_INDICES:
+        SCENE_VIEW_INDICES[scene] = ViewIndex(scene.poses, scene.intrinsics, scene.image_size)
+    return SCENE_VIEW_INDICES[scene]
+
+
+def scene_render_views(scene: Scene, camera_positions: NumpyTensor['n', 3], target_positions: NumpyTensor['n', 3], k=1) -> NumpyTensor['n', 'k']:
+    """
+    Returns the positions in the sequence of the `k` frames best matching each (camera, target) view, in one batched query.
+    """
+    frames, _ = scene_view_index(scene).query(camera_positions, target_positions, k=k)
+    return frames
 
 
-def scene_render(camera_position: Point3D, target_position: Point3D) -> ImagePatch:
+def scene_render(camera_position: Point3D, target_position: Point3D, scene: Scene = None) -> ImagePatch:
     """
-    TODO actually doesn't render, but returns closest image in the posed multiview sequence
+    Returns the frame of the posed sequence whose view best matches a camera at `camera_position` looking at
+    `target_position`, rather than rendering a novel view.
     """
-    pass
\ No newline at end of file
+    scene = scene or CURRENT_SCENE.get()
+    assert scene is not None, 'render requires a scene, set with scene_context while executing a program'
+    frame = scene[int(scene_render_views(scene, camera_position, target_position)[0, 0])]
+    if frame.depth is not None:
+        image_set_sensor_depth(frame.image, frame.depth, frame.intrinsics, frame.intrinsics_depth)
+    return ImagePatch(frame.image)
\ No newline at end of file
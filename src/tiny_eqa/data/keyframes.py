@@ -0,0 +1,132 @@
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+from tiny_eqa.data.common import NumpyTensor
+from tiny_eqa.data.sequence import FrameSequence
+
+
+@dataclass
+class KeyframeConfig:
+    """
+    """
+
+    """ Maximum number of keyframes. Keyframes over budget are uniformly subsampled. None for no budget. """
+    max_frames: int = None
+
+    """ Frames within both `min_translation` (meters) and `min_rotation` (degrees) of a recent keyframe are dropped
+        from their pose alone, without decoding depth or images. """
+    min_translation: float = 0.10
+    min_rotation: float = 10
+
+    """ Frames whose view frustum overlaps a recent keyframe by more than `max_overlap` are near-duplicate candidates,
+        and dropped if their image hash is also within `max_hash_distance` bits of that keyframe. """
+    max_overlap: float = 0.8
+    max_hash_distance: int = 12
+
+    """ Number of most recent keyframes each frame is compared against. 0 keeps every frame with a valid pose. """
+    window: int = 4
+
+    """ Depth grid resolution used to estimate frustum overlap. """
+    overlap_grid: tuple[int, int] = (12, 16)
+
+
+def pose_distance(pose1: NumpyTensor[4, 4], pose2: NumpyTensor[4, 4]) -> tuple[float, float]:
+    """
+    Returns the translation (meters) and rotation (degrees) between two camera poses.
+    """
+    translation = np.linalg.norm(pose1[:3, 3] - pose2[:3, 3])
+    cos = (np.trace(pose1[:3, :3].T @ pose2[:3, :3]) - 1) / 2
+    return translation, np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+
+def image_hash(image: NumpyTensor['H', 'W', 3]) -> int:
+    """
+    Returns the 64 bit difference hash of an image, whose Hamming distance is robust to small viewpoint and exposure
+    changes.
+    """
+    stride = max(1, min(image.shape[:2]) // 64) # subsample before resampling to avoid converting the full image
+    image = Image.fromarray(np.ascontiguousarray(image[::stride, ::stride])).convert('L')
+    pixels = np.asarray(image.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def frustum_overlap(
+    depth: NumpyTensor['h', 'w'],
+    pose: NumpyTensor[4, 4],
+    pose_other: NumpyTensor[4, 4],
+    intrinsics: NumpyTensor[3, 3],
+    grid: tuple[int, int],
+) -> float:
+    """
+    Returns the fraction of the surface seen from `pose` that is inside the view frustum of `pose_other`, estimated on a
+    grid of depth samples.
+    """
+    h, w = depth.shape
+    v, u = np.meshgrid(
+        np.linspace(0, h - 1, grid[0]).astype(int),
+        np.linspace(0, w - 1, grid[1]).astype(int), indexing='ij',
+    )
+    z = depth[v, u]
+    valid = z > 0
+    if not valid.any():
+        return 0
+    pixels = np.stack([u[valid], v[valid], np.ones(valid.sum())], axis=-1)
+    points = (pixels @ np.linalg.inv(intrinsics).T) * z[valid, None]
+
+    transform = np.linalg.inv(pose_other) @ pose
+    points = points @ transform[:3, :3].T + transform[:3, 3]
+    projected = points @ intrinsics.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u_other = projected[:, 0] / projected[:, 2]
+        v_other = projected[:, 1] / projected[:, 2]
+    inside = (points[:, 2] > 0) & (u_other >= 0) & (u_other < w) & (v_other >= 0) & (v_other < h)
+    return inside.mean()
+
+
+def select_keyframes(sequence: FrameSequence, config: KeyframeConfig) -> NumpyTensor['k']:
+    """
+    Returns positions (into `sequence`) of keyframes, dropping near-duplicate views in increasing order of cost: pose
+    distance, then frustum overlap from depth, then image hash.
+    """
+    reader = sequence.reader
+    poses = sequence.poses
+    keyframes = []
+    hashes = {}
+
+    def keyframe_hash(position):
+        if position not in hashes:
+            hashes[position] = image_hash(reader.read_image(int(sequence.indices[position])))
+        return hashes[position]
+
+    for position, pose in enumerate(poses):
+        if not np.isfinite(pose).all(): # ScanNet marks frames with failed tracking with -inf poses
+            continue
+        recent = keyframes[-config.window:] if config.window else []
+        if not recent:
+            keyframes.append(position)
+            continue
+        if any(
+            t < config.min_translation and r < config.min_rotation
+            for t, r in (pose_distance(pose, poses[k]) for k in recent)
+        ):
+            continue
+
+        depth = reader.read_depth(int(sequence.indices[position]))
+        overlapping = [
+            k for k in recent
+            if frustum_overlap(depth, pose, poses[k], sequence.intrinsics_depth, config.overlap_grid) > config.max_overlap
+        ]
+        if overlapping:
+            frame_hash = image_hash(reader.read_image(int(sequence.indices[position])))
+            if any(bin(frame_hash ^ keyframe_hash(k)).count('1') <= config.max_hash_distance for k in overlapping):
+                continue
+            hashes[position] = frame_hash
+        keyframes.append(position)
+
+    keyframes = np.array(keyframes, dtype=np.int64)
+    if config.max_frames is not None and len(keyframes) > config.max_frames:
+        keyframes = keyframes[np.linspace(0, len(keyframes) - 1, config.max_frames).round().astype(int)]
+    return keyframes
@@ -1,13 +1,129 @@
+from __future__ import annotations
 
+from dataclasses import dataclass
+from typing import Iterator
+
+import numpy as np
+
+from tiny_eqa.data.common import NumpyTensor
+
+
+class FrameSequenceReader: # typing w/o circular imports
+    pass
+
+
+class KeyframeConfig: # typing w/o circular imports
+    pass
+
+
+@dataclass
+class Frame:
+    """
+    Posed RGB-D frame of a sequence.
+    """
+
+    """ Index of the frame in the original (unsubsampled) sequence. """
+    index: int
+    """ RGB image. """
+    image: NumpyTensor['H', 'W', 3]
+    """ Depth in meters. May have a different resolution than `image`, as in ScanNet. """
+    depth: NumpyTensor['h', 'w']
+    """ Intrinsics of `image`. """
+    intrinsics: NumpyTensor[3, 3]
+    """ Intrinsics of `depth`. """
+    intrinsics_depth: NumpyTensor[3, 3]
+    """ Camera to world transform (OpenCV convention). """
+    pose: NumpyTensor[4, 4]
+
+
+@dataclass(eq=False) # hashed by identity to key per scene caches
+class SceneInstances:
+    """
+    3D object instances of a scene, e.g. from the ScanNet instance segmentation.
+    """
+
+    """ Axis-aligned bounding box (min corner, max corner) of each instance. """
+    bboxes: NumpyTensor['n', 2, 3]
+    """ Object name of each instance. """
+    labels: list[str]
 
 
 class FrameSequence:
     """
+    Lazy view over the frames of a reader. Frames are only decoded when accessed, and indexing with a slice or index
+    array returns another view without reading any frames.
     """
-    def __init__(self):
+    def __init__(self, reader: FrameSequenceReader, indices: NumpyTensor['n'] = None, instances: SceneInstances = None):
+        """
+        `instances` default to the instances read by `reader`, if any.
+        """
+        self.reader = reader
+        self.indices = np.arange(len(reader)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self.instances = getattr(reader, 'instances', None) if instances is None else instances
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.indices)
+
+    def __getitem__(self, index: int | slice | NumpyTensor['m']) -> Frame | FrameSequence:
+        """
+        """
+        if isinstance(index, (int, np.integer)):
+            return self.reader.read(int(self.indices[index]))
+        return FrameSequence(self.reader, self.indices[index], self.instances)
+
+    def __iter__(self) -> Iterator[Frame]:
+        """
+        """
+        return self.stream()
+
+    def stream(self, prefetch: int = None) -> Iterator[Frame]:
+        """
+        Yields frames in order, decoded ahead of time by the reader's background workers.
+        """
+        return self.reader.stream(self.indices, prefetch=prefetch)
+
+    def keyframes(self, config: KeyframeConfig) -> tuple[FrameSequence, NumpyTensor['k']]:
+        """
+        Returns the subsequence of keyframes with near-duplicate views pruned, and the ids of the keyframes in the
+        original sequence.
+        """
+        from tiny_eqa.data.keyframes import select_keyframes
+        keyframes = self[select_keyframes(self, config)]
+        return keyframes, keyframes.ids
+
+    @property
+    def ids(self) -> NumpyTensor['n']:
+        """
+        Maps each frame of the view back to its index in the original sequence.
+        """
+        return self.indices
+
+    @property
+    def poses(self) -> NumpyTensor['n', 4, 4]:
+        """
+        """
+        return self.reader.poses[self.indices]
+
+    @property
+    def intrinsics(self) -> NumpyTensor[3, 3]:
+        """
+        """
+        return self.reader.intrinsics
+
+    @property
+    def intrinsics_depth(self) -> NumpyTensor[3, 3]:
+        """
+        """
+        return self.reader.intrinsics_depth
+
+    @property
+    def image_size(self) -> tuple[int, int]:
         """
+        (H, W) of the images, known without decoding any frame.
         """
-        pass
+        return tuple(self.reader.image_size)
 
 
-Scene = FrameSequence # Type definition for agent
\ No newline at end of file
+Scene = FrameSequence # Type definition for agent
@@ -1,16 +1,277 @@
+import json
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from natsort import natsorted
+from PIL import Image
+
+from tiny_eqa.data.common import NumpyTensor
+from tiny_eqa.data.sequence import Frame, FrameSequence, SceneInstances
 
 
 class FrameSequenceReader(ABC):
     """
+    Random access to the frames of a posed RGB-D sequence. Poses, intrinsics and 3D instances are small and loaded
+    eagerly, while images and depth are decoded on demand.
     """
-    pass
+    def __init__(self, prefetch: int = 8, workers: int = 2):
+        """
+        """
+        self.prefetch = prefetch
+        self.workers = workers
+        self.instances: SceneInstances = None
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """
+        """
+        pass
+
+    @abstractmethod
+    def read_image(self, index: int) -> NumpyTensor['H', 'W', 3]:
+        """
+        """
+        pass
+
+    @abstractmethod
+    def read_depth(self, index: int) -> NumpyTensor['h', 'w']:
+        """
+        """
+        pass
+
+    def read(self, index: int) -> Frame:
+        """
+        """
+        return Frame(
+            index=index,
+            image=self.read_image(index),
+            depth=self.read_depth(index),
+            intrinsics=self.intrinsics,
+            intrinsics_depth=self.intrinsics_depth,
+            pose=self.poses[index],
+        )
+
+    def stream(self, indices: NumpyTensor['n'] = None, prefetch: int = None) -> Iterator[Frame]:
+        """
+        Yields frames in order while up to `prefetch` frames are decoded ahead by a background thread pool.
+        """
+        indices = np.arange(len(self)) if indices is None else indices
+        prefetch = prefetch or self.prefetch
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = deque()
+        try:
+            for index in indices:
+                pending.append(executor.submit(self.read, int(index)))
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def sequence(self) -> FrameSequence:
+        """
+        """
+        return FrameSequence(self)
 
 
 class ScannetFrameSequenceReader(FrameSequenceReader):
     """
+    Reads a ScanNet scene exported by the SensReader, i.e. with layout
+
+        color/{index}.jpg, depth/{index}.png, pose/{index}.txt, intrinsic/intrinsic_{color, depth}.txt
+
+    and its 3D instances from the annotations of the scan, if present (see `read_scannet_instances`).
     """
-    def __init__(self):
+    DEPTH_SHIFT = 1000
+
+    def __init__(self, path: Path | str, annotations: Path | str = None, **kwargs):
+        """
+        `annotations` is the directory of the scan with the mesh and instance annotation files, by default `path`.
+        """
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.filenames_image = natsorted((self.path / 'color').glob('*.jpg'))
+        self.filenames_depth = natsorted((self.path / 'depth').glob('*.png'))
+        filenames_pose = natsorted((self.path / 'pose').glob('*.txt'))
+        assert len(self.filenames_image) == len(self.filenames_depth) == len(filenames_pose), \
+            f'Mismatched number of color, depth and pose files in {self.path}'
+        assert self.filenames_image, f'No frames in {self.path}'
+
+        self.poses = np.stack([np.loadtxt(filename) for filename in filenames_pose]).astype(np.float32)
+        self.intrinsics       = np.loadtxt(self.path / 'intrinsic' / 'intrinsic_color.txt')[:3, :3].astype(np.float32)
+        self.intrinsics_depth = np.loadtxt(self.path / 'intrinsic' / 'intrinsic_depth.txt')[:3, :3].astype(np.float32)
+        with Image.open(self.filenames_image[0]) as image: # only decodes the header
+            self.image_size = (image.height, image.width)
+        self.instances = read_scannet_instances(self.path if annotations is None else annotations)
+
+    def __len__(self) -> int:
         """
         """
-        pass
\ No newline at end of file
+        return len(self.filenames_image)
+
+    def read_image(self, index: int) -> NumpyTensor['H', 'W', 3]:
+        """
+        """
+        with Image.open(self.filenames_image[index]) as image:
+            return np.asarray(image.convert('RGB'))
+
+    def read_depth(self, index: int) -> NumpyTensor['h', 'w']:
+        """
+        """
+        with Image.open(self.filenames_depth[index]) as depth:
+            return np.asarray(depth, dtype=np.float32) / self.DEPTH_SHIFT
+
+
+class MemmapFrameSequenceReader(FrameSequenceReader):
+    """
+    Reads a sequence packed by `pack_sequence`. Frames are views into memory-mapped arrays, so repeated reads are
+    served from the page cache without decoding.
+    """
+    def __init__(self, path: Path | str, **kwargs):
+        """
+        """
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as f:
+            self.meta = json.load(f)
+        self.images = np.load(self.path / 'image.npy', mmap_mode='r')
+        self.depths = np.load(self.path / 'depth.npy', mmap_mode='r')
+        self.poses            = np.load(self.path / 'pose.npy')
+        self.intrinsics       = np.load(self.path / 'intrinsics.npy')
+        self.intrinsics_depth = np.load(self.path / 'intrinsics_depth.npy')
+        self.image_size = self.images.shape[1:3]
+        if 'labels' in self.meta:
+            self.instances = SceneInstances(np.load(self.path / 'instance_bboxes.npy'), self.meta['labels'])
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.images)
+
+    def read_image(self, index: int) -> NumpyTensor['H', 'W', 3]:
+        """
+        """
+        return self.images[index]
+
+    def read_depth(self, index: int) -> NumpyTensor['h', 'w']:
+        """
+        """
+        return self.depths[index].astype(np.float32) / self.meta['depth_shift']
+
+    @staticmethod
+    def exists(path: Path | str) -> bool:
+        """
+        """
+        return (Path(path) / 'meta.json').exists()
+
+
+def pack_sequence(reader: FrameSequenceReader, path: Path | str, depth_shift=1000) -> MemmapFrameSequenceReader:
+    """
+    Decodes all frames of `reader` once into a packed memory-mapped store at `path`. Depth is stored as uint16 scaled
+    by `depth_shift`, matching the precision of ScanNet depth.
+    """
+    assert len(reader) > 0, 'Cannot pack a sequence without frames'
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    frame = reader.read(0)
+    images = np.lib.format.open_memmap(path / 'image.npy', mode='w+', dtype=np.uint8,  shape=(len(reader), *frame.image.shape))
+    depths = np.lib.format.open_memmap(path / 'depth.npy', mode='w+', dtype=np.uint16, shape=(len(reader), *frame.depth.shape))
+    for frame in reader.stream():
+        images[frame.index] = frame.image
+        depths[frame.index] = np.clip(np.round(frame.depth * depth_shift), 0, np.iinfo(np.uint16).max)
+    images.flush()
+    depths.flush()
+    del images, depths
+
+    np.save(path / 'pose.npy', reader.poses)
+    np.save(path / 'intrinsics.npy', reader.intrinsics)
+    np.save(path / 'intrinsics_depth.npy', reader.intrinsics_depth)
+    meta = {'depth_shift': depth_shift, 'num_frames': len(reader)}
+    if reader.instances is not None:
+        np.save(path / 'instance_bboxes.npy', reader.instances.bboxes)
+        meta['labels'] = list(reader.instances.labels)
+    with open(path / 'meta.json', 'w') as f: # written last so partially packed stores are not picked up
+        json.dump(meta, f)
+    return MemmapFrameSequenceReader(path, prefetch=reader.prefetch, workers=reader.workers)
+
+
+def read_scannet_sequence(path: Path | str, store: Path | str = None, annotations: Path | str = None, **kwargs) -> FrameSequence:
+    """
+    Returns the ScanNet sequence at `path` with its 3D instances from the scan `annotations` (by default `path`). If
+    `store` is given, the scene is packed there on first use and read from the packed store afterwards.
+    """
+    if store is None:
+        return ScannetFrameSequenceReader(path, annotations, **kwargs).sequence()
+    if not MemmapFrameSequenceReader.exists(store):
+        return pack_sequence(ScannetFrameSequenceReader(path, annotations, **kwargs), store).sequence()
+    return MemmapFrameSequenceReader(store, **kwargs).sequence()
+
+
+PLY_TYPES = {
+    'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2', 'int': 'i4', 'uint': 'u4', 'float': 'f4', 'double': 'f8',
+    'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2', 'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8',
+}
+
+
+def read_ply_vertices(path: Path | str) -> NumpyTensor['n', 3]:
+    """
+    Returns the vertex positions of a PLY mesh whose first element is its vertices, as in ScanNet.
+    """
+    with open(path, 'rb') as f:
+        header = []
+        while (line := f.readline().decode('ascii').strip()) != 'end_header':
+            header.append(line.split())
+        format = header[1][1]
+        elements = [i for i, line in enumerate(header) if line[0] == 'element']
+        assert header[elements[0]][1] == 'vertex', f'First element of {path} is not vertex'
+        count = int(header[elements[0]][2])
+        end = elements[1] if len(elements) > 1 else len(header)
+        names = [line[2] for line in header[elements[0] + 1:end] if line[0] == 'property']
+        if format == 'ascii':
+            vertices = np.loadtxt(f, max_rows=count, usecols=[names.index(axis) for axis in 'xyz'], ndmin=2)
+            return vertices.astype(np.float32)
+        endian = '<' if format == 'binary_little_endian' else '>'
+        dtype = np.dtype([(line[2], endian + PLY_TYPES[line[1]]) for line in header[elements[0] + 1:end] if line[0] == 'property'])
+        vertices = np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype, count=count)
+    return np.stack([vertices['x'], vertices['y'], vertices['z']], axis=-1).astype(np.float32)
+
+
+def read_scannet_instances(path: Path | str) -> SceneInstances | None:
+    """
+    Returns the 3D instances of a ScanNet scan directory, with the axis-aligned box of the mesh vertices of each object
+    of the aggregation, in the coordinates of the camera poses. Reads
+
+        {scene}_vh_clean_2.ply, {scene}_vh_clean_2.0.010000.segs.json, {scene}.aggregation.json
+
+    Returns None if the scan has no annotations.
+    """
+    path = Path(path)
+    filenames = [
+        next(iter(natsorted(path.glob(pattern))), None)
+        for pattern in ['*_vh_clean_2.ply', '*_vh_clean_2.0.010000.segs.json', '*.aggregation.json']
+    ]
+    if any(filename is None for filename in filenames):
+        return None
+    filename_mesh, filename_segments, filename_aggregation = filenames
+    vertices = read_ply_vertices(filename_mesh)
+    with open(filename_segments) as f:
+        segments = np.asarray(json.load(f)['segIndices'])
+    with open(filename_aggregation) as f:
+        groups = json.load(f)['segGroups']
+
+    bboxes, labels = [], []
+    for group in groups:
+        points = vertices[np.isin(segments, group['segments'])]
+        if len(points):
+            bboxes.append(np.stack([points.min(axis=0), points.max(axis=0)]))
+            labels.append(group['label'])
+    return SceneInstances(np.stack(bboxes) if bboxes else np.zeros((0, 2, 3), dtype=np.float32), labels)
@@ -0,0 +1,142 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from tiny_eqa.data.common import NumpyTensor
+
+
+def look_at(eye: NumpyTensor[3], target: NumpyTensor[3], up=(0, 0, 1)) -> NumpyTensor[4, 4]:
+    """
+    Returns the camera to world transform (OpenCV convention) of a camera at `eye` looking at `target`.
+    """
+    forward = np.asarray(target, dtype=np.float64) - eye
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    pose = np.eye(4)
+    pose[:3, :3] = np.stack([right, down, forward], axis=1)
+    pose[:3,  3] = eye
+    return pose
+
+
+def intrinsics_from_fov(size: tuple[int, int], fov=60) -> NumpyTensor[3, 3]:
+    """
+    Returns pinhole intrinsics for an image of `size` (H, W) with horizontal field of view `fov` in degrees.
+    """
+    H, W = size
+    f = W / 2 / np.tan(np.radians(fov) / 2)
+    return np.array([
+        [f, 0, W / 2],
+        [0, f, H / 2],
+        [0, 0, 1],
+    ])
+
+
+def synthetic_trajectory(
+    num_frames: int, room=(6, 5, 3), radius=1.5, revolutions=2, seed=0
+) -> NumpyTensor['n', 4, 4]:
+    """
+    Returns poses of a handheld scan: the camera circles the room center at eye height looking outwards towards the
+    walls, with jitter in position and look-at target.
+    """
+    rng = np.random.RandomState(seed)
+    center = np.array(room) / 2
+    angles = np.linspace(0, 2 * np.pi * revolutions, num_frames)
+    poses = []
+    for angle in angles:
+        eye = center + radius * np.array([np.cos(angle), np.sin(angle), 0]) + rng.normal(0, 0.02, 3)
+        eye[2] = 1.5
+        target = eye + np.array([np.cos(angle + 0.5), np.sin(angle + 0.5), -0.3]) + rng.normal(0, 0.02, 3)
+        poses.append(look_at(eye, target))
+    return np.stack(poses).astype(np.float32)
+
+
+def render_room(
+    pose: NumpyTensor[4, 4], intrinsics: NumpyTensor[3, 3], size: tuple[int, int], room=(6, 5, 3)
+) -> tuple[NumpyTensor['H', 'W', 3], NumpyTensor['H', 'W']]:
+    """
+    Ray casts the inside of an axis-aligned box room from `pose`, returning a textured image and metric depth that are
+    consistent across views.
+    """
+    H, W = size
+    v, u = np.mgrid[0:H, 0:W] + 0.5
+    rays = np.stack([u, v, np.ones_like(u)], axis=-1) @ np.linalg.inv(intrinsics).T
+    rays_world = rays @ pose[:3, :3].T
+    origin = pose[:3, 3]
+
+    # distance along each ray to the nearest wall it exits through
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bounds = np.where(rays_world > 0, np.array(room), 0)
+        t = np.where(rays_world != 0, (bounds - origin) / rays_world, np.inf)
+    t = t.min(axis=-1)
+    points = origin + rays_world * t[..., None]
+
+    texture = np.sin(points[..., [0, 1, 2]] * [3, 5, 7]) + np.sin(points[..., [1, 2, 0]] * [11, 13, 17]) / 2
+    image = (127.5 + 85 * texture).clip(0, 255).astype(np.uint8)
+    depth = t.astype(np.float32) # rays have unit z in camera space, so t is depth
+    return image, depth
+
+
+def write_synthetic_scannet(
+    path: Path | str, num_frames=100, image_size=(968, 1296), depth_size=(480, 640), room=(6, 5, 3), seed=0
+):
+    """
+    Writes a synthetic scene with the ScanNet SensReader layout read by `ScannetFrameSequenceReader`.
+    """
+    path = Path(path)
+    for name in ['color', 'depth', 'pose', 'intrinsic']:
+        (path / name).mkdir(parents=True, exist_ok=True)
+
+    intrinsics       = intrinsics_from_fov(image_size)
+    intrinsics_depth = intrinsics_from_fov(depth_size)
+    np.savetxt(path / 'intrinsic' / 'intrinsic_color.txt', np.pad(intrinsics,       (0, 1)) + np.diag([0, 0, 0, 1]))
+    np.savetxt(path / 'intrinsic' / 'intrinsic_depth.txt', np.pad(intrinsics_depth, (0, 1)) + np.diag([0, 0, 0, 1]))
+
+    for i, pose in enumerate(synthetic_trajectory(num_frames, room=room, seed=seed)):
+        image, _ = render_room(pose, intrinsics,       image_size, room=room)
+        _, depth = render_room(pose, intrinsics_depth, depth_size, room=room)
+        Image.fromarray(image).save(path / 'color' / f'{i}.jpg', quality=90)
+        Image.fromarray((depth * 1000).astype(np.uint16)).save(path / 'depth' / f'{i}.png')
+        np.savetxt(path / 'pose' / f'{i}.txt', pose)
+
+
+def write_synthetic_scannet_instances(path: Path | str, bboxes: NumpyTensor['n', 2, 3], labels: list[str], scene='scene0000_00'):
+    """
+    Writes ScanNet instance annotations read by `read_scannet_instances`: a binary mesh of the boxes' corners, one
+    segment per box and one aggregated object per segment.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    bboxes = np.asarray(bboxes, dtype=np.float32)
+    corners = np.stack(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij'), axis=-1).reshape(8, 3)
+    vertices = np.concatenate([np.where(corners, bbox[1], bbox[0]) for bbox in bboxes]).astype(np.float32)
+    faces = np.array([
+        [0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+        [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3],
+    ])
+    faces = np.concatenate([faces + 8 * i for i in range(len(bboxes))])
+
+    vertex = np.zeros(len(vertices), dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1'), ('alpha', 'u1')])
+    vertex['x'], vertex['y'], vertex['z'] = vertices.T
+    face = np.zeros(len(faces), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+    face['count'], face['indices'] = 3, faces
+    header = '\n'.join([
+        'ply', 'format binary_little_endian 1.0',
+        f'element vertex {len(vertex)}',
+        *[f'property {kind} {name}' for name, kind in [('x', 'float'), ('y', 'float'), ('z', 'float')]],
+        *[f'property uchar {name}' for name in ['red', 'green', 'blue', 'alpha']],
+        f'element face {len(face)}', 'property list uchar int vertex_indices', 'end_header',
+    ])
+    with open(path / f'{scene}_vh_clean_2.ply', 'wb') as f:
+        f.write(f'{header}\n'.encode('ascii'))
+        f.write(vertex.tobytes())
+        f.write(face.tobytes())
+
+    with open(path / f'{scene}_vh_clean_2.0.010000.segs.json', 'w') as f:
+        json.dump({'sceneId': scene, 'segIndices': np.repeat(np.arange(len(bboxes)), 8).tolist()}, f)
+    with open(path / f'{scene}.aggregation.json', 'w') as f:
+        groups = [{'id': i, 'objectId': i, 'segments': [i], 'label': label} for i, label in enumerate(labels)]
+        json.dump({'sceneId': scene, 'segGroups': groups}, f)
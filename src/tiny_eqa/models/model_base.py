@@ -0,0 +1,8 @@
+from abc import ABC
+
+
+class Model(ABC):
+    """
+    Base class of model wrappers.
+    """
+    pass
@@ -1,9 +1,104 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
 import numpy as np
+import torch
 
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
 from tiny_eqa.models.model_base import Model
+from tiny_eqa.models.model_dino import to_tensor
+from tiny_eqa.models.transforms import transform_clip
+
+
+@dataclass
+class ModelClipConfig:
+    """
+    """
+
+    """ Hugging Face CLIP checkpoint. """
+    checkpoint: str = 'openai/clip-vit-base-patch32'
+
+    """ Number of crops per image encoder forward. """
+    batch_size: int = 64
+
+    """ Number of text embeddings kept in the LRU cache. """
+    text_cache_size: int = 4096
 
 
 class ModelClip(Model):
     """
+    CLIP scoring engine for many (crop, text) pairs. Crops of any size are rescaled and packed into batches for the image
+    encoder, while text embeddings are cached, so the usual case of scoring many crops against a few texts runs the text
+    encoder once per distinct text.
     """
-    pass
\ No newline at end of file
+    def __init__(self, config: ModelClipConfig = None, device='cpu', model: torch.nn.Module = None, tokenizer: Callable = None):
+        """
+        `model` and `tokenizer` default to the `checkpoint` of `config`. `tokenizer` is called like a Hugging Face tokenizer
+        on a list of texts with `padding=True` and `return_tensors='pt'`.
+        """
+        self.config = config or ModelClipConfig()
+        self.device = device
+        if model is None or tokenizer is None:
+            from transformers import AutoTokenizer, CLIPModel
+            model = model or CLIPModel.from_pretrained(self.config.checkpoint)
+            tokenizer = tokenizer or AutoTokenizer.from_pretrained(self.config.checkpoint)
+        self.model = model.eval().to(device)
+        self.tokenizer = tokenizer
+        self.transform = transform_clip(self.model.config.vision_config.image_size)
+        self.text_cache = OrderedDict()
+
+    @torch.inference_mode()
+    def __call__(self, crops: list[NumpyTensor['H', 'W', 3] | TorchTensor['ch', 'H', 'W']], texts: list[str]) -> TorchTensor['n', 'm']:
+        """
+        Returns the score matrix in [0, 1] (rescaled cosine similarity) between every crop and every text.
+        """
+        return (self.encode_images(crops) @ self.encode_texts(texts).T + 1) / 2
+
+    def match(self, crops: list[NumpyTensor['H', 'W', 3] | TorchTensor['ch', 'H', 'W']], texts: list[str]) -> TorchTensor['n']:
+        """
+        Returns the score of each (crop, text) pair, encoding each distinct text once.
+        """
+        unique_texts, inverse = np.unique(texts, return_inverse=True)
+        scores = self(crops, list(unique_texts))
+        return scores[torch.arange(len(crops)), torch.from_numpy(inverse.reshape(-1))]
+
+    @torch.inference_mode()
+    def encode_images(self, crops: list[NumpyTensor['H', 'W', 3] | TorchTensor['ch', 'H', 'W']]) -> TorchTensor['n', 'dim']:
+        """
+        Returns normalized image embeddings of crops, which are rescaled to the encoder resolution and run in batches.
+        """
+        embeddings = []
+        for i in range(0, len(crops), self.config.batch_size):
+            inputs = torch.stack([self.transform(to_tensor(crop)) for crop in crops[i:i + self.config.batch_size]])
+            embeddings.append(features(self.model.get_image_features(pixel_values=inputs.to(self.device))).float().cpu())
+        embeddings = torch.cat(embeddings) if embeddings else torch.empty(0, self.model.config.projection_dim)
+        return embeddings / embeddings.norm(dim=-1, keepdim=True)
+
+    @torch.inference_mode()
+    def encode_texts(self, texts: list[str]) -> TorchTensor['m', 'dim']:
+        """
+        Returns normalized text embeddings, encoding texts missing from the LRU cache in one batch.
+        """
+        missing = list(dict.fromkeys(text for text in texts if text not in self.text_cache))
+        if missing:
+            tokens = self.tokenizer(missing, padding=True, return_tensors='pt')
+            embeddings = features(self.model.get_text_features(
+                input_ids=tokens['input_ids'].to(self.device), attention_mask=tokens['attention_mask'].to(self.device),
+            )).float().cpu()
+            embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
+            self.text_cache.update(zip(missing, embeddings))
+        for text in texts:
+            self.text_cache.move_to_end(text)
+        embeddings = torch.stack([self.text_cache[text] for text in texts]) if texts else torch.empty(0, self.model.config.projection_dim)
+        while len(self.text_cache) > self.config.text_cache_size:
+            self.text_cache.popitem(last=False)
+        return embeddings
+
+
+def features(output: TorchTensor['batch', 'dim'] | object) -> TorchTensor['batch', 'dim']:
+    """
+    Returns projected embeddings from `get_{image, text}_features`, which return an output object in recent transformers.
+    """
+    return output if isinstance(output, torch.Tensor) else output.pooler_output
+
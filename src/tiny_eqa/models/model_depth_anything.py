@@ -1,9 +1,272 @@
+import hashlib
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+
 import numpy as np
+import torch
 
+from tiny_eqa.data.common import NumpyTensor
 from tiny_eqa.models.model_base import Model
+from tiny_eqa.models.model_dino import to_tensor
+from tiny_eqa.models.transforms import transform_imagenet
+
+
+@dataclass
+class ModelDepthAnythingConfig:
+    """
+    """
+
+    """ Hugging Face Depth Anything checkpoint. The metric indoor model predicts depth in meters, like ScanNet sensor depth. """
+    checkpoint: str = 'depth-anything/Depth-Anything-V2-Metric-Indoor-Small-hf'
+
+    """ Images are rescaled so that their shorter side is about `image_size`, rounded to the patch size of 14. """
+    image_size: int = 518
+
+    """ Number of frames per forward in `predict`. """
+    batch_size: int = 4
+
+    """ Number of depth bins of the median table, spanning the depth range of each frame. """
+    bins: int = 128
+
+    """ Depth pixels per side of the cells of the median table. """
+    stride: int = 4
+
+    """
+    Number of frames whose depth maps are kept in the LRU cache. The median table of a depth map takes 2 bytes per bin
+    and table cell, about 5.8 MB for the 518x690 prediction of a 4:3 frame with the default bins and stride, so the
+    default cache holds about 190 MB.
+    """
+    cache_size: int = 32
+
+
+@dataclass
+class ModelDepthAnythingStats:
+    """
+    """
+    hits: int = 0
+    misses: int = 0
+    sensor: int = 0
+    forwards: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        """
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+def image_to_depth(intrinsics: NumpyTensor[3, 3], intrinsics_depth: NumpyTensor[3, 3]) -> NumpyTensor[3, 3]:
+    """
+    Returns the map of image pixels to depth pixels of a registered RGB-D camera, e.g. ScanNet, whose depth sensor has
+    a different field of view and principal point than its color camera.
+    """
+    return np.asarray(intrinsics_depth, dtype=np.float64) @ np.linalg.inv(np.asarray(intrinsics, dtype=np.float64))
+
+
+class DepthMap:
+    """
+    Depth of a full frame with a summed area table of per bin depth counts, so the median of any crop costs O(bins)
+    instead of a partial sort of its pixels. The table is built on every `stride`-th depth pixel, with uint16 counts if
+    they fit.
+    """
+    def __init__(
+        self, depth: NumpyTensor['h', 'w'], image_size: tuple[int, int], bins=128, stride=4, transform: NumpyTensor[3, 3] = None,
+    ):
+        """
+        `depth` is in meters with 0 for invalid pixels and may have a lower resolution than the image of `image_size`.
+        `transform` maps image pixels to depth pixels (see `image_to_depth`), by default the ratio of the resolutions, as
+        for depth predicted from the whole image.
+        """
+        self.depth = depth
+        self.stride = stride
+        if transform is None:
+            transform = np.diag([depth.shape[1] / image_size[1], depth.shape[0] / image_size[0], 1])
+        self.transform = np.asarray(transform, dtype=np.float64)
+        samples = depth[::stride, ::stride]
+        valid = samples > 0
+        lo, hi = (samples[valid].min(), samples[valid].max()) if valid.any() else (0.0, 1.0)
+        self.edges = np.linspace(lo, max(hi, lo + 1e-3), bins + 1)
+        ids = np.clip(np.searchsorted(self.edges, samples, side='right') - 1, 0, bins - 1)
+        dtype = np.uint16 if samples.size <= np.iinfo(np.uint16).max else np.uint32
+        self.table = np.zeros((samples.shape[0] + 1, samples.shape[1] + 1, bins), dtype=dtype)
+        np.put_along_axis(self.table[1:, 1:], ids[..., None], valid[..., None].astype(dtype), axis=-1)
+        for r in range(1, self.table.shape[0]): # in place row and column sums, several times faster than np.cumsum
+            self.table[r] += self.table[r - 1]
+        for c in range(1, self.table.shape[1]):
+            self.table[:, c] += self.table[:, c - 1]
+
+    def crop(self, point1: NumpyTensor[2], point2: NumpyTensor[2]) -> 'DepthCrop':
+        """
+        Returns the depth of the image region [point1, point2], in image pixels (x, y), as a view of the depth map.
+        """
+        h, w = self.depth.shape
+        corners = np.stack([point1, point2]).astype(np.float64) @ self.transform[:2, :2].T + self.transform[:2, 2]
+        x1, y1 = np.clip(np.floor(corners.min(axis=0)).astype(int), 0, [w, h])
+        x2, y2 = np.clip(np.ceil(corners.max(axis=0)).astype(int), 0, [w, h])
+        return DepthCrop(self, x1, y1, max(x2, x1), max(y2, y1))
+
+    def median(self, x1: int, y1: int, x2: int, y2: int) -> float:
+        """
+        Returns the median valid depth of the depth pixels [x1, x2) x [y1, y2) from the table, interpolated within its bin,
+        or from the pixels themselves if the region holds no table samples. NaN if no pixel is valid.
+        """
+        s = self.stride
+        r1, r2, c1, c2 = -(-y1 // s), -(-y2 // s), -(-x1 // s), -(-x2 // s) # samples at multiples of the stride
+        if r1 == r2 or c1 == c2:
+            values = self.depth[y1:y2, x1:x2]
+            values = values[values > 0]
+            return float(np.median(values)) if len(values) else float('nan')
+        t = self.table
+        counts = t[r2, c2] - t[r1, c2] - t[r2, c1] + t[r1, c1] # unsigned wraparound cancels, counts fit the dtype
+        cumulative = counts.cumsum()
+        if cumulative[-1] == 0:
+            return float('nan')
+        half = cumulative[-1] / 2
+        b = int(np.searchsorted(cumulative, half))
+        below = cumulative[b - 1] if b > 0 else 0
+        return float(self.edges[b] + (half - below) / counts[b] * (self.edges[b + 1] - self.edges[b]))
+
+
+class DepthCrop:
+    """
+    Depth of an image patch, a view of the depth map of its frame.
+    """
+    def __init__(self, depth_map: DepthMap, x1: int, y1: int, x2: int, y2: int):
+        """
+        """
+        self.depth_map = depth_map
+        self.bounds = (x1, y1, x2, y2)
+
+    @property
+    def depth(self) -> NumpyTensor['h', 'w']:
+        """
+        """
+        x1, y1, x2, y2 = self.bounds
+        return self.depth_map.depth[y1:y2, x1:x2]
+
+    def median(self) -> float:
+        """
+        """
+        return self.depth_map.median(*self.bounds)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.depth, dtype=dtype)
 
 
 class ModelDepthAnything(Model):
     """
+    Monocular depth engine returning a cached `DepthMap` per full frame, which patches of the frame crop as views. Sensor
+    depth, e.g. of ScanNet frames, is used directly when given, skipping inference.
     """
-    pass
\ No newline at end of file
+    def __init__(self, config: ModelDepthAnythingConfig = None, device='cpu', model: torch.nn.Module = None):
+        """
+        `model` defaults to the `checkpoint` of `config`.
+        """
+        self.config = config or ModelDepthAnythingConfig()
+        self.device = device
+        if model is None:
+            from transformers import AutoModelForDepthEstimation
+            model = AutoModelForDepthEstimation.from_pretrained(self.config.checkpoint)
+        self.model = model.eval().to(device)
+        self.transforms = {}
+        self.cache = OrderedDict() # content hash of the frame image -> DepthMap
+        self.keys = {} # id of a frame image -> (weak reference to the image, content hash)
+        self.stats = ModelDepthAnythingStats()
+
+    def __call__(
+        self, image: NumpyTensor['H', 'W', 3], depth: NumpyTensor['h', 'w'] = None, transform: NumpyTensor[3, 3] = None,
+    ) -> DepthMap:
+        """
+        Returns the depth map of a full frame, from sensor `depth` if given and otherwise predicted. `transform` maps image
+        to sensor depth pixels (see `image_to_depth`). Frames are cached by content, so frames decoded again hit the
+        cache, and the content hash is kept per image, so it is free to look up for the many patches of one frame.
+        """
+        return self.depth_maps([image], None if depth is None else [depth], None if transform is None else [transform])[0]
+
+    def depth_maps(
+        self,
+        images: list[NumpyTensor['H', 'W', 3]],
+        depths: list[NumpyTensor['h', 'w'] | None] = None,
+        transforms: list[NumpyTensor[3, 3] | None] = None,
+    ) -> list[DepthMap]:
+        """
+        Returns the depth maps of many frames, predicting those missing from the cache without sensor depth in batches.
+        """
+        depths = depths or [None] * len(images)
+        transforms = transforms or [None] * len(images)
+        results, missing = [None] * len(images), {}
+        for i, image in enumerate(images):
+            key = self.key(image)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                results[i] = self.cache[key]
+                self.stats.hits += 1
+                continue
+            self.stats.misses += 1
+            if depths[i] is not None:
+                self.stats.sensor += 1
+                results[i] = self.insert(key, image, depths[i], transforms[i])
+            else:
+                missing.setdefault(key, []).append(i)
+        positions = list(missing.values())
+        for (key, i), depth in zip(missing.items(), self.predict([images[i[0]] for i in positions])):
+            depth_map = self.insert(key, images[i[0]], depth)
+            for j in i:
+                results[j] = depth_map
+        return results
+
+    def key(self, image: NumpyTensor['H', 'W', 3]) -> str:
+        """
+        Returns the content hash of a frame image, computed once per image object.
+        """
+        entry = self.keys.get(id(image))
+        if entry is not None and entry[0]() is image: # ids of freed images are reused
+            return entry[1]
+        data = np.ascontiguousarray(image)
+        hasher = hashlib.sha1(f'{data.shape}/{data.dtype}'.encode(), usedforsecurity=False)
+        hasher.update(data.data)
+        key, image_id = hasher.hexdigest(), id(image)
+        self.keys[image_id] = (weakref.ref(image, lambda _: self.keys.pop(image_id, None)), key)
+        return key
+
+    def insert(
+        self, key: str, image: NumpyTensor['H', 'W', 3], depth: NumpyTensor['h', 'w'], transform: NumpyTensor[3, 3] = None,
+    ) -> DepthMap:
+        """
+        """
+        depth_map = DepthMap(depth, image.shape[:2], self.config.bins, self.config.stride, transform)
+        self.cache[key] = depth_map
+        while len(self.cache) > self.config.cache_size:
+            self.cache.popitem(last=False)
+        return depth_map
+
+    @torch.inference_mode()
+    def predict(self, images: list[NumpyTensor['H', 'W', 3]]) -> list[NumpyTensor['h', 'w']]:
+        """
+        Returns the predicted depth of each image at the model resolution, running frames of the same size in batches.
+        """
+        results = [None] * len(images)
+        buckets = {}
+        for i, image in enumerate(images):
+            buckets.setdefault(image.shape[:2], []).append(i)
+        for bucket in buckets.values():
+            for start in range(0, len(bucket), self.config.batch_size):
+                batch = bucket[start:start + self.config.batch_size]
+                inputs = torch.stack([self.transform(to_tensor(images[i])) for i in batch]).to(self.device)
+                depth = self.model(pixel_values=inputs).predicted_depth.float().cpu().numpy()
+                self.stats.forwards += 1
+                for i, frame_depth in zip(batch, depth):
+                    results[i] = frame_depth
+        return results
+
+    def transform(self, image: torch.Tensor) -> torch.Tensor:
+        """
+        Rescales an image to the model resolution and normalizes it with ImageNet mean and std.
+        """
+        H, W = image.shape[-2:]
+        scale = self.config.image_size / min(H, W)
+        size = (max(round(H * scale / 14), 1) * 14, max(round(W * scale / 14), 1) * 14)
+        if size not in self.transforms:
+            self.transforms[size] = transform_imagenet(resize=size)
+        return self.transforms[size](image)
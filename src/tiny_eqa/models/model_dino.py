@@ -1,26 +1,45 @@
+import queue
+import threading
 from dataclasses import dataclass
-from typing import Literal
+from typing import Iterable, Iterator, Literal
 
+import numpy as np
 import torch
 from PIL import Image
 
-from tiny_eqa.data.common import TorchTensor
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
+from tiny_eqa.data.sequence import Frame
 from tiny_eqa.models.transforms import transform_imagenet
-from tiny_eqa.utils.math import min_max_norm, pca_transform
+from tiny_eqa.utils.math import PCABasis, StreamingPCA, min_max_norm, pca_fit
 
 
-def visualize_dino(features: TorchTensor['Hout', 'Wout', 'emb']) -> Image.Image:
+def visualize_dino(features: TorchTensor['Hout', 'Wout', 'emb'], basis: PCABasis = None) -> Image.Image:
     """
-    Given a batch of dino features, visualizes features' first 3 (RGB) principal components.
+    Given a batch of dino features, visualizes features' first 3 (RGB) principal components. If `basis` is given, e.g.
+    from `fit_dino_basis`, it is used instead of fitting the components of `features`.
     """
     H, W, dim = features.shape
-    features = torch.from_numpy(features.detach().cpu().numpy())
-    features = features.reshape(-1, dim)
-    
-    pca_features = pca_transform(features, n=3)
+    features = features.detach().float().reshape(-1, dim)
+
+    basis = basis or pca_fit(features, n=3)
+    pca_features = basis.transform(features)
     pca_features = min_max_norm(pca_features, dim=-1)
     pca_features = pca_features.reshape(H, W, 3)
-    return Image.fromarray((pca_features * 255).astype('uint8'))
+    return Image.fromarray((pca_features * 255).byte().cpu().numpy())
+
+
+def fit_dino_basis(features: Iterable[TorchTensor['Hout', 'Wout', 'emb']]) -> PCABasis:
+    """
+    Fits the first 3 principal components of a sequence of dino features in a single streaming pass, so that every frame
+    is colored consistently by `visualize_dino`.
+    """
+    pca = None
+    for frame_features in features:
+        frame_features = frame_features.detach().reshape(-1, frame_features.shape[-1])
+        pca = pca or StreamingPCA(frame_features.shape[-1], device=frame_features.device)
+        pca.partial_fit(frame_features)
+    assert pca is not None, 'fit_dino_basis requires at least one frame of features'
+    return pca.basis(n=3)
 
 
 @dataclass
@@ -39,6 +58,23 @@ class DinoModelConfig:
         these, the higher the feature quality. """
     downsample: float = 2
 
+    """ Number of frames per micro-batch in `DinoModel.extract_sequence`. """
+    batch_size: int = 8
+
+    """ Preprocess the next micro-batches of `DinoModel.extract_sequence` in a worker thread while the model runs. By
+        default on for CUDA, where the forward pass leaves the CPU idle, and off for CPU, where the forward pass already
+        uses every core and the thread measured slower. """
+    prefetch: bool = None
+
+    """ Compute dtype. bfloat16 runs under autocast, which is faster than float32 on recent CPUs. """
+    dtype: Literal['float32', 'bfloat16'] = 'float32'
+
+    """ Apply int8 dynamic quantization to linear layers (CPU only). """
+    quantize: bool = False
+
+    """ Compile the backbone with `torch.compile`. Micro-batches are padded to `batch_size` to avoid recompilation. """
+    compile: bool = False
+
     def input_dims(self, image: TorchTensor['batch', 'ch', 'H', 'W']) -> tuple[int, int]:
         """ 
         Returns the input image dimensions that are compatible with dino.
@@ -54,27 +90,43 @@ class DinoModelConfig:
 class DinoModel:
     """
     """
-    def __init__(self, config: DinoModelConfig, device='cuda'):
+    def __init__(self, config: DinoModelConfig, device='cuda', model: torch.nn.Module = None):
         """
         """
         self.config = config
         self.device = device
-        self.model = torch.hub.load('facebookresearch/dinov2', self.config.backbone)
+        self.model = model or torch.hub.load('facebookresearch/dinov2', self.config.backbone)
         self.model.eval()
         self.model.to(device)
+        if self.config.quantize:
+            assert device == 'cpu', 'Dynamic quantization is only supported on CPU'
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        if self.config.compile:
+            self.model = torch.compile(self.model)
+        self.transforms = {}
 
+    @torch.inference_mode()
     def __call__(self, image: TorchTensor['batch', 'ch', 'H', 'W']) -> TorchTensor['batch', 'Hout', 'Wout', 'dim']:
         """
         """
-        image = self.transform(image).to(self.device)
-        
-        features: TorchTensor['batch', 'Hout x Wout', 'dim'] = self.model.forward_features(image)['x_norm_patchtokens']
+        return self.forward(self.transform(image))
+
+    def forward(self, image: TorchTensor['batch', 'ch', 'Hin', 'Win']) -> TorchTensor['batch', 'Hout', 'Wout', 'dim']:
+        """
+        Returns normalized patch features of images already transformed by `transform`.
+        """
+        image = image.to(self.device)
+        with torch.autocast(
+            device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.config.dtype == 'bfloat16'
+        ):
+            features: TorchTensor['batch', 'Hout x Wout', 'dim'] = self.model.forward_features(image)['x_norm_patchtokens']
+        features = features.float()
         features = features / features.norm(dim=-1, keepdim=True)
         features = features.reshape(
             -1, 
             image.shape[2] // self.config.PATCH_SIZE, 
             image.shape[3] // self.config.PATCH_SIZE, 
-            self.config.FEATURE_CHANNELS,
+            features.shape[-1],
         )
         return features
 
@@ -83,9 +135,108 @@ class DinoModel:
         Transforms an image to be compatible with dino vision transformer. 
         """
         Hout, Wout = self.config.input_dims(image)
-        transform = transform_imagenet(resize=(Hout, Wout))
-        return transform(image)
-    
+        if (Hout, Wout) not in self.transforms:
+            self.transforms[(Hout, Wout)] = transform_imagenet(resize=(Hout, Wout))
+        return self.transforms[(Hout, Wout)](image)
+
+    @torch.inference_mode()
+    def extract_sequence(
+        self, images: Iterable[TorchTensor['ch', 'H', 'W'] | NumpyTensor['H', 'W', 3] | Frame]
+    ) -> list[TorchTensor['Hout', 'Wout', 'dim']]:
+        """
+        Returns features of each image, on CPU and in input order. Images are grouped into buckets by their dino input 
+        dimensions and run in micro-batches of `batch_size`, prepared ahead by a worker thread if `prefetch`.
+        """
+        prefetch = self.config.prefetch
+        if prefetch is None:
+            prefetch = torch.device(self.device).type == 'cuda'
+        batches = self.batches(images)
+        outputs = {}
+        for positions, inputs in prefetched(batches) if prefetch else batches:
+            features = self.forward(inputs).cpu()
+            for position, feature in zip(positions, features): # padded entries are dropped by zip
+                outputs[position] = feature
+        return [outputs[position] for position in range(len(outputs))]
+
+    def batches(self, images: Iterable) -> Iterator[tuple[tuple[int, ...], TorchTensor['batch', 'ch', 'Hin', 'Win']]]:
+        """
+        Yields the (positions, inputs) micro-batches of `extract_sequence`, each full micro-batch of a bucket as soon as
+        it fills up, then the remainders of all buckets.
+        """
+        def make_batch(bucket):
+            positions, inputs = zip(*bucket)
+            inputs = list(inputs)
+            if self.config.compile: # static shapes avoid recompilation on the last micro-batch of each bucket
+                inputs += inputs[-1:] * (self.config.batch_size - len(inputs))
+            return positions, torch.stack(inputs)
+
+        buckets = {}
+        for position, image in enumerate(images):
+            with torch.inference_mode(): # also in the worker thread of `prefetched`
+                image = self.transform(to_tensor(image).unsqueeze(0))[0]
+            bucket = buckets.setdefault(image.shape[-2:], [])
+            bucket.append((position, image))
+            if len(bucket) == self.config.batch_size:
+                yield make_batch(bucket)
+                bucket.clear()
+        for bucket in buckets.values():
+            if bucket:
+                yield make_batch(bucket)
+
+
+def prefetched(items: Iterator, size=2) -> Iterator:
+    """
+    Yields the items of an iterator, which a worker thread advances up to `size` items ahead. Exceptions of the iterator
+    are raised in the caller, and the worker stops when the generator is closed.
+    """
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                return buffer.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+    def work():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                put((item, None))
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+def to_tensor(image: TorchTensor['ch', 'H', 'W'] | NumpyTensor['H', 'W', 3] | Frame) -> TorchTensor['ch', 'H', 'W']:
+    """
+    Converts an image in any of the formats accepted by `DinoModel.extract_sequence` to a float tensor in [0, 1].
+    """
+    if isinstance(image, Frame):
+        image = image.image
+    if isinstance(image, np.ndarray):
+        image = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+    if image.dtype == torch.uint8:
+        image = image.float() / 255
+    return image
+
 
 if __name__ == '__main__':
     from torchvision import transforms
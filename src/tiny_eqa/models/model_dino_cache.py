@@ -0,0 +1,316 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import torch
+
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
+from tiny_eqa.data.sequence import Frame
+from tiny_eqa.models.model_dino import DinoModel, DinoModelConfig
+
+
+def hash_image(image: TorchTensor['ch', 'H', 'W'] | NumpyTensor['H', 'W', 3] | Frame) -> str:
+    """
+    Returns a content hash of the raw pixels of an image. uint8 images hash the same as numpy (H, W, 3) arrays or torch
+    (3, H, W) tensors, without converting them to float.
+    """
+    if isinstance(image, Frame):
+        image = image.image
+    if isinstance(image, torch.Tensor):
+        image = image.detach().cpu()
+        image = (image.permute(1, 2, 0) if image.dtype == torch.uint8 else image).numpy()
+    image = np.ascontiguousarray(image)
+    hasher = hashlib.blake2b(f'{image.shape}/{image.dtype}'.encode(), digest_size=16)
+    hasher.update(image.data)
+    return hasher.hexdigest()
+
+
+def config_prefix(config: DinoModelConfig) -> str:
+    """
+    Returns the part of the cache key determined by `config`.
+    """
+    return f'{config.backbone}/{config.downsample}'
+
+
+def config_fingerprint(config: DinoModelConfig) -> str:
+    """
+    Returns a fingerprint of every option of `config` that changes the extracted features.
+    """
+    return f'{config.backbone}/{config.downsample}/{config.dtype}/{config.quantize}'
+
+
+@dataclass
+class DinoFeatureCacheConfig:
+    """
+    """
+
+    """ Maximum total size of the chunk files in bytes. Least recently used chunks are evicted beyond it. """
+    max_bytes: int = 8 * 2**30
+
+    """ Size of each chunk file in bytes. Chunks are the unit of eviction. """
+    chunk_bytes: int = 256 * 2**20
+
+    """ Number of feature maps kept in process memory in front of the memory-mapped chunks. """
+    hot_size: int = 64
+
+
+@dataclass
+class DinoFeatureCacheStats:
+    """
+    """
+    hits: int = 0
+    hits_hot: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        """
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class DinoFeatureCache:
+    """
+    Persistent cache of normalized dino patch features stored as float16 in append-only memory-mapped chunk files.
+    Reads return tensors backed by the chunk mappings without copying.
+    """
+    DTYPE = np.float16
+
+    def __init__(self, path: Path | str, config: DinoFeatureCacheConfig = None):
+        """
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.config = config or DinoFeatureCacheConfig()
+        self.stats = DinoFeatureCacheStats()
+
+        self.entries = {}  # key -> (chunk, offset, shape)
+        self.chunks  = {}  # chunk -> last access
+        self.sizes   = {}  # chunk -> bytes
+        self.configs = {}  # config prefix -> config fingerprint
+        self.clock = 0
+        self.next_chunk = 0
+        if (self.path / 'index.json').exists():
+            with open(self.path / 'index.json') as f:
+                index = json.load(f)
+            self.chunks = {int(chunk): access for chunk, access in index['chunks'].items() if self.filename(int(chunk)).exists()}
+            self.entries = {key: tuple(entry) for key, entry in index['entries'].items() if entry[0] in self.chunks}
+            self.configs = index['configs']
+            self.clock = index['clock']
+            self.next_chunk = index['next_chunk']
+            self.sizes = {chunk: self.filename(chunk).stat().st_size for chunk in self.chunks}
+        self.nbytes = sum(self.sizes.values()) # total size of the chunk files, kept up to date by put and remove_chunk
+
+        self.hot = OrderedDict()
+        self.mmaps = {}
+        self.active = None # chunks written by another process are never appended to
+        self.active_file = None
+
+    def __contains__(self, key: str) -> bool:
+        """
+        """
+        return key in self.entries
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.entries)
+
+    def __enter__(self):
+        """
+        """
+        return self
+
+    def __exit__(self, *args):
+        """
+        """
+        self.close()
+
+    def filename(self, chunk: int) -> Path:
+        """
+        """
+        return self.path / f'chunk_{chunk:06d}.bin'
+
+    def key(self, frame_hash: str, config: DinoModelConfig) -> str:
+        """
+        """
+        return f'{config_prefix(config)}/{frame_hash}'
+
+    def get(self, key: str) -> TorchTensor['Hout', 'Wout', 'dim'] | None:
+        """
+        Returns cached float16 features for `key` or None, counting hits and misses.
+        """
+        if key not in self.entries:
+            self.stats.misses += 1
+            return None
+        chunk, offset, shape = self.entries[key]
+        self.clock += 1
+        self.chunks[chunk] = self.clock
+        self.stats.hits += 1
+        if key in self.hot:
+            self.hot.move_to_end(key)
+            self.stats.hits_hot += 1
+            return self.hot[key]
+        features = torch.from_numpy(np.ndarray(shape, dtype=self.DTYPE, buffer=self.mmap(chunk, offset, shape), offset=offset))
+        self.put_hot(key, features)
+        return features
+
+    def put(self, key: str, features: TorchTensor['Hout', 'Wout', 'dim']):
+        """
+        Appends features to the active chunk, evicting least recently used chunks if over the disk budget.
+        """
+        if key in self.entries:
+            return
+        data = features.detach().cpu().numpy().astype(self.DTYPE)
+        if self.active is None or self.active_file.tell() + data.nbytes > self.config.chunk_bytes:
+            self.open_chunk()
+        offset = self.active_file.tell()
+        self.active_file.write(data.tobytes())
+        self.entries[key] = (self.active, offset, list(data.shape))
+        self.sizes[self.active] = offset + data.nbytes
+        self.nbytes += data.nbytes
+        self.clock += 1
+        self.chunks[self.active] = self.clock
+        self.put_hot(key, torch.from_numpy(data))
+        self.evict()
+
+    def put_hot(self, key: str, features: TorchTensor['Hout', 'Wout', 'dim']):
+        """
+        """
+        self.hot[key] = features
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.config.hot_size:
+            self.hot.popitem(last=False)
+
+    def mmap(self, chunk: int, offset: int, shape: list[int]) -> np.memmap:
+        """
+        Returns a copy-on-write mapping of `chunk` covering [offset, offset + size), remapping chunks that grew.
+        """
+        end = offset + int(np.prod(shape)) * np.dtype(self.DTYPE).itemsize
+        if chunk not in self.mmaps or len(self.mmaps[chunk]) < end:
+            if chunk == self.active:
+                self.active_file.flush()
+            self.mmaps[chunk] = np.memmap(self.filename(chunk), dtype=np.uint8, mode='c')
+        return self.mmaps[chunk]
+
+    def open_chunk(self):
+        """
+        """
+        if self.active_file is not None:
+            self.active_file.close()
+        self.active = self.next_chunk
+        self.next_chunk += 1
+        self.active_file = open(self.filename(self.active), 'ab')
+
+    def evict(self):
+        """
+        Removes least recently used chunks, other than the active one, until the cache fits the disk budget.
+        """
+        if self.nbytes <= self.config.max_bytes:
+            return
+        for chunk in sorted(self.chunks, key=self.chunks.get):
+            if self.nbytes <= self.config.max_bytes:
+                break
+            if chunk == self.active:
+                continue
+            self.remove_chunk(chunk)
+            self.stats.evictions += 1
+
+    def remove_chunk(self, chunk: int):
+        """
+        Deletes a chunk and its entries. Tensors already returned from it stay valid since they hold the mapping.
+        """
+        keys = [key for key, entry in self.entries.items() if entry[0] == chunk]
+        for key in keys:
+            del self.entries[key]
+            self.hot.pop(key, None)
+        self.mmaps.pop(chunk, None)
+        del self.chunks[chunk]
+        self.nbytes -= self.sizes.pop(chunk, 0)
+        if chunk == self.active:
+            self.active_file.close()
+            self.active = self.active_file = None
+        os.remove(self.filename(chunk))
+
+    def invalidate(self, config: DinoModelConfig = None):
+        """
+        Removes all entries extracted with `config`, or every entry if no config is given. Chunks left without entries are
+        deleted.
+        """
+        prefix = None if config is None else config_prefix(config) + '/'
+        for key in [key for key in self.entries if prefix is None or key.startswith(prefix)]:
+            del self.entries[key]
+            self.hot.pop(key, None)
+        self.configs = {} if prefix is None else {k: v for k, v in self.configs.items() if k != config_prefix(config)}
+        for chunk in set(self.chunks) - {entry[0] for entry in self.entries.values()}:
+            self.remove_chunk(chunk)
+
+    def validate(self, config: DinoModelConfig):
+        """
+        Invalidates entries of `config` if they were extracted with options that changed since, e.g. dtype or quantization.
+        """
+        prefix = config_prefix(config)
+        if self.configs.get(prefix, config_fingerprint(config)) != config_fingerprint(config):
+            self.invalidate(config)
+        self.configs[prefix] = config_fingerprint(config)
+
+    def flush(self):
+        """
+        Writes the index, so entries survive the process.
+        """
+        if self.active_file is not None:
+            self.active_file.flush()
+        index = {
+            'entries': self.entries,
+            'chunks': self.chunks,
+            'configs': self.configs,
+            'clock': self.clock,
+            'next_chunk': self.next_chunk,
+        }
+        with open(self.path / 'index.json.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.path / 'index.json.tmp', self.path / 'index.json')
+
+    def close(self):
+        """
+        """
+        self.flush()
+        if self.active_file is not None:
+            self.active_file.close()
+            self.active = self.active_file = None
+
+
+class CachedDinoModel:
+    """
+    DinoModel that only extracts features of frames missing from a `DinoFeatureCache`.
+    """
+    def __init__(self, model: DinoModel, cache: DinoFeatureCache):
+        """
+        """
+        self.model = model
+        self.cache = cache
+        self.cache.validate(model.config)
+
+    def extract_sequence(
+        self, images: Iterable[TorchTensor['ch', 'H', 'W'] | NumpyTensor['H', 'W', 3] | Frame]
+    ) -> list[TorchTensor['Hout', 'Wout', 'dim']]:
+        """
+        Returns float16 features of each image in input order. Misses are extracted in one `DinoModel.extract_sequence`
+        call and written to the cache.
+        """
+        images = list(images)
+        keys = [self.cache.key(hash_image(image), self.model.config) for image in images]
+        outputs = [self.cache.get(key) for key in keys]
+
+        missing = [i for i, features in enumerate(outputs) if features is None]
+        features = self.model.extract_sequence(images[i] for i in missing)
+        for i, feature in zip(missing, features):
+            self.cache.put(keys[i], feature)
+            outputs[i] = feature.half()
+        return outputs
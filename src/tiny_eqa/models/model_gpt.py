@@ -1,12 +1,24 @@
 import io
+import asyncio
 import base64
+import contextlib
+import hashlib
+import math
+import random
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Literal
 
 from PIL import Image
-from openai import OpenAI, ChatCompletion
+from openai import AsyncOpenAI, OpenAI, ChatCompletion, APIConnectionError, InternalServerError, RateLimitError
 from omegaconf import OmegaConf
 
 from tiny_eqa.models.model_base import Model
+from tiny_eqa.models.model_gpt_cache import GptResponseCache
 
 
 def encode_base64(image: Image.Image):
@@ -24,58 +36,554 @@ def unpack_content(response: ChatCompletion):
     return response.choices[0].message.content
 
 
+def image_tokens(width: int, height: int) -> int:
+    """
+    Returns the prompt tokens of a high detail image, which the API scales to fit 2048x2048 and then to a shortest side
+    of at most 768 before counting 170 tokens per 512x512 tile plus 85.
+    """
+    width, height = api_image_size(width, height)
+    return LOW_DETAIL_TOKENS + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+LOW_DETAIL_TOKENS = 85 # prompt tokens of a low detail image, which the API scales to fit 512x512
+
+
+def api_image_size(width: int, height: int) -> tuple[int, int]:
+    """
+    Returns the size the API scales a high detail image to, so larger images only cost upload bytes.
+    """
+    scale = min(1, 2048 / max(width, height))
+    scale = min(scale, 768 / (min(width, height) * scale)) * scale if min(width, height) * scale > 768 else scale
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+@dataclass
+class ImageEncoderConfig:
+    """
+    """
+
+    """
+    Prompt tokens per image, images are downscaled to stay within it. None to only scale to the size the API uses. Below
+    the 255 tokens of one high detail tile, images are sent in low detail, which takes 85 tokens.
+    """
+    max_tokens: int = 765
+
+    """ Size of the encoded JPEG in bytes, reached by lowering the quality down to `min_quality` and then downscaling. """
+    max_bytes: int = None
+
+    """ JPEG quality of images within `max_bytes`. """
+    quality: int = 85
+    min_quality: int = 40
+
+    """ Number of encoded images kept in the LRU cache, keyed by content hash. """
+    cache_size: int = 1024
+
+    """ Threads encoding the images of one input. """
+    num_workers: int = 8
+
+
+class ImageEncoder:
+    """
+    Encodes images as base64 JPEG for requests, downscaled to a token budget and compressed to a byte budget. Encodings
+    are cached by image content, so frames and crops sent again in later turns or questions are not encoded again.
+    """
+    def __init__(self, config: ImageEncoderConfig = None):
+        """
+        """
+        self.config = config or ImageEncoderConfig()
+        assert self.config.max_tokens is None or self.config.max_tokens >= LOW_DETAIL_TOKENS, \
+            f'Images take at least {LOW_DETAIL_TOKENS} tokens, got max_tokens {self.config.max_tokens}'
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, image: Image.Image) -> str:
+        """
+        Returns the base64 encoding of `image`.
+        """
+        key = self.key(image)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+        encoded = self.encode(image)
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = encoded
+            while len(self.cache) > self.config.cache_size:
+                self.cache.popitem(last=False)
+        return encoded
+
+    def encode_many(self, images: list[Image.Image]) -> list[str]:
+        """
+        Returns the base64 encodings of `images`, encoded in parallel.
+        """
+        if len(images) <= 1 or self.config.num_workers <= 1:
+            return [self(image) for image in images]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.config.num_workers) # PIL releases the GIL while resizing and encoding
+        return list(self.executor.map(self, images))
+
+    def key(self, image: Image.Image) -> str:
+        """
+        """
+        hasher = hashlib.sha1(f'{image.mode}/{image.size}'.encode(), usedforsecurity=False) # fastest of hashlib
+        hasher.update(image.tobytes())
+        return hasher.hexdigest()
+
+    @property
+    def detail(self) -> str | None:
+        """
+        'low' if `max_tokens` is below one high detail tile, else None for the API's default.
+        """
+        return 'low' if self.config.max_tokens is not None and self.config.max_tokens < image_tokens(1, 1) else None
+
+    def target_size(self, width: int, height: int) -> tuple[int, int]:
+        """
+        Returns the largest size at most the API size of the image whose tokens are within `max_tokens`.
+        """
+        if self.detail == 'low':
+            scale = min(1, 512 / max(width, height))
+            return max(1, round(width * scale)), max(1, round(height * scale))
+        width, height = api_image_size(width, height)
+        if self.config.max_tokens is None:
+            return width, height
+        tiles = max(1, (self.config.max_tokens - LOW_DETAIL_TOKENS) // 170)
+        while image_tokens(width, height) > self.config.max_tokens and (width > 1 or height > 1):
+            # largest scale fitting the tiles, e.g. 2x1 tiles fit a 4:3 image in 682x512
+            scale = max(
+                min(512 * columns / width, 512 * (tiles // columns) / height) for columns in range(1, tiles + 1)
+            )
+            width, height = max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+        return width, height
+
+    def encode(self, image: Image.Image) -> str:
+        """
+        """
+        image = image.convert('RGB')
+        size = self.target_size(*image.size)
+        while True:
+            if size != image.size:
+                image = image.resize(size, Image.BOX, reducing_gap=3.0) # area averaging, the fastest antialiased filter
+            data = self.compress(image, self.config.quality)
+            if self.config.max_bytes is not None and len(data) > self.config.max_bytes:
+                low, high = self.config.min_quality, self.config.quality - 1
+                data = None
+                while low <= high: # highest quality within the budget
+                    quality = (low + high) // 2
+                    candidate = self.compress(image, quality)
+                    if len(candidate) <= self.config.max_bytes:
+                        data, low = candidate, quality + 1
+                    else:
+                        high = quality - 1
+                if data is None and min(image.size) > 16:
+                    size = (max(1, round(image.size[0] * 0.75)), max(1, round(image.size[1] * 0.75)))
+                    continue
+                data = data or self.compress(image, self.config.min_quality)
+            return base64.b64encode(data).decode('utf-8')
+
+    def compress(self, image: Image.Image, quality: int) -> bytes:
+        """
+        """
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        return buffer.getvalue()
+
+
+IMAGE_ENCODER = ImageEncoder() # shared by inputs without their own encoder
+
+
 @dataclass
 class ModelGptInput:
     """
     """
     content: list[str] = field(default_factory=list)
 
+    """ Encoder of appended images, `IMAGE_ENCODER` by default. """
+    encoder: ImageEncoder = field(default=None, repr=False, compare=False)
+
     def append(self, input: str | Image.Image):
         """
         """
+        self.extend([input])
+    
+    def extend(self, inputs: list[str | Image.Image]):
+        """
+        Appends `inputs`, encoding all images in parallel.
+        """
         def encode_text(text):
             return {'type': 'text', 'text': text}
 
-        def encode_image(image):
-            encoded = encode_base64(image)
-            return {'type': 'image_url', 'image_url': {'url': f'data:image/jpeg;base64,{encoded}'}}
-    
-        if isinstance(input, str):
-            self.content.append(encode_text(input))
-        elif isinstance(input, Image.Image):
-            self.content.append(encode_image(input))
-        else:
-            raise TypeError(f'ModelGptInput does not support type {type(input)}.')
-    
-    def extend(self, inputs: list[str | Image.Image]):
+        def encode_image(encoded):
+            image_url = {'url': f'data:image/jpeg;base64,{encoded}'}
+            if encoder.detail is not None:
+                image_url['detail'] = encoder.detail
+            return {'type': 'image_url', 'image_url': image_url}
+
+        for input in inputs:
+            if not isinstance(input, (str, Image.Image)):
+                raise TypeError(f'ModelGptInput does not support type {type(input)}.')
+        encoder = self.encoder or IMAGE_ENCODER
+        encoded = iter(encoder.encode_many([input for input in inputs if isinstance(input, Image.Image)]))
+        for input in inputs:
+            self.content.append(encode_text(input) if isinstance(input, str) else encode_image(next(encoded)))
+
+
+def estimate_tokens(messages: list[dict], image_tokens=765) -> int:
+    """
+    Returns an upper estimate of the prompt tokens of messages, about 4 characters per text token and `image_tokens`
+    per image.
+    """
+    tokens = 0
+    for message in messages:
+        content = message['content']
+        for part in [content] if isinstance(content, str) else content:
+            if isinstance(part, str):
+                tokens += len(part) // 4 + 1
+            elif part['type'] == 'text':
+                tokens += len(part['text']) // 4 + 1
+            else:
+                tokens += image_tokens
+    return tokens
+
+
+@dataclass
+class HistoryPolicy:
+    """
+    """
+
+    """
+    'keep' sends the whole history, 'truncate' drops the oldest turns beyond `max_tokens`, and 'summarize' replaces them
+    by one message with the beginning of the most recently dropped turns.
+    """
+    strategy: Literal['keep', 'truncate', 'summarize'] = 'truncate'
+
+    """ Tokens of the history sent with each turn, besides the system prefix and the new turn. """
+    max_tokens: int = 4096
+
+    """ Number of most recent turns whose images are sent, older images are replaced by a placeholder. """
+    keep_images: int = 1
+
+    """ Characters of each dropped message kept by 'summarize'. """
+    summary_chars: int = 200
+
+    """ Tokens of the summary of 'summarize', which keeps the most recently dropped messages within it. """
+    summary_tokens: int = 512
+
+
+IMAGE_PLACEHOLDER = {'type': 'text', 'text': '[image of an earlier turn]'}
+
+
+@dataclass
+class Conversation:
+    """
+    Handle of one conversation with the model, so concurrent tasks do not share history. The system prefix is the same
+    for every turn and handle, so the server can reuse its cached prefix, while `policy` bounds the history sent.
+    """
+
+    """ System message sent first with every turn, e.g. the API prompt. """
+    system: str = None
+
+    """ All turns of the conversation, of which `history` is sent. """
+    messages: list[dict] = field(default_factory=list)
+
+    """ Bound of the history sent with each turn. """
+    policy: HistoryPolicy = field(default_factory=HistoryPolicy)
+
+    """ Index of the first message of the history sent, advanced by truncation. """
+    start: int = 0
+
+    def request(self, content: list[dict]) -> list[dict]:
+        """
+        Returns the messages sent for a new turn with user `content`.
+        """
+        prefix = [{'role': 'system', 'content': self.system}] if self.system is not None else []
+        history = self.history()
+        if self.policy.strategy == 'summarize' and self.start > 0:
+            prefix.append({'role': 'user', 'content': self.summary()})
+        return prefix + history + [{'role': 'user', 'content': content}]
+
+    def record(self, content: list[dict], reply: str):
+        """
+        Appends a turn after its reply was received.
+        """
+        self.messages += [{'role': 'user', 'content': content}, {'role': 'assistant', 'content': reply}]
+
+    def history(self) -> list[dict]:
+        """
+        Returns the history sent with the next turn. Beyond `max_tokens`, the oldest turns are dropped until half of it
+        is left, so the sent history stays a stable prefix for the following turns.
         """
+        if self.policy.strategy != 'keep':
+            if estimate_tokens(self.messages[self.start:]) > self.policy.max_tokens:
+                while self.start < len(self.messages) and estimate_tokens(self.messages[self.start:]) > self.policy.max_tokens // 2:
+                    self.start += 2 # user and assistant message
+        history = self.messages[self.start:]
+        split = max(len(history) - 2 * self.policy.keep_images, 0)
+        return [strip_images(message) for message in history[:split]] + history[split:]
+
+    def summary(self) -> str:
+        """
+        Returns the beginnings of the dropped messages, the most recent ones within `summary_tokens`.
         """
-        for input in inputs: 
-            self.append(input)
+        header = 'Summary of earlier turns:'
+        lines, chars = [], len(header)
+        for message in reversed(self.messages[:self.start]):
+            content = message['content']
+            text = content if isinstance(content, str) else ' '.join(part['text'] for part in content if part['type'] == 'text')
+            line = f'{message["role"]}: {text[:self.policy.summary_chars]}'
+            if (chars + 1 + len(line)) // 4 + 1 > self.policy.summary_tokens: # as estimated by estimate_tokens
+                break
+            lines.append(line)
+            chars += 1 + len(line)
+        return '\n'.join([header, *reversed(lines)])
+
+
+def strip_images(message: dict) -> dict:
+    """
+    Returns `message` with images replaced by a placeholder.
+    """
+    if isinstance(message['content'], str) or all(part['type'] == 'text' for part in message['content']):
+        return message
+    content = [part if part['type'] == 'text' else IMAGE_PLACEHOLDER for part in message['content']]
+    return {**message, 'content': content}
 
 
 class ModelGpt(Model):
     """
+    Chat completion client. It holds no conversation state, so one instance can serve many tasks and threads, each with
+    its own `Conversation` handle.
     """
-    def __init__(self, model: str):
+    def __init__(self, model: str, cache: GptResponseCache = None):
         """
         """
         self.model = model
         self.client = OpenAI()
-        self.reset()
+        self.cache = cache
 
-    def __call__(self, input: ModelGptInput, max_tokens=512) -> dict:
+    def conversation(self, system: str = None, policy: HistoryPolicy = None) -> Conversation:
+        """
+        Returns a new conversation handle with a fixed system prefix, e.g. the API prompt.
+        """
+        return Conversation(system=system, policy=policy or HistoryPolicy())
+
+    def __call__(self, input: ModelGptInput, conversation: Conversation = None, *, max_tokens=512) -> dict:
+        """
+        Sends `input` after the (bounded) history of `conversation`, to which the turn is recorded. Without
+        `conversation`, the input is sent without history.
         """
-        """        
-        self.messages.append({'role': 'user', 'content': input.content})
-        response = self.client.chat.completions.create(model=self.model, messages=self.messages, max_tokens=max_tokens)
-        self.messages.append({'role': 'assistant', 'content': unpack_content(response)})
+        if not isinstance(conversation, (Conversation, type(None))): # e.g. max_tokens passed positionally
+            raise TypeError(f'Expected a Conversation, got {type(conversation)}, max_tokens is keyword-only.')
+        conversation = conversation or self.conversation()
+        messages = conversation.request(input.content)
+        key = self.cache.key(self.model, messages, max_tokens) if self.cache is not None else None
+        response = self.cache.lookup(key) if self.cache is not None else None
+        if response is None:
+            response = self.client.chat.completions.create(model=self.model, messages=messages, max_tokens=max_tokens)
+            if self.cache is not None:
+                self.cache.store(key, response)
+        conversation.record(input.content, unpack_content(response))
         return response
 
     def reset(self):
         """
+        Deprecated, the model holds no history to reset. Start a new `conversation` instead.
+        """
+        warnings.warn('ModelGpt.reset is deprecated, use a new conversation instead', DeprecationWarning, stacklevel=2)
+
+
+@dataclass
+class ModelGptAsyncConfig:
+    """
+    """
+
+    """ Maximum number of requests in flight. """
+    max_concurrency: int = 8
+
+    """ Retries of requests failing with rate limit, connection or server errors. """
+    max_retries: int = 6
+
+    """ Initial and maximum delay in seconds of the jittered exponential backoff between retries. """
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+
+    """ Token rate limit of the account, requests are delayed to stay below it. None for no limit. """
+    tokens_per_minute: int = None
+
+    """ Prompt tokens assumed per image when estimating request size, 765 for a high detail 1024x1024 image. """
+    image_tokens: int = 765
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `tokens_per_minute`. Requests wait in arrival order until their estimated tokens are
+    available, and the difference to the actual usage is returned once known, or all of them if the request failed.
+    """
+    def __init__(self, tokens_per_minute: int):
+        """
+        """
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.available = float(tokens_per_minute)
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        """
+        """
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self, tokens: int):
+        """
+        """
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.available < tokens:
+                await asyncio.sleep((tokens - self.available) / self.rate)
+                self.refill()
+            self.available -= tokens
+
+    def release(self, tokens: int):
+        """
+        Returns overestimated tokens, or takes underestimated ones (negative `tokens`).
+        """
+        self.refill()
+        self.available = min(self.capacity, self.available + tokens)
+
+
+class ModelGptAsync(Model):
+    """
+    Asynchronous chat completion client for running many requests concurrently, e.g. generating programs for all tasks
+    of a benchmark. Each request belongs to its own `Conversation`, and requests are bounded by a concurrency limit and
+    an optional token rate, and retried with exponential backoff.
+    """
+    def __init__(
+        self,
+        model: str,
+        config: ModelGptAsyncConfig = None,
+        transport: Callable[..., Awaitable[ChatCompletion]] = None,
+        cache: GptResponseCache = None,
+    ):
+        """
+        `transport` is called like `AsyncOpenAI().chat.completions.create`, which it defaults to, e.g. to use a fake
+        server in tests. Responses are looked up in and stored to `cache` if given.
+        """
+        self.model = model
+        self.config = config or ModelGptAsyncConfig()
+        self.transport = transport
+        self.cache = cache
+        self.client = None
+        self.loop = None
+        self.retries = 0
+
+    async def setup(self):
+        """
+        Creates the client and the limits, which are bound to the running event loop, e.g. of one `asyncio.run`. The
+        client of a previous loop is closed, as its connections cannot be reused.
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        await self.close()
+        self.loop = loop
+        if self.transport is None:
+            self.client = AsyncOpenAI()
+        self.semaphore = asyncio.Semaphore(self.config.max_concurrency)
+        self.inflight = {} # cache key -> future of the response
+        self.bucket = TokenBucket(self.config.tokens_per_minute) if self.config.tokens_per_minute else None
+
+    def conversation(self, system: str = None, policy: HistoryPolicy = None) -> Conversation:
+        """
+        Returns a new conversation handle with a fixed system prefix, e.g. the API prompt.
+        """
+        return Conversation(system=system, policy=policy or HistoryPolicy())
+
+    async def __call__(self, input: ModelGptInput, conversation: Conversation = None, max_tokens=512) -> ChatCompletion:
+        """
+        Sends `input` after the (bounded) history of `conversation`, to which the turn is recorded on success.
+        """
+        await self.setup()
+        conversation = conversation or self.conversation()
+        messages = conversation.request(input.content)
+        if self.cache is None or self.cache.config.mode == 'off':
+            response = await self.send(messages, max_tokens)
+        else:
+            key = self.cache.key(self.model, messages, max_tokens)
+            response = self.cache.lookup(key)
+            if response is None and key in self.inflight: # identical request sent concurrently
+                response = await asyncio.shield(self.inflight[key])
+            if response is None:
+                self.inflight[key] = asyncio.ensure_future(self.send(messages, max_tokens))
+                try:
+                    response = await asyncio.shield(self.inflight[key])
+                finally:
+                    del self.inflight[key]
+                self.cache.store(key, response)
+        conversation.record(input.content, unpack_content(response))
+        return response
+
+    async def send(self, messages: list[dict], max_tokens: int) -> ChatCompletion:
+        """
+        Sends a request within the concurrency and token rate limits, retrying on rate limit and server errors. The
+        estimated tokens are taken once for all attempts, and returned if the request fails.
+        """
+        tokens = estimate_tokens(messages, self.config.image_tokens) + max_tokens
+        if self.bucket is not None:
+            await self.bucket.acquire(tokens)
+        used = 0
+        try:
+            for attempt in range(self.config.max_retries + 1):
+                try:
+                    transport = self.transport or self.client.chat.completions.create
+                    async with self.semaphore:
+                        response = await transport(model=self.model, messages=messages, max_tokens=max_tokens)
+                except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                    if attempt == self.config.max_retries:
+                        raise
+                    self.retries += 1
+                    await asyncio.sleep(self.backoff(attempt, e))
+                    continue
+                used = response.usage.total_tokens if response.usage is not None else tokens
+                return response
+        finally:
+            if self.bucket is not None:
+                self.bucket.release(tokens - used)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """
+        Returns the delay before retrying, which is the server's `retry-after` if given.
+        """
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        delay = min(self.config.backoff_max, self.config.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def batch(self, inputs: list[ModelGptInput], max_tokens=512) -> list[ChatCompletion]:
+        """
+        Sends each input as a new conversation, concurrently up to `max_concurrency`.
+        """
+        return await asyncio.gather(*[self(input, max_tokens=max_tokens) for input in inputs])
+
+    async def close(self):
+        """
+        Closes the client, e.g. before the event loop of its requests ends. A new one is created by the next request.
         """
-        self.messages = []
+        if self.client is not None:
+            with contextlib.suppress(RuntimeError): # connections of a closed loop are dropped without closing them
+                await self.client.close()
+        self.client = None
+        self.loop = None
 
 
 if __name__ == '__main__':
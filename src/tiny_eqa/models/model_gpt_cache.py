@@ -0,0 +1,177 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+from openai.types.chat import ChatCompletion
+
+
+@dataclass
+class GptResponseCacheConfig:
+    """
+    """
+
+    """
+    'readwrite' returns cached responses and stores new ones, 'write' always sends requests and stores the responses,
+    'replay' only returns cached responses and raises KeyError on misses, e.g. for offline CI, and 'off' bypasses the cache.
+    """
+    mode: Literal['readwrite', 'write', 'replay', 'off'] = 'readwrite'
+
+    """ Seconds after which responses expire, None to keep them until evicted. """
+    ttl: float = None
+
+    """ Maximum total size of the stored responses in bytes. Least recently used responses are evicted beyond it. """
+    max_bytes: int = 2**30
+
+
+@dataclass
+class GptResponseCacheStats:
+    """
+    """
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        """
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class GptResponseCache:
+    """
+    On-disk SQLite cache of chat completions, addressed by a hash of the model, messages, including base64 encoded
+    images, and max_tokens of the request.
+    """
+    def __init__(self, path: Path | str, config: GptResponseCacheConfig = None):
+        """
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.config = config or GptResponseCacheConfig()
+        self.stats = GptResponseCacheStats()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL') # concurrent readers in other processes
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, accessed REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.nbytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def __len__(self) -> int:
+        """
+        """
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def __enter__(self):
+        """
+        """
+        return self
+
+    def __exit__(self, *args):
+        """
+        """
+        self.close()
+
+    def close(self):
+        """
+        """
+        self.connection.close()
+
+    @staticmethod
+    def key(model: str, messages: list[dict], max_tokens: int) -> str:
+        """
+        """
+        request = json.dumps({'model': model, 'messages': messages, 'max_tokens': max_tokens}, sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def lookup(self, key: str) -> ChatCompletion | None:
+        """
+        Returns the cached response of `key` according to the mode, or None if the request has to be sent.
+        """
+        if self.config.mode in ('off', 'write'):
+            return None
+        response = self.get(key)
+        if response is None and self.config.mode == 'replay':
+            raise KeyError(f'No cached response for request {key} in replay mode')
+        return response
+
+    def store(self, key: str, response: ChatCompletion):
+        """
+        Stores the response of a sent request according to the mode.
+        """
+        if self.config.mode in ('readwrite', 'write'):
+            self.put(key, response)
+
+    def get(self, key: str) -> ChatCompletion | None:
+        """
+        Returns the cached response of `key` or None, counting hits and misses.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT response, size, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.config.ttl is not None and now - row[2] > self.config.ttl:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.nbytes -= row[1]
+                self.stats.expired += 1
+                row = None
+            if row is None:
+                self.stats.misses += 1
+                return None
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        self.stats.hits += 1
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key: str, response: ChatCompletion):
+        """
+        Inserts or replaces the response of `key`, evicting least recently used responses if over `max_bytes`.
+        """
+        data = response.model_dump_json()
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.nbytes += len(data) - (row[0] if row else 0)
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (key, data, len(data), now, now))
+            self.evict(keep=key)
+
+    def evict(self, keep: str = None):
+        """
+        Deletes least recently used responses other than `keep` until the cache is within `max_bytes`.
+        """
+        while self.nbytes > self.config.max_bytes:
+            rows = self.connection.execute(
+                'SELECT key, size FROM responses WHERE key != ? ORDER BY accessed LIMIT 64', (keep or '',)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.nbytes <= self.config.max_bytes:
+                    break
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.nbytes -= size
+                self.stats.evictions += 1
+
+    def expire(self) -> int:
+        """
+        Deletes all expired responses, returning their number.
+        """
+        if self.config.ttl is None:
+            return 0
+        with self.lock:
+            cutoff = time.time() - self.config.ttl
+            size, count = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM responses WHERE created < ?', (cutoff,)
+            ).fetchone()
+            self.connection.execute('DELETE FROM responses WHERE created < ?', (cutoff,))
+            self.nbytes -= size
+            self.stats.expired += count
+        return count
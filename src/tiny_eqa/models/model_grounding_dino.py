@@ -1,9 +1,227 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
 import numpy as np
+import torch
+from torchvision.ops import nms
 
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
 from tiny_eqa.models.model_base import Model
+from tiny_eqa.models.model_dino import to_tensor
+from tiny_eqa.models.transforms import transform_imagenet
+
+
+@dataclass
+class ModelGroundingDinoConfig:
+    """
+    """
+
+    """ Hugging Face Grounding DINO checkpoint. """
+    checkpoint: str = 'IDEA-Research/grounding-dino-tiny'
+
+    """ Minimum score of a detection, the highest probability of the query over the tokens of its label. """
+    box_threshold: float = 0.35
+
+    """ IoU above which overlapping detections of the same label are suppressed. """
+    nms_threshold: float = 0.5
+
+    """ Join the labels asked about a frame into one grounding prompt, so one forward detects all of them. The labels then
+        compete for the decoder queries, so their detections differ from asking for each label alone. If False, each label
+        gets its own prompt and forward, and a multi-label call returns exactly the detections of separate calls. """
+    joint_prompts: bool = True
+
+    """ Images are rescaled so that their shorter side is `image_size` and their longer side at most `max_image_size`. """
+    image_size: int = 800
+    max_image_size: int = 1333
+
+    """ Number of frames per forward. """
+    batch_size: int = 4
+
+    """ Number of (frame, label) detections kept in the LRU cache. """
+    cache_size: int = 16384
+
+
+@dataclass
+class Detections:
+    """
+    Detections of one label in one image, sorted by descending score.
+    """
+
+    """ Boxes (x1, y1, x2, y2) in pixels of the image. """
+    boxes: TorchTensor['n', 4]
+    """ Scores in [0, 1]. """
+    scores: TorchTensor['n']
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.scores)
+
+
+@dataclass
+class ModelGroundingDinoStats:
+    """
+    """
+    hits: int = 0
+    misses: int = 0
+    forwards: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        """
+        return self.hits / max(self.hits + self.misses, 1)
 
 
 class ModelGroundingDino(Model):
+    """
+    Open vocabulary detection engine for many (frame, label) pairs. All labels asked about a frame are joined into one
+    grounding prompt ('cabinet . chair . door .', see `joint_prompts`), whose phrases the text encoder keeps separate, so
+    one forward detects every label, and frames run in micro-batches. Detections are split back out per label by the query probabilities over
+    each label's tokens and cached per (frame, label), so repeated `find` and `exists` calls are free.
+    """
+    def __init__(self, config: ModelGroundingDinoConfig = None, device='cpu', model: torch.nn.Module = None, tokenizer: Callable = None):
+        """
+        `model` and `tokenizer` default to the `checkpoint` of `config`. `tokenizer` is called like a Hugging Face BERT
+        tokenizer on a list of texts with `add_special_tokens=False`, and provides `cls_token_id`, `sep_token_id` and
+        `convert_tokens_to_ids`.
+        """
+        self.config = config or ModelGroundingDinoConfig()
+        self.device = device
+        if model is None or tokenizer is None:
+            from transformers import AutoTokenizer, GroundingDinoForObjectDetection
+            model = model or GroundingDinoForObjectDetection.from_pretrained(self.config.checkpoint)
+            tokenizer = tokenizer or AutoTokenizer.from_pretrained(self.config.checkpoint)
+        self.model = model.eval().to(device)
+        self.tokenizer = tokenizer
+        self.transforms = {}
+        self.cache = OrderedDict() # (frame key, label) -> Detections
+        self.stats = ModelGroundingDinoStats()
+
+    def __call__(self, images: list[NumpyTensor['H', 'W', 3]], labels: list[str]) -> list[dict[str, Detections]]:
+        """
+        Returns the detections of every label in every image. Only (frame, label) pairs missing from the cache are run,
+        with one prompt per set of missing labels.
+        """
+        labels = list(dict.fromkeys(labels))
+        keys = [self.key(image) for image in images]
+        found, missing = {}, {} # frame key -> cached detections, missing labels
+        positions = {}
+        for i, key in enumerate(keys):
+            if key in positions: # the same frame passed twice
+                continue
+            positions[key] = i
+            found[key] = {}
+            for label in labels:
+                if (key, label) in self.cache:
+                    self.cache.move_to_end((key, label))
+                    found[key][label] = self.cache[(key, label)]
+                    self.stats.hits += 1
+                else:
+                    missing.setdefault(key, []).append(label)
+                    self.stats.misses += 1
+
+        groups = {} # missing labels -> frame keys, usually one group over all frames
+        for key, missing_labels in missing.items():
+            groups.setdefault(tuple(missing_labels), []).append(key)
+        for missing_labels, group in groups.items():
+            detections = self.detect([images[positions[key]] for key in group], list(missing_labels))
+            for key, frame_detections in zip(group, detections):
+                found[key].update(frame_detections)
+                for label, label_detections in frame_detections.items():
+                    self.cache[(key, label)] = label_detections
+        while len(self.cache) > self.config.cache_size:
+            self.cache.popitem(last=False)
+        return [{label: found[key][label] for label in labels} for key in keys]
+
+    @torch.inference_mode()
+    def detect(self, images: list[NumpyTensor['H', 'W', 3]], labels: list[str]) -> list[dict[str, Detections]]:
+        """
+        Returns the detections of every label in every image without the cache. Frames are grouped by size and run in
+        micro-batches of `batch_size` per prompt, and labels only span several prompts beyond the text length of the model.
+        """
+        results = [{} for _ in images]
+        buckets = {}
+        for i, image in enumerate(images):
+            buckets.setdefault(image.shape[:2], []).append(i)
+        for input_ids, spans in self.prompts(labels):
+            for (H, W), bucket in buckets.items():
+                for start in range(0, len(bucket), self.config.batch_size):
+                    batch = bucket[start:start + self.config.batch_size]
+                    inputs = torch.stack([self.transform(to_tensor(images[i])) for i in batch]).to(self.device)
+                    ids = input_ids[None].expand(len(batch), -1).to(self.device)
+                    outputs = self.model(
+                        pixel_values=inputs,
+                        pixel_mask=torch.ones(len(batch), *inputs.shape[-2:], dtype=torch.long, device=self.device),
+                        input_ids=ids,
+                        attention_mask=torch.ones_like(ids),
+                        token_type_ids=torch.zeros_like(ids),
+                    )
+                    self.stats.forwards += 1
+                    probs = outputs.logits.float().sigmoid().cpu()
+                    boxes = box_cxcywh_to_xyxy(outputs.pred_boxes.float().cpu()) * torch.tensor([W, H, W, H])
+                    for label, begin, end in spans:
+                        scores = probs[:, :, begin:end].amax(dim=-1)
+                        for i, frame_scores, frame_boxes in zip(batch, scores, boxes):
+                            results[i][label] = self.select(frame_boxes, frame_scores)
+        return results
+
+    def select(self, boxes: TorchTensor['q', 4], scores: TorchTensor['q']) -> Detections:
+        """
+        Returns the detections of one label among the queries of a frame, above `box_threshold` and suppressing overlaps.
+        """
+        keep = torch.nonzero(scores >= self.config.box_threshold)[:, 0]
+        boxes, scores = boxes[keep], scores[keep]
+        keep = nms(boxes, scores, self.config.nms_threshold) # sorted by descending score
+        return Detections(boxes[keep], scores[keep])
+
+    def prompts(self, labels: list[str]) -> list[tuple[TorchTensor['length'], list[tuple[str, int, int]]]]:
+        """
+        Returns the token ids of grounding prompts joining the labels, e.g. '[CLS] cabinet . chair . [SEP]', with the
+        (label, begin, end) token span of each label, splitting labels over several prompts beyond `max_text_len`, or
+        one prompt per label unless `joint_prompts`.
+        """
+        max_length = self.model.config.max_text_len
+        cls, sep, dot = self.tokenizer.cls_token_id, self.tokenizer.sep_token_id, self.tokenizer.convert_tokens_to_ids('.')
+        tokens = self.tokenizer([label.lower() for label in labels], add_special_tokens=False)['input_ids']
+        prompts, ids, spans = [], [cls], []
+        for label, label_tokens in zip(labels, tokens):
+            label_tokens = list(label_tokens)[:max_length - 3]
+            if spans and (len(ids) + len(label_tokens) + 2 > max_length or not self.config.joint_prompts):
+                prompts.append((torch.tensor(ids + [sep]), spans))
+                ids, spans = [cls], []
+            spans.append((label, len(ids), len(ids) + len(label_tokens)))
+            ids += label_tokens + [dot]
+        if spans:
+            prompts.append((torch.tensor(ids + [sep]), spans))
+        return prompts
+
+    def transform(self, image: TorchTensor['ch', 'H', 'W']) -> TorchTensor['ch', 'Hin', 'Win']:
+        """
+        Rescales an image to the detector resolution and normalizes it with ImageNet mean and std.
+        """
+        H, W = image.shape[-2:]
+        scale = min(self.config.image_size / min(H, W), self.config.max_image_size / max(H, W))
+        size = (round(H * scale), round(W * scale))
+        if size not in self.transforms:
+            self.transforms[size] = transform_imagenet(resize=size)
+        return self.transforms[size](image)
+
+    @staticmethod
+    def key(image: NumpyTensor['H', 'W', 3]) -> str:
+        """
+        Returns a content hash of a frame, so copies of the same frame share cached detections.
+        """
+        image = np.ascontiguousarray(image)
+        hasher = hashlib.sha1(f'{image.shape}/{image.dtype}'.encode(), usedforsecurity=False)
+        hasher.update(image.data)
+        return hasher.hexdigest()
+
+
+def box_cxcywh_to_xyxy(boxes: TorchTensor['...', 4]) -> TorchTensor['...', 4]:
     """
     """
-    pass
\ No newline at end of file
+    cx, cy, w, h = boxes.unbind(-1)
+    return torch.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], dim=-1)
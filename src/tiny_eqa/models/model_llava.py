@@ -1,9 +1,232 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
 import numpy as np
+import torch
 
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
 from tiny_eqa.models.model_base import Model
+from tiny_eqa.models.model_dino import to_tensor
+from tiny_eqa.models.transforms import transform_clip
+
+
+@dataclass
+class ModelLlavaConfig:
+    """
+    """
+
+    """ Hugging Face LLaVA checkpoint. """
+    checkpoint: str = 'llava-hf/llava-1.5-7b-hf'
+
+    """ System prompt, followed by 'USER: <image>' in the prefix shared by all questions about an image. """
+    system: str = (
+        'A chat between a curious human and an artificial intelligence assistant. '
+        'The assistant gives helpful, detailed, and polite answers to the human\'s questions.'
+    )
+
+    """ Part of the prompt after the image, differing per question. """
+    question_template: str = '\n{question} ASSISTANT:'
+
+    """ Maximum number of generated tokens per answer. """
+    max_new_tokens: int = 32
+
+    """ Number of questions decoded together against one prefix. """
+    batch_size: int = 8
+
+    """ Keep the KV cache of each image prefix for later questions, otherwise it is recomputed for every batch. """
+    reuse_prefix: bool = True
+
+    """ Number of image prefixes (vision tokens and KV cache) kept in the LRU cache. """
+    cache_size: int = 16
+
+
+@dataclass
+class ModelLlavaStats:
+    """
+    """
+    hits: int = 0
+    misses: int = 0
+    prefill_tokens: int = 0
+    generated_tokens: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        """
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+@dataclass
+class LlavaPrefix:
+    """
+    Prefill of (system prompt + image) shared by all questions about an image.
+    """
+
+    """ Projected vision tokens of the image. """
+    vision: TorchTensor['tokens', 'dim']
+    """ Keys and values of every language model layer over the prefix, with batch size 1. """
+    kv: list[tuple[TorchTensor[1, 'heads', 'length', 'head_dim'], TorchTensor[1, 'heads', 'length', 'head_dim']]]
+    """ Number of prefix tokens. """
+    length: int
 
 
 class ModelLlava(Model):
     """
+    Local LLaVA visual question answering engine for many questions about few images. The vision tokens of an image and
+    the KV cache of the (system prompt + image) prefix are computed once and kept, and questions about the image are
+    prefilled and greedily decoded together against the prefix. Questions of different lengths are padded between the
+    prefix and the question, with attention masks and position ids skipping the padding.
     """
-    pass
\ No newline at end of file
+    def __init__(self, config: ModelLlavaConfig = None, device='cpu', model: torch.nn.Module = None, tokenizer: Callable = None):
+        """
+        `model` and `tokenizer` default to the `checkpoint` of `config`. `tokenizer` is called like a Hugging Face
+        tokenizer on a text with `add_special_tokens=False`, and provides `bos_token_id`, `eos_token_id`, `pad_token_id`
+        and `decode`.
+        """
+        self.config = config or ModelLlavaConfig()
+        self.device = device
+        if model is None or tokenizer is None:
+            from transformers import AutoTokenizer, LlavaForConditionalGeneration
+            model = model or LlavaForConditionalGeneration.from_pretrained(self.config.checkpoint)
+            tokenizer = tokenizer or AutoTokenizer.from_pretrained(self.config.checkpoint)
+        self.model = model.eval().to(device)
+        self.tokenizer = tokenizer
+        self.transform = transform_clip(self.model.config.vision_config.image_size)
+        self.cache = OrderedDict() # image key -> LlavaPrefix
+        self.stats = ModelLlavaStats()
+
+    def __call__(self, images: list[NumpyTensor['H', 'W', 3]], questions: list[str]) -> list[str]:
+        """
+        Returns the answer of each (image, question) pair. Pairs are grouped by image, so each distinct image is prefilled
+        at most once.
+        """
+        groups = {} # image key -> positions of its questions
+        keys = [self.key(image) for image in images]
+        for i, key in enumerate(keys):
+            groups.setdefault(key, []).append(i)
+        answers = [None] * len(images)
+        for key, positions in groups.items():
+            tokens = self.generate(images[positions[0]], [questions[i] for i in positions], key=key)
+            for i, answer in zip(positions, tokens):
+                answers[i] = self.tokenizer.decode(answer, skip_special_tokens=True).strip()
+        return answers
+
+    def answer_frames(self, frames: list[NumpyTensor['H', 'W', 3]], questions: list[str]) -> list[str]:
+        """
+        Returns the answers of questions about a scene seen in several frames, ordered by decreasing visibility. A single
+        image model looks at the first frame only.
+        """
+        return self([frames[0]] * len(questions), questions)
+
+    @torch.inference_mode()
+    def generate(self, image: NumpyTensor['H', 'W', 3], questions: list[str], max_new_tokens: int = None, key: str = None) -> list[list[int]]:
+        """
+        Returns the generated token ids of each question about `image`, without the end of sequence token.
+        """
+        max_new_tokens = max_new_tokens or self.config.max_new_tokens
+        key = key or self.key(image)
+        results = []
+        for start in range(0, len(questions), self.config.batch_size):
+            prefix = self.prefix(image, key)
+            results += self.decode(prefix, questions[start:start + self.config.batch_size], max_new_tokens)
+        return results
+
+    def decode(self, prefix: LlavaPrefix, questions: list[str], max_new_tokens: int) -> list[list[int]]:
+        """
+        Prefills a batch of questions after a copy of the prefix KV cache and decodes them greedily.
+        """
+        from transformers import DynamicCache
+
+        pad, eos = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
+        tokens = [
+            list(self.tokenizer(self.config.question_template.format(question=question), add_special_tokens=False)['input_ids'])
+            for question in questions
+        ]
+        B, length = len(tokens), max(len(x) for x in tokens)
+        input_ids = torch.tensor([[pad] * (length - len(x)) + x for x in tokens])
+        valid = input_ids.new_tensor([[0] * (length - len(x)) + [1] * len(x) for x in tokens])
+        attention_mask = torch.cat([valid.new_ones(B, prefix.length), valid], dim=1)
+        position_ids = prefix.length + (valid.cumsum(dim=1) - 1).clamp(min=0)
+        cache = DynamicCache(ddp_cache_data=[(k.expand(B, -1, -1, -1), v.expand(B, -1, -1, -1)) for k, v in prefix.kv])
+        self.stats.prefill_tokens += int(valid.sum())
+
+        generated, done = [], torch.zeros(B, dtype=torch.bool)
+        next_positions = position_ids[:, -1:] + 1
+        for _ in range(max_new_tokens):
+            outputs = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                position_ids=position_ids.to(self.device),
+                past_key_values=cache,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+            next_tokens = outputs.logits[:, -1].argmax(dim=-1).cpu()
+            next_tokens = torch.where(done, pad, next_tokens)
+            generated.append(next_tokens)
+            self.stats.generated_tokens += int((~done).sum())
+            done |= next_tokens == eos
+            if done.all():
+                break
+            cache = outputs.past_key_values
+            input_ids = next_tokens[:, None]
+            attention_mask = torch.cat([attention_mask, (~done[:, None]).long()], dim=1)
+            position_ids, next_positions = next_positions, next_positions + 1
+        generated = torch.stack(generated, dim=1).tolist()
+        return [x[:x.index(eos)] if eos in x else x for x in generated]
+
+    def prefix(self, image: NumpyTensor['H', 'W', 3], key: str) -> LlavaPrefix:
+        """
+        Returns the prefill of (system prompt + image), from the cache if `reuse_prefix`.
+        """
+        if self.config.reuse_prefix and key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats.hits += 1
+            return self.cache[key]
+        self.stats.misses += 1
+        prefix = self.prefill(self.encode_image(image))
+        if self.config.reuse_prefix:
+            self.cache[key] = prefix
+            while len(self.cache) > self.config.cache_size:
+                self.cache.popitem(last=False)
+        return prefix
+
+    @torch.inference_mode()
+    def prefill(self, vision: TorchTensor['tokens', 'dim']) -> LlavaPrefix:
+        """
+        Returns the prefill of the system prompt followed by vision tokens.
+        """
+        text = self.tokenizer(f'{self.config.system} USER:', add_special_tokens=False)['input_ids']
+        input_ids = torch.tensor([[self.tokenizer.bos_token_id, *text] + [self.model.config.image_token_id] * len(vision)])
+        embeddings = self.model.get_input_embeddings()(input_ids.to(self.device))
+        embeddings[0, -len(vision):] = vision.to(embeddings)
+        outputs = self.model(inputs_embeds=embeddings, use_cache=True, logits_to_keep=1)
+        prefix = LlavaPrefix(vision, [(k, v) for k, v, *_ in outputs.past_key_values], input_ids.shape[1])
+        self.stats.prefill_tokens += prefix.length
+        return prefix
+
+    @torch.inference_mode()
+    def encode_image(self, image: NumpyTensor['H', 'W', 3]) -> TorchTensor['tokens', 'dim']:
+        """
+        Returns the projected vision tokens of an image.
+        """
+        pixel_values = self.transform(to_tensor(image))[None].to(self.device)
+        output = self.model.get_image_features(
+            pixel_values=pixel_values,
+            vision_feature_layer=self.model.config.vision_feature_layer,
+            vision_feature_select_strategy=self.model.config.vision_feature_select_strategy,
+        )
+        features = output if isinstance(output, torch.Tensor) else output.pooler_output # output object in recent transformers
+        return features[0]
+
+    @staticmethod
+    def key(image: NumpyTensor['H', 'W', 3]) -> str:
+        """
+        Returns a content hash of an image, so that crops of the same region share their prefix.
+        """
+        image = np.ascontiguousarray(image)
+        hasher = hashlib.sha1(f'{image.shape}/{image.dtype}'.encode(), usedforsecurity=False)
+        hasher.update(image.data)
+        return hasher.hexdigest()
@@ -1,9 +1,161 @@
-import numpy as np
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
 
-from tiny_eqa.models.model_llava import ModelLlava
+import torch
+
+from tiny_eqa.data.common import NumpyTensor, TorchTensor
+from tiny_eqa.models.model_clip import ModelClip
+from tiny_eqa.models.model_llava import LlavaPrefix, ModelLlava, ModelLlavaConfig
+
+
+@dataclass
+class ModelLlavaMultiframeConfig(ModelLlavaConfig):
+    """
+    """
+
+    """ Vision tokens per frame, to which the token grid of each frame is average pooled (to the largest square within). """
+    frame_tokens: int = 64
+
+    """ Vision tokens of all frames of a question, filled with frames in order of relevance. """
+    max_tokens: int = 576
+
+    """ Number of frames whose pooled vision tokens and CLIP embeddings are kept in the LRU caches. """
+    frame_cache_size: int = 1024
 
 
 class ModelLlavaMultiframe(ModelLlava):
     """
+    LLaVA engine for questions about many scan frames. Each frame's vision tokens are pooled to `frame_tokens`, and for
+    each question the frames most relevant to it by CLIP score are packed, in their original order, until `max_tokens`
+    is filled, bounding the sequence length however many frames are given. Pooled tokens and CLIP embeddings are cached
+    per frame across questions, and questions selecting the same frames share one prefix.
     """
-    pass
\ No newline at end of file
+    def __init__(
+        self,
+        config: ModelLlavaMultiframeConfig = None,
+        device='cpu',
+        model: torch.nn.Module = None,
+        tokenizer: Callable = None,
+        clip: ModelClip = None,
+    ):
+        """
+        Without `clip`, frames are taken in the given order, e.g. by decreasing visibility.
+        """
+        super().__init__(config or ModelLlavaMultiframeConfig(), device, model, tokenizer)
+        self.clip = clip
+        self.frame_cache = OrderedDict() # frame key -> pooled vision tokens
+        self.embedding_cache = OrderedDict() # frame key -> CLIP image embedding
+
+    def answer_frames(self, frames: list[NumpyTensor['H', 'W', 3]], questions: list[str]) -> list[str]:
+        """
+        """
+        return [self.tokenizer.decode(x, skip_special_tokens=True).strip() for x in self.generate_frames(frames, questions)]
+
+    @torch.inference_mode()
+    def generate_frames(self, frames: list[NumpyTensor['H', 'W', 3]], questions: list[str], max_new_tokens: int = None) -> list[list[int]]:
+        """
+        Returns the generated token ids of each question about the frames, each question seeing its selected frames.
+        """
+        max_new_tokens = max_new_tokens or self.config.max_new_tokens
+        keys = [self.key(frame) for frame in frames]
+        groups = {} # selected frames -> positions of their questions
+        for i, selection in enumerate(self.select(frames, keys, questions)):
+            groups.setdefault(tuple(selection), []).append(i)
+        results = [None] * len(questions)
+        for selection, positions in groups.items():
+            for start in range(0, len(positions), self.config.batch_size):
+                batch = positions[start:start + self.config.batch_size]
+                prefix = self.frames_prefix([frames[i] for i in selection], [keys[i] for i in selection])
+                for i, tokens in zip(batch, self.decode(prefix, [questions[i] for i in batch], max_new_tokens)):
+                    results[i] = tokens
+        return results
+
+    def select(self, frames: list[NumpyTensor['H', 'W', 3]], keys: list[str], questions: list[str]) -> list[list[int]]:
+        """
+        Returns the positions of the frames packed for each question, the most relevant ones fitting in `max_tokens`, in
+        their original order.
+        """
+        num_frames = max(self.config.max_tokens // self.pooled_size() ** 2, 1)
+        if self.clip is None or len(frames) <= num_frames:
+            return [list(range(min(num_frames, len(frames))))] * len(questions)
+        scores = self.frame_embeddings(frames, keys) @ self.clip.encode_texts(questions).T # (frames, questions)
+        selected = torch.topk(scores, num_frames, dim=0).indices.T
+        return [sorted(x) for x in selected.tolist()]
+
+    def frame_embeddings(self, frames: list[NumpyTensor['H', 'W', 3]], keys: list[str]) -> TorchTensor['n', 'dim']:
+        """
+        Returns the normalized CLIP embedding of each frame, encoding frames missing from the cache in batches.
+        """
+        embeddings = self.lookup(self.embedding_cache, keys) # of this call, as it may hold more frames than the cache
+        missing = list({key: i for i, key in enumerate(keys) if key not in embeddings}.items())
+        if missing:
+            for (key, _), embedding in zip(missing, self.clip.encode_images([frames[i] for _, i in missing])):
+                embeddings[key] = self.embedding_cache[key] = embedding
+        self.evict(self.embedding_cache, self.config.frame_cache_size)
+        return torch.stack([embeddings[key] for key in keys])
+
+    def frames_prefix(self, frames: list[NumpyTensor['H', 'W', 3]], keys: list[str]) -> LlavaPrefix:
+        """
+        Returns the prefill of the system prompt and the pooled vision tokens of the frames, from the cache if
+        `reuse_prefix`.
+        """
+        key = '+'.join(keys)
+        if self.config.reuse_prefix and key in self.cache:
+            self.stats.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.stats.misses += 1
+        vision = self.lookup(self.frame_cache, keys)
+        for frame, frame_key in zip(frames, keys):
+            if frame_key not in vision:
+                vision[frame_key] = self.frame_cache[frame_key] = self.pool(self.encode_image(frame))
+        self.evict(self.frame_cache, self.config.frame_cache_size)
+        prefix = self.prefill(torch.cat([vision[frame_key] for frame_key in keys]))
+        if self.config.reuse_prefix:
+            self.cache[key] = prefix
+            while len(self.cache) > self.config.cache_size:
+                self.cache.popitem(last=False)
+        return prefix
+
+    def pool(self, vision: TorchTensor['tokens', 'dim']) -> TorchTensor['pooled', 'dim']:
+        """
+        Average pools the square token grid of a frame to `pooled_size`^2 tokens.
+        """
+        size = math.isqrt(len(vision))
+        vision = vision[len(vision) - size**2:] # without the CLS token of the 'full' feature selection
+        pooled = self.pooled_size(len(vision))
+        if pooled == size:
+            return vision
+        grid = vision.T.reshape(1, -1, size, size)
+        return torch.nn.functional.adaptive_avg_pool2d(grid, pooled).reshape(vision.shape[1], -1).T.contiguous()
+
+    def pooled_size(self, tokens: int = None) -> int:
+        """
+        Returns the side of the pooled token grid of a frame with `tokens` vision tokens, by default of the model.
+        """
+        if tokens is None:
+            vision_config = self.model.config.vision_config
+            tokens = (vision_config.image_size // vision_config.patch_size) ** 2
+        return max(min(math.isqrt(self.config.frame_tokens), math.isqrt(tokens)), 1)
+
+    @staticmethod
+    def lookup(cache: OrderedDict, keys: list[str]) -> dict:
+        """
+        Returns the entries of `keys` found in `cache`, marked as most recently used.
+        """
+        found = {}
+        for key in keys:
+            if key in cache:
+                cache.move_to_end(key)
+                found[key] = cache[key]
+        return found
+
+    @staticmethod
+    def evict(cache: OrderedDict, size: int):
+        """
+        Evicts the least recently used entries of `cache` beyond `size`.
+        """
+        while len(cache) > size:
+            cache.popitem(last=False)
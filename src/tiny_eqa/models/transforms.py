@@ -13,4 +13,20 @@ def transform_imagenet(resize: tuple[int, int]=None, interpolation=transforms.In
                 std =[0.229, 0.224, 0.225],
             ),
         ]
-    )
\ No newline at end of file
+    )
+
+def transform_clip(size: int, interpolation=transforms.InterpolationMode.BICUBIC):
+    """
+    Returns transform that resizes the shorter side of an image to `size`, center crops it to a square and normalizes it
+    with CLIP mean and std.
+    """
+    return transforms.Compose(
+        [
+            transforms.Resize(size, interpolation=interpolation, antialias=True),
+            transforms.CenterCrop(size),
+            transforms.Normalize(
+                mean=[0.48145466, 0.4578275, 0.40821073],
+                std =[0.26862954, 0.26130258, 0.27577711],
+            ),
+        ]
+    )
@@ -0,0 +1,225 @@
+from dataclasses import dataclass
+
+import torch
+
+from tiny_eqa.data.common import TorchTensor
+
+
+VOXEL_BITS = 21 # bits per axis of packed voxel keys, i.e. +-2^20 voxels
+
+
+def backproject(
+    depth: TorchTensor['batch', 'h', 'w'],
+    intrinsics: TorchTensor['batch', 3, 3],
+    poses: TorchTensor['batch', 4, 4],
+    masks: TorchTensor['batch', 'h', 'w'],
+) -> tuple[TorchTensor['n', 3], TorchTensor['n']]:
+    """
+    Back-projects every pixel with valid depth and a mask id >= 0 of a batch of frames to world coordinates in a single
+    pass, returning the points and their mask ids. `masks` holds per frame label maps at depth resolution, e.g. detections
+    of an object name numbered globally across frames, with -1 for unmasked pixels.
+    """
+    frames, v, u = torch.nonzero((masks >= 0) & (depth > 0), as_tuple=True)
+    z = depth[frames, v, u]
+    K = intrinsics.expand(len(depth), 3, 3)[frames]
+    x = (u.to(z) + 0.5 - K[:, 0, 2]) / K[:, 0, 0] * z
+    y = (v.to(z) + 0.5 - K[:, 1, 2]) / K[:, 1, 1] * z
+    points = torch.stack([x, y, z], dim=-1)
+
+    T = poses[frames].to(points)
+    points = (T[:, :3, :3] @ points[:, :, None])[:, :, 0] + T[:, :3, 3]
+    return points, masks[frames, v, u]
+
+
+def voxel_keys(points: TorchTensor['n', 3], voxel_size: float) -> TorchTensor['n']:
+    """
+    Packs the voxel coordinates of points into int64 keys, comparable across point sets with the same voxel size.
+    """
+    coords = torch.floor(points / voxel_size).long() + (1 << (VOXEL_BITS - 1))
+    return (coords[:, 0] << (2 * VOXEL_BITS)) | (coords[:, 1] << VOXEL_BITS) | coords[:, 2]
+
+
+def voxel_downsample(
+    points: TorchTensor['n', 3], labels: TorchTensor['n'], voxel_size: float
+) -> tuple[TorchTensor['m'], TorchTensor['m'], TorchTensor['m']]:
+    """
+    Merges points with the same label falling in the same voxel, returning the voxel keys, labels and point counts of the
+    occupied (voxel, label) pairs.
+    """
+    keys, voxels = torch.unique(voxel_keys(points, voxel_size), return_inverse=True)
+    labels = labels.long()
+    num_labels = int(labels.max()) + 1 if len(labels) else 1
+    pairs, counts = torch.unique(voxels * num_labels + labels, return_counts=True)
+    return keys[pairs // num_labels], pairs % num_labels, counts
+
+
+@dataclass
+class InstanceVoxels:
+    """
+    Voxelized 3D instance segmentation of a scene, mapping voxel keys to instance ids.
+    """
+
+    """ Sorted keys of occupied voxels. """
+    keys: TorchTensor['v']
+    """ Instance id of each voxel. """
+    instances: TorchTensor['v']
+    """ Voxel size in meters. """
+    voxel_size: float
+
+    @classmethod
+    def from_points(cls, points: TorchTensor['n', 3], instances: TorchTensor['n'], voxel_size=0.05):
+        """
+        Voxelizes an instance labeled point cloud, e.g. ScanNet mesh vertices, resolving voxels shared by several
+        instances to the instance with the most points.
+        """
+        keys, instances, counts = voxel_downsample(points, instances, voxel_size)
+        order = torch.argsort(counts, stable=True) # keep the last (largest count) entry per key
+        keys, instances = keys[order], instances[order]
+        unique_keys, inverse = torch.unique(keys, return_inverse=True)
+        winner = torch.zeros(len(unique_keys), dtype=torch.long).scatter_(0, inverse, torch.arange(len(keys)))
+        return cls(unique_keys, instances[winner], voxel_size)
+
+    @classmethod
+    def from_boxes(cls, bboxes: TorchTensor['n', 2, 3], voxel_size=0.05):
+        """
+        Voxelizes the volumes of axis-aligned instance boxes, for scenes without an instance labeled point cloud, e.g.
+        packed sequences. Voxels of overlapping boxes go to the smallest box, e.g. to a cup rather than its table.
+        """
+        lower = torch.floor(bboxes[:, 0] / voxel_size).long()
+        upper = torch.floor(bboxes[:, 1] / voxel_size).long()
+        order = torch.argsort((upper - lower + 1).prod(dim=1), descending=True, stable=True)
+        keys, instances = [], []
+        for i in order.tolist():
+            axes = [torch.arange(int(lower[i, axis]), int(upper[i, axis]) + 1) for axis in range(3)]
+            coords = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1).reshape(-1, 3)
+            keys.append(voxel_keys((coords + 0.5) * voxel_size, voxel_size))
+            instances.append(torch.full((len(coords),), i, dtype=torch.long))
+        if not keys:
+            return cls(torch.empty(0, dtype=torch.long), torch.empty(0, dtype=torch.long), voxel_size)
+        keys, instances = torch.cat(keys), torch.cat(instances)
+        unique_keys, inverse = torch.unique(keys, return_inverse=True)
+        # the last (smallest) box of each voxel wins
+        winner = torch.zeros(len(unique_keys), dtype=torch.long).scatter_reduce_(0, inverse, torch.arange(len(keys)), 'amax')
+        return cls(unique_keys, instances[winner], voxel_size)
+
+    def lookup(self, keys: TorchTensor['n']) -> TorchTensor['n']:
+        """
+        Returns the instance id of each voxel key, -1 for unoccupied voxels.
+        """
+        positions = torch.searchsorted(self.keys, keys).clamp(max=len(self.keys) - 1)
+        return torch.where(self.keys[positions] == keys, self.instances[positions], -1)
+
+
+def vote_instances(
+    labels: TorchTensor['m'], instances: TorchTensor['m'], counts: TorchTensor['m'], num_labels: int
+) -> tuple[TorchTensor['num_labels'], TorchTensor['num_labels']]:
+    """
+    Majority vote of instance ids per label, weighted by counts, ignoring instance -1. Returns the winning instance of each
+    label (-1 without votes) and its share of the label's votes.
+    """
+    valid = instances >= 0
+    labels, instances, counts = labels[valid], instances[valid], counts[valid]
+    if len(labels) == 0:
+        return torch.full((num_labels,), -1, dtype=torch.long), torch.zeros(num_labels)
+    num_instances = int(instances.max()) + 1 if len(instances) else 1
+    pairs, inverse = torch.unique(labels * num_instances + instances, return_inverse=True)
+    votes = torch.zeros(len(pairs), dtype=counts.dtype).scatter_add_(0, inverse, counts)
+    pair_labels = pairs // num_instances
+
+    # the winner of each label is its last pair after sorting by votes then (stably) by label
+    order = torch.argsort(votes, stable=True)
+    order = order[torch.argsort(pair_labels[order], stable=True)]
+    winner = torch.full((num_labels,), -1, dtype=torch.long).scatter_(0, pair_labels[order], order)
+
+    totals = torch.zeros(num_labels, dtype=counts.dtype).scatter_add_(0, labels, counts)
+    has_votes = winner >= 0
+    instance = torch.where(has_votes, pairs[winner.clamp(min=0)] % num_instances, -1)
+    share = torch.where(has_votes, votes[winner.clamp(min=0)] / totals.clamp(min=1), 0)
+    return instance, share
+
+
+def project(
+    points: TorchTensor['n', 3], poses: TorchTensor['batch', 4, 4], intrinsics: TorchTensor[3, 3]
+) -> tuple[TorchTensor['batch', 'n', 2], TorchTensor['batch', 'n']]:
+    """
+    Projects world points into every camera of a batch, returning pixel coordinates and depths.
+    """
+    world_to_camera = torch.linalg.inv(poses.to(points))
+    camera = points @ world_to_camera[:, :3, :3].transpose(1, 2) + world_to_camera[:, None, :3, 3]
+    z = camera[..., 2]
+    uv = (camera @ intrinsics.to(points).T)[..., :2] / z.clamp(min=1e-6)[..., None]
+    return uv, z
+
+
+@dataclass
+class BoxVisibility:
+    """
+    Frames of a sequence whose camera frustum sees a 3D box.
+    """
+
+    """ Positions of the frames in the sequence. """
+    frames: TorchTensor['k']
+    """ Fraction of the box (by volume samples) inside each frame's frustum. """
+    fractions: TorchTensor['k']
+    """ Projected 2D box (x1, y1, x2, y2) of the visible part of the box in each frame, in pixels. """
+    bboxes: TorchTensor['k', 4]
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.frames)
+
+
+def box_visibility(
+    point1: TorchTensor[3],
+    point2: TorchTensor[3],
+    poses: TorchTensor['batch', 4, 4],
+    intrinsics: TorchTensor[3, 3],
+    image_size: tuple[int, int],
+    min_fraction=0.05,
+    resolution=6,
+    near=0.1,
+    far=10.0,
+) -> BoxVisibility:
+    """
+    Culls frames that cannot see the box [point1, point2] by projecting a `resolution`^3 grid of samples spanning the box
+    into all camera frusta at once. Occlusion is not considered.
+    """
+    lower, upper = torch.minimum(point1, point2).double(), torch.maximum(point1, point2).double()
+    steps = torch.linspace(0, 1, resolution, dtype=torch.float64)
+    grid = torch.stack(torch.meshgrid(steps, steps, steps, indexing='ij'), dim=-1).reshape(-1, 3)
+    samples = lower + grid * (upper - lower)
+
+    uv, z = project(samples, poses, intrinsics)
+    H, W = image_size
+    inside = (z > near) & (z < far) & (uv[..., 0] >= 0) & (uv[..., 0] < W) & (uv[..., 1] >= 0) & (uv[..., 1] < H)
+    fractions = inside.double().mean(dim=1)
+    centers = poses[:, :3, 3].double()
+    surrounding = torch.all((centers >= lower) & (centers <= upper), dim=1) # cameras inside the box always see it
+    frames = torch.nonzero((fractions >= min_fraction) | (surrounding & (fractions > 0)))[:, 0]
+
+    uv, inside = uv[frames], inside[frames, :, None]
+    x1y1 = torch.where(inside, uv, torch.inf).amin(dim=1)
+    x2y2 = torch.where(inside, uv, -torch.inf).amax(dim=1)
+    x1y1 = torch.where(surrounding[frames, None], 0, x1y1)
+    x2y2 = torch.where(surrounding[frames, None], torch.tensor([W, H], dtype=uv.dtype), x2y2)
+    return BoxVisibility(frames, fractions[frames].float(), torch.cat([x1y1, x2y2], dim=-1).float())
+
+
+def lift_masks(
+    depth: TorchTensor['batch', 'h', 'w'],
+    intrinsics: TorchTensor['batch', 3, 3],
+    poses: TorchTensor['batch', 4, 4],
+    masks: TorchTensor['batch', 'h', 'w'],
+    scene: InstanceVoxels,
+    num_masks: int = None,
+) -> tuple[TorchTensor['num_masks'], TorchTensor['num_masks']]:
+    """
+    Lifts 2D masks of a batch of frames to the 3D instances of `scene`: back-projects all masked pixels, merges them per
+    voxel, and votes each mask into the instance most of its voxels fall into. Returns the instance id of each mask (-1 if
+    none) and the share of votes it won.
+    """
+    num_masks = num_masks or int(masks.max()) + 1
+    points, labels = backproject(depth, intrinsics, poses, masks)
+    keys, labels, counts = voxel_downsample(points, labels, scene.voxel_size)
+    return vote_instances(labels, scene.lookup(keys), counts, num_masks)
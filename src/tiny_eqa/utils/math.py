@@ -1,4 +1,7 @@
-from sklearn.decomposition import PCA
+from dataclasses import dataclass
+
+import numpy as np
+import torch
 
 from tiny_eqa.data.common import NumpyTensor, TorchTensor
 
@@ -6,14 +9,82 @@ from tiny_eqa.data.common import NumpyTensor, TorchTensor
 def min_max_norm(tensor: NumpyTensor | TorchTensor, dim=None):
     """
     """
-    tmin = tensor.min(axis=dim, keepdims=True)
-    tmax = tensor.max(axis=dim, keepdims=True)
+    if isinstance(tensor, torch.Tensor):
+        tmin = tensor.amin(dim=() if dim is None else dim, keepdim=True)
+        tmax = tensor.amax(dim=() if dim is None else dim, keepdim=True)
+    else:
+        tmin = tensor.min(axis=dim, keepdims=True)
+        tmax = tensor.max(axis=dim, keepdims=True)
     return (tensor - tmin) / (tmax - tmin)
 
 
-def pca_transform(tensor: NumpyTensor['batch', 'dim'], n: int) -> NumpyTensor['batch', 'n']:
+@dataclass
+class PCABasis:
+    """
+    Principal components of a dataset, fit once and used to project many tensors, e.g. every frame of a sequence.
+    """
+    mean: TorchTensor['dim']
+    components: TorchTensor['n', 'dim']
+
+    def transform(self, tensor: TorchTensor['batch', 'dim']) -> TorchTensor['batch', 'n']:
+        """
+        """
+        return (tensor - self.mean) @ self.components.T
+
+
+def sign_flip(components: TorchTensor['n', 'dim']) -> TorchTensor['n', 'dim']:
+    """
+    Flips signs of components so their largest magnitude entry is positive, making projections deterministic.
+    """
+    signs = torch.sign(components.gather(1, components.abs().argmax(dim=1, keepdim=True)))
+    return components * signs
+
+
+def pca_fit(tensor: TorchTensor['batch', 'dim'], n: int, niter=4) -> PCABasis:
+    """
+    Fits the top `n` principal components with randomized low rank SVD, which is much cheaper than a full SVD when
+    `n` is small relative to `dim`.
+    """
+    tensor = tensor.float()
+    mean = tensor.mean(dim=0)
+    _, _, V = torch.pca_lowrank(tensor - mean, q=min(n + 8, *tensor.shape), center=False, niter=niter)
+    return PCABasis(mean, sign_flip(V[:, :n].T))
+
+
+class StreamingPCA:
+    """
+    Exact PCA accumulated over batches of a dataset too large to fit in memory, keeping only the first and second
+    moments, which are (dim, dim) regardless of the number of samples.
+    """
+    def __init__(self, dim: int, device='cpu'):
+        """
+        """
+        self.count = 0
+        self.total = torch.zeros(dim, dtype=torch.float64, device=device)
+        self.outer = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+
+    def partial_fit(self, tensor: TorchTensor['batch', 'dim']):
+        """
+        """
+        tensor = tensor.to(self.total)
+        self.count += len(tensor)
+        self.total += tensor.sum(dim=0)
+        self.outer += tensor.T @ tensor
+
+    def basis(self, n: int) -> PCABasis:
+        """
+        """
+        mean = self.total / self.count
+        covariance = self.outer / self.count - torch.outer(mean, mean)
+        _, eigenvectors = torch.linalg.eigh(covariance) # ascending eigenvalues
+        components = eigenvectors[:, -n:].flip(1).T
+        return PCABasis(mean.float(), sign_flip(components).float())
+
+
+def pca_transform(tensor: NumpyTensor['batch', 'dim'] | TorchTensor['batch', 'dim'], n: int) -> NumpyTensor['batch', 'n'] | TorchTensor['batch', 'n']:
     """
+    Projects `tensor` onto its top `n` principal components, returning the same tensor type as the input.
     """
-    pca = PCA(n_components=n)
-    pca.fit(tensor)
-    return pca.transform(tensor)
\ No newline at end of file
+    if isinstance(tensor, np.ndarray):
+        return pca_transform(torch.from_numpy(tensor), n).numpy()
+    return pca_fit(tensor, n).transform(tensor.float())
@@ -0,0 +1,184 @@
+import numpy as np
+
+from tiny_eqa.data.common import NumpyTensor
+
+
+class UniformGrid:
+    """
+    Uniform grid over 3D points stored in CSR layout: points are sorted by cell, and occupied cells are looked up by
+    binary search, so memory is proportional to the number of points rather than the grid volume.
+    """
+    def __init__(self, points: NumpyTensor['n', 3], cell_size: float = None, points_per_cell=4):
+        """
+        """
+        self.points = np.asarray(points, dtype=np.float64)
+        self.lower = self.points.min(axis=0) if len(self.points) else np.zeros(3)
+        self.upper = self.points.max(axis=0) if len(self.points) else np.zeros(3)
+        if cell_size is None: # roughly `points_per_cell` points per occupied cell for points spread over the bounds
+            volume = np.prod(np.maximum(self.upper - self.lower, 1e-3))
+            cell_size = (volume * points_per_cell / max(len(self.points), 1)) ** (1 / 3)
+        self.cell_size = cell_size
+        self.dims = np.floor((self.upper - self.lower) / cell_size).astype(np.int64) + 1
+
+        keys = self.cell_keys(self.cell_coords(self.points))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts = np.unique(keys[self.order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(self.order))
+
+    def cell_coords(self, points: NumpyTensor['n', 3]) -> NumpyTensor['n', 3]:
+        """
+        """
+        return np.clip(np.floor((points - self.lower) / self.cell_size).astype(np.int64), 0, self.dims - 1)
+
+    def cell_keys(self, coords: NumpyTensor['n', 3]) -> NumpyTensor['n']:
+        """
+        """
+        return (coords[..., 0] * self.dims[1] + coords[..., 1]) * self.dims[2] + coords[..., 2]
+
+    def query_box(self, lower: NumpyTensor[3], upper: NumpyTensor[3]) -> NumpyTensor['m']:
+        """
+        Returns ids of points in the cells overlapping [lower, upper], a superset of the points inside the box.
+        """
+        lower = np.maximum(lower, self.lower)
+        upper = np.minimum(upper, self.upper)
+        if len(self.points) == 0 or np.any(lower > upper):
+            return np.empty(0, dtype=np.int64)
+        c1, c2 = self.cell_coords(lower), self.cell_coords(upper)
+        if np.prod(c2 - c1 + 1) >= len(self.keys): # box covers most occupied cells, scanning is cheaper
+            return self.order
+        axes = [np.arange(c1[i], c2[i] + 1) for i in range(3)]
+        keys = self.cell_keys(np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3))
+        positions = np.searchsorted(self.keys, keys)
+        valid = positions < len(self.keys)
+        positions = positions[valid][self.keys[positions[valid]] == keys[valid]]
+        # concatenate the ranges [starts, ends) of the occupied cells without a python loop
+        lengths = self.ends[positions] - self.starts[positions]
+        offsets = np.repeat(self.starts[positions] - np.cumsum(lengths) + lengths, lengths)
+        return self.order[offsets + np.arange(lengths.sum())]
+
+
+class InstanceIndex:
+    """
+    Spatial index over axis-aligned bounding boxes of 3D instances, answering containment and intersection queries in
+    time proportional to the number of nearby instances.
+    """
+    def __init__(self, bboxes: NumpyTensor['n', 2, 3], cell_size: float = None):
+        """
+        """
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 2, 3)
+        self.centers = self.bboxes.mean(axis=1)
+        self.extents = (self.bboxes[:, 1] - self.bboxes[:, 0]) / 2
+        self.max_extent = self.extents.max(axis=0) if len(self.bboxes) else np.zeros(3)
+        self.bounds = np.zeros((2, 3)) # box around all instances
+        if len(self.bboxes):
+            self.bounds = np.stack([self.bboxes[:, 0].min(axis=0), self.bboxes[:, 1].max(axis=0)])
+        self.grid = UniformGrid(self.centers, cell_size=cell_size)
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.bboxes)
+
+    def contained(self, point1: NumpyTensor[3], point2: NumpyTensor[3], mode='center') -> NumpyTensor['m']:
+        """
+        Returns sorted ids of instances inside the box [point1, point2], either by their center or by their whole box.
+        """
+        lower, upper = np.minimum(point1, point2), np.maximum(point1, point2)
+        ids = self.grid.query_box(lower, upper)
+        if mode == 'center':
+            inside = np.all((self.centers[ids] >= lower) & (self.centers[ids] <= upper), axis=1)
+        else:
+            inside = np.all((self.bboxes[ids, 0] >= lower) & (self.bboxes[ids, 1] <= upper), axis=1)
+        return np.sort(ids[inside])
+
+    def intersecting(self, point1: NumpyTensor[3], point2: NumpyTensor[3]) -> NumpyTensor['m']:
+        """
+        Returns sorted ids of instances whose box intersects the box [point1, point2].
+        """
+        lower, upper = np.minimum(point1, point2), np.maximum(point1, point2)
+        # centers of intersecting boxes lie within the query box grown by the largest instance half extent
+        ids = self.grid.query_box(lower - self.max_extent, upper + self.max_extent)
+        overlap = np.all((self.bboxes[ids, 0] <= upper) & (self.bboxes[ids, 1] >= lower), axis=1)
+        return np.sort(ids[overlap])
+
+
+class ViewIndex:
+    """
+    Index over the camera poses of a sequence for picking the frames that best match requested (camera, target) views,
+    preferring frames facing the target over frames that are merely nearby. Per frame terms of the score are precomputed,
+    so scoring all frames for a batch of queries reduces to a few matrix products.
+    """
+    def __init__(
+        self,
+        poses: NumpyTensor['n', 4, 4],
+        intrinsics: NumpyTensor[3, 3],
+        image_size: tuple[int, int],
+        max_angle=45,
+        distance_weight=1.0,
+        direction_weight=0.5,
+    ):
+        """
+        """
+        self.centers = poses[:, :3, 3].astype(np.float64)
+        self.directions = poses[:, :3, 2].astype(np.float64) # optical axis (OpenCV convention)
+        self.directions /= np.linalg.norm(self.directions, axis=1, keepdims=True)
+        self.cos_max_angle = np.cos(np.radians(max_angle))
+        self.distance_weight = distance_weight
+        self.direction_weight = direction_weight
+
+        # per frame visibility cone: cosine of the angle between the optical axis and the nearest image border
+        H, W = image_size
+        half_fov = min(np.arctan(W / 2 / intrinsics[0, 0]), np.arctan(H / 2 / intrinsics[1, 1]))
+        self.cos_fov = np.full(len(self.centers), np.cos(half_fov))
+        # expansions of d . (x - c) and |x - c|^2 into products with the query point x
+        self.direction_offsets = np.sum(self.directions * self.centers, axis=1)
+        self.center_norms = np.sum(self.centers ** 2, axis=1)
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.centers)
+
+    def distances(self, points: NumpyTensor['q', 3]) -> NumpyTensor['q', 'n']:
+        """
+        """
+        squared = np.sum(points ** 2, axis=1)[:, None] - 2 * points @ self.centers.T + self.center_norms
+        return np.sqrt(np.maximum(squared, 0))
+
+    def score(self, cameras: NumpyTensor['q', 3], targets: NumpyTensor['q', 3], facing=True) -> NumpyTensor['q', 'n']:
+        """
+        Scores how well each frame matches the view from each camera to its target: whether the target is inside the
+        frame's visibility cone, how aligned the view directions are, and how close the camera centers are. If `facing`,
+        frames more than `max_angle` away from facing the target score -inf.
+        """
+        cos_target = (targets @ self.directions.T - self.direction_offsets) / np.maximum(self.distances(targets), 1e-6)
+        visibility = np.clip((cos_target - self.cos_fov) / (1 - self.cos_fov), 0, 1)
+        views = targets - cameras
+        cos_view = (views / np.maximum(np.linalg.norm(views, axis=1, keepdims=True), 1e-6)) @ self.directions.T
+        scores = visibility + self.direction_weight * cos_view - self.distance_weight * self.distances(cameras)
+        if facing:
+            scores[cos_target < self.cos_max_angle] = -np.inf
+        return scores
+
+    def query(
+        self, cameras: NumpyTensor['q', 3], targets: NumpyTensor['q', 3], k=1, chunk_size=8
+    ) -> tuple[NumpyTensor['q', 'k'], NumpyTensor['q', 'k']]:
+        """
+        Returns the ids and scores of the `k` best matching frames for each (camera, target) query, best first, padded
+        with -1. Queries without a frame facing the target fall back to frames that are merely nearby.
+        """
+        cameras = np.asarray(cameras, dtype=np.float64).reshape(-1, 3)
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+        k = min(k, len(self))
+        ids = np.empty((len(cameras), k), dtype=np.int64)
+        best = np.empty((len(cameras), k))
+        for i in range(0, len(cameras), chunk_size):
+            chunk = slice(i, i + chunk_size)
+            scores = self.score(cameras[chunk], targets[chunk])
+            unseen = scores.max(axis=1) == -np.inf
+            if unseen.any():
+                scores[unseen] = self.score(cameras[chunk][unseen], targets[chunk][unseen], facing=False)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable'), axis=1)
+            ids[chunk], best[chunk] = top, np.take_along_axis(scores, top, axis=1)
+        return ids, best
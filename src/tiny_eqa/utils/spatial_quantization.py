@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+
+import torch
+
+from tiny_eqa.data.common import TorchTensor
+
+
+@dataclass
+class Regions:
+    """
+    Superpixel regions of a batch of images, indexed contiguously across the batch.
+    """
+
+    """ Mean feature of each region. """
+    features: TorchTensor['R', 'dim']
+    """ Number of pixels in each region. """
+    counts: TorchTensor['R']
+    """ Batch index of each region. """
+    batch: TorchTensor['R']
+    """ Superpixel label of each region in its image. """
+    labels: TorchTensor['R']
+    """ Pairs (i, j), i < j, of regions sharing a pixel boundary. """
+    adjacency: TorchTensor['E', 2]
+    """ Region index of each pixel. """
+    assignment: TorchTensor['batch', 'H', 'W']
+
+    def __len__(self) -> int:
+        """
+        """
+        return len(self.features)
+
+    def unpool(self, values: TorchTensor['R']) -> TorchTensor['batch', 'H', 'W']:
+        """
+        Broadcasts per region values, e.g. text match scores, back to pixels.
+        """
+        return values[self.assignment]
+
+
+def region_adjacency(assignment: TorchTensor['batch', 'H', 'W'], num_regions: int) -> TorchTensor['E', 2]:
+    """
+    Returns unique pairs of regions that are 4-connected neighbors somewhere in the batch.
+    """
+    pairs = []
+    for a, b in [
+        (assignment[:, :, 1:], assignment[:, :, :-1]),
+        (assignment[:, 1:, :], assignment[:, :-1, :]),
+    ]:
+        boundary = a != b
+        pairs.append(torch.stack([a[boundary], b[boundary]], dim=-1))
+    pairs = torch.cat(pairs).sort(dim=-1).values
+    keys = torch.unique(pairs[:, 0] * num_regions + pairs[:, 1])
+    return torch.stack([keys // num_regions, keys % num_regions], dim=-1)
+
+
+def pool_superpixel_features(
+    features: TorchTensor['batch', 'h', 'w', 'dim'], labels: TorchTensor['batch', 'H', 'W'], normalize=True
+) -> Regions:
+    """
+    Pools patch features, e.g. from `DinoModel`, over superpixels, e.g. from SLIC, in a single sparse reduction.
+
+    Each pixel is assigned the feature of the patch it falls in (nearest upsampling). Rather than upsampling the features
+    to image resolution, pixels are counted per (region, patch) pair, and region features are the count weighted mean of
+    patch features, so the cost is independent of the feature dimension until the final sparse product.
+    """
+    B, h, w, dim = features.shape
+    _, H, W = labels.shape
+    device = features.device
+    labels = labels.to(device).long()
+
+    # contiguous region ids across the batch
+    batch_index = torch.arange(B, device=device).view(B, 1, 1)
+    keys = batch_index * (labels.max() + 1) + labels
+    unique_keys, assignment = torch.unique(keys, return_inverse=True)
+    R = len(unique_keys)
+
+    # patch index of each pixel
+    rows = (torch.arange(H, device=device) * h // H).view(1, H, 1)
+    cols = (torch.arange(W, device=device) * w // W).view(1, 1, W)
+    cells = (batch_index * h + rows) * w + cols
+
+    pairs, weights = torch.unique(assignment * (B * h * w) + cells, return_counts=True)
+    weights_matrix = torch.sparse_coo_tensor(
+        torch.stack([pairs // (B * h * w), pairs % (B * h * w)]), weights.to(features.dtype), size=(R, B * h * w), check_invariants=False,
+    )
+    counts = torch.bincount(assignment.flatten(), minlength=R)
+    region_features = torch.sparse.mm(weights_matrix, features.reshape(-1, dim)) / counts[:, None].to(features.dtype)
+    if normalize:
+        region_features = region_features / region_features.norm(dim=-1, keepdim=True)
+
+    return Regions(
+        features=region_features,
+        counts=counts,
+        batch=unique_keys // (labels.max() + 1),
+        labels=unique_keys % (labels.max() + 1),
+        adjacency=region_adjacency(assignment, R),
+        assignment=assignment,
+    )
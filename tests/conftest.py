@@ -0,0 +1,121 @@
+import zlib
+
+import pytest
+import torch
+from transformers import (
+    BertConfig, CLIPConfig, CLIPModel, CLIPVisionConfig, GroundingDinoConfig, GroundingDinoForObjectDetection, LlamaConfig,
+    LlavaConfig, LlavaForConditionalGeneration, SwinConfig,
+)
+
+from tiny_eqa.models.model_clip import ModelClip
+
+
+class HashTokenizer:
+    """
+    Offline stand-in for the LLaVA tokenizer, mapping words to ids by hash, with Llama's special token ids.
+    """
+    pad_token_id, bos_token_id, eos_token_id = 0, 1, 2
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+
+    def __call__(self, text: str, add_special_tokens=False) -> dict:
+        return {'input_ids': [4 + zlib.crc32(word.encode()) % (self.vocab_size - 4) for word in text.split()]}
+
+    def decode(self, ids: list[int], skip_special_tokens=True) -> str:
+        return ' '.join(f'w{i}' for i in ids if not (skip_special_tokens and i < 4))
+
+
+@pytest.fixture(scope='session')
+def llava() -> LlavaForConditionalGeneration:
+    """
+    Randomly initialized LLaVA with a small CLIP vision tower (16 vision tokens) and Llama language model.
+    """
+    torch.manual_seed(0)
+    config = LlavaConfig(
+        vision_config=CLIPVisionConfig(
+            image_size=56, patch_size=14, hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+        ),
+        text_config=LlamaConfig(
+            vocab_size=512, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+            num_key_value_heads=2, max_position_embeddings=1024, pad_token_id=0, bos_token_id=1, eos_token_id=2,
+        ),
+        image_token_index=3,
+    )
+    return LlavaForConditionalGeneration(config).eval()
+
+
+@pytest.fixture
+def llava_tokenizer(llava) -> HashTokenizer:
+    return HashTokenizer(llava.config.text_config.vocab_size)
+
+
+class ClipHashTokenizer:
+    """
+    Offline stand-in for the CLIP tokenizer, mapping words to ids by hash and ending each text with eos.
+    """
+    def __call__(self, texts: list[str], padding=True, return_tensors='pt') -> dict:
+        ids = [[0] + [2 + zlib.crc32(word.encode()) % 254 for word in text.split()] + [1] for text in texts]
+        length = max(len(x) for x in ids)
+        return {
+            'input_ids': torch.tensor([x + [1] * (length - len(x)) for x in ids]),
+            'attention_mask': torch.tensor([[1] * len(x) + [0] * (length - len(x)) for x in ids]),
+        }
+
+
+@pytest.fixture(scope='session')
+def clip_model() -> CLIPModel:
+    """
+    Randomly initialized CLIP with one layer encoders, 32x32 images and 16 dimensional embeddings.
+    """
+    torch.manual_seed(0)
+    layers = dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2)
+    config = CLIPConfig(
+        text_config=dict(vocab_size=256, max_position_embeddings=32, bos_token_id=0, eos_token_id=1, pad_token_id=1, **layers),
+        vision_config=dict(image_size=32, patch_size=16, **layers),
+        projection_dim=16,
+    )
+    return CLIPModel(config).eval()
+
+
+@pytest.fixture
+def clip(clip_model) -> ModelClip:
+    return ModelClip(model=clip_model, tokenizer=ClipHashTokenizer())
+
+
+class BertHashTokenizer:
+    """
+    Offline stand-in for the BERT tokenizer of Grounding DINO, with its special token ids and words hashed to ids.
+    """
+    cls_token_id, sep_token_id = 101, 102
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        return {'.': 1012, '?': 1029}[token]
+
+    def __call__(self, texts: list[str], add_special_tokens=False) -> dict:
+        return {'input_ids': [[2000 + zlib.crc32(word.encode()) % (self.vocab_size - 2000) for word in text.split()] for text in texts]}
+
+
+@pytest.fixture(scope='session')
+def grounding_dino() -> GroundingDinoForObjectDetection:
+    """
+    Randomly initialized Grounding DINO with a small Swin backbone, BERT text encoder and fusion transformer.
+    """
+    torch.manual_seed(0)
+    config = GroundingDinoConfig(
+        backbone_config=SwinConfig(
+            embed_dim=32, depths=[1, 1, 2, 1], num_heads=[1, 2, 4, 8], out_features=['stage2', 'stage3', 'stage4'],
+        ),
+        text_config=BertConfig(vocab_size=4096, hidden_size=64, num_hidden_layers=1, num_attention_heads=4, intermediate_size=128),
+        d_model=64, num_queries=100, encoder_layers=1, decoder_layers=2, encoder_ffn_dim=128, decoder_ffn_dim=128,
+        encoder_attention_heads=4, decoder_attention_heads=4,
+    )
+    return GroundingDinoForObjectDetection(config).eval()
+
+
+@pytest.fixture
+def grounding_dino_tokenizer(grounding_dino) -> BertHashTokenizer:
+    return BertHashTokenizer(grounding_dino.config.text_config.vocab_size)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from tiny_eqa.agents.embedding_index import IVFConfig, kmeans
+from tiny_eqa.agents.scene_cache import EmbeddingDatabase
+
+
+def clustered(n: int, dim=32, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((20, dim), dtype=np.float32)
+    return centers[rng.integers(len(centers), size=n)] + 0.3 * rng.standard_normal((n, dim), dtype=np.float32)
+
+
+def ivf_database(data: np.ndarray, **kwargs) -> EmbeddingDatabase:
+    database = EmbeddingDatabase(backend='ivf', ivf=IVFConfig(num_lists=16, min_train=500, **kwargs))
+    for batch in np.array_split(data, 4):
+        database.add(batch, [None] * len(batch))
+    assert database.index.trained
+    return database
+
+
+def test_spherical_kmeans_centroids_are_normalized():
+    data = clustered(500)
+    centroids = kmeans(data / np.linalg.norm(data, axis=1, keepdims=True), 8, iterations=5, spherical=True)
+    assert np.allclose(np.linalg.norm(centroids, axis=1), 1, atol=1e-5)
+
+
+def test_lists_agree_with_euclidean_and_cosine_assignment():
+    data = clustered(1000)
+    database = ivf_database(data)
+    index, embeddings = database.index, database.embeddings[:database.size]
+    distances = np.linalg.norm(embeddings[:, None] - index.centroids[None], axis=-1)
+    for i, inverted_list in enumerate(index.lists):
+        ids = inverted_list.view()
+        assert (np.argmax(embeddings[ids] @ index.centroids.T, axis=1) == i).all()
+        assert (np.argmin(distances[ids], axis=1) == i).all()
+
+
+@pytest.mark.parametrize('pq_subspaces', [0, 8])
+def test_entries_are_found_in_their_probed_list(pq_subspaces):
+    data = clustered(1000)
+    database = ivf_database(data, pq_subspaces=pq_subspaces)
+    # an entry is probed by the list it was assigned to, so it finds itself with a single probe
+    _, ids = database.search(data, k=1, nprobe=1)
+    assert np.array_equal(ids[:, 0], np.arange(len(data)))
+
+
+@pytest.mark.parametrize('pq_subspaces', [0, 8])
+def test_probing_every_list_is_exact(pq_subspaces):
+    data, queries = clustered(1000), clustered(20, seed=1)
+    database = ivf_database(data, pq_subspaces=pq_subspaces, rerank=len(data))
+    exact_scores, exact_ids = database.search(queries, k=5, exact=True)
+    scores, ids = database.search(queries, k=5, nprobe=16)
+    assert np.array_equal(ids, exact_ids)
+    assert np.allclose(scores, exact_scores, atol=1e-5)
+
+
+@pytest.mark.parametrize('pq_subspaces', [0, 8])
+def test_batched_search_matches_single_queries(pq_subspaces):
+    data, queries = clustered(1000), clustered(20, seed=1)
+    database = ivf_database(data, pq_subspaces=pq_subspaces)
+    scores, ids = database.search(queries, k=5, nprobe=3)
+    for query, query_scores, query_ids in zip(queries, scores, ids):
+        single_scores, single_ids = database.search(query, k=5, nprobe=3)
+        assert np.array_equal(single_ids[0], query_ids)
+        assert np.allclose(single_scores[0], query_scores, atol=1e-5)
+
+
+def test_remove_compact_and_reload(tmp_path):
+    data = clustered(1000)
+    database = ivf_database(data, pq_subspaces=8)
+    database.remove(np.arange(0, 1000, 2))
+    mapping = database.compact()
+    _, ids = database.search(data[1::2], k=1, nprobe=16)
+    assert np.array_equal(ids[:, 0], mapping[1::2])
+
+    database.save(tmp_path)
+    loaded = EmbeddingDatabase.load(tmp_path)
+    assert loaded.index.trained and loaded.index.config == database.index.config
+    assert np.array_equal(loaded.search(data[1::2], k=3)[1], database.search(data[1::2], k=3)[1])
+
+
+def test_untrained_database_reloads_as_ivf(tmp_path):
+    data = clustered(600)
+    database = EmbeddingDatabase(backend='ivf', ivf=IVFConfig(num_lists=16, min_train=500))
+    database.add(data[:300], [None] * 300)
+    database.save(tmp_path)
+    loaded = EmbeddingDatabase.load(tmp_path, mmap=False)
+    assert loaded.backend == 'ivf' and not loaded.index.trained and loaded.index.config == database.index.config
+    loaded.add(data[300:], [None] * 300) # trains once min_train entries exist, as before saving
+    assert loaded.index.trained
+
+
+def test_fewer_candidates_than_k():
+    data = clustered(600)
+    database = ivf_database(data)
+    database.remove(np.arange(600))
+    scores, ids = database.search(data[:2], k=3, nprobe=16)
+    assert (ids == -1).all() and np.isinf(scores).all()
@@ -0,0 +1,33 @@
+import torch
+
+from tiny_eqa.utils.geometry import InstanceVoxels, lift_masks, voxel_keys
+
+
+def test_lift_masks_votes_instances():
+    # a fronto-parallel plane at 2m seen by a camera at the origin, pixel (u, v) back-projects to (u - 2.5, v - 1.5, 2)
+    depth = torch.full((1, 4, 6), 2.0)
+    depth[0, 3] = 0 # invalid depth is ignored
+    intrinsics = torch.tensor([[[2.0, 0, 3], [0, 2, 2], [0, 0, 1]]])
+    poses = torch.eye(4)[None]
+    v, u = torch.meshgrid(torch.arange(4.0), torch.arange(6.0), indexing='ij')
+    points = torch.stack([u - 2.5, v - 1.5, torch.full_like(u, 2)], dim=-1).reshape(-1, 3)
+    scene = InstanceVoxels.from_points(points, torch.where(points[:, 0] < 0, 3, 7), voxel_size=0.5)
+
+    masks = torch.full((1, 4, 6), -1)
+    masks[0, :, :2] = 0 # columns of instance 3
+    masks[0, :, 2:] = 1 # one column of instance 3 and three of instance 7
+    instances, shares = lift_masks(depth, intrinsics, poses, masks, scene)
+    assert instances.tolist() == [3, 7]
+    assert torch.allclose(shares, torch.tensor([1.0, 0.75]))
+
+    masks[0] = -1
+    masks[0, 3] = 0 # only pixels without depth
+    instances, shares = lift_masks(depth, intrinsics, poses, masks, scene, num_masks=2)
+    assert instances.tolist() == [-1, -1] and shares.tolist() == [0, 0]
+
+
+def test_instance_voxels_from_boxes_prefer_smaller_boxes():
+    bboxes = torch.tensor([[[0.0, 0, 0], [2, 2, 1]], [[0.5, 0.5, 0.5], [1, 1, 1]]])
+    scene = InstanceVoxels.from_boxes(bboxes, voxel_size=0.25)
+    points = torch.tensor([[0.7, 0.7, 0.7], [1.5, 1.5, 0.2], [3.0, 3.0, 3.0]])
+    assert scene.lookup(voxel_keys(points, 0.25)).tolist() == [1, 0, -1]
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from tiny_eqa.data.keyframes import KeyframeConfig, select_keyframes
+from tiny_eqa.data.sequence import FrameSequence
+from tiny_eqa.data.sequence_reader import FrameSequenceReader
+from tiny_eqa.data.synthetic import intrinsics_from_fov, look_at, render_room
+
+
+class RoomReader(FrameSequenceReader):
+    """
+    Frames of the synthetic room rendered on demand at the given poses, counting the decoded images and depths.
+    """
+    def __init__(self, poses: np.ndarray, size=(24, 32)):
+        super().__init__()
+        self.poses = np.asarray(poses)
+        self.size = size
+        self.intrinsics = self.intrinsics_depth = intrinsics_from_fov(size)
+        self.image_size = size
+        self.reads = {'image': 0, 'depth': 0}
+
+    def __len__(self) -> int:
+        return len(self.poses)
+
+    def read_image(self, index: int) -> np.ndarray:
+        self.reads['image'] += 1
+        return render_room(self.poses[index], self.intrinsics, self.size)[0]
+
+    def read_depth(self, index: int) -> np.ndarray:
+        self.reads['depth'] += 1
+        return render_room(self.poses[index], self.intrinsics_depth, self.size)[1]
+
+
+EYE = np.array([3.0, 2.5, 1.5])
+
+POSES = np.stack([
+    look_at(EYE, [6, 2.5, 1.5]), # keyframe
+    look_at(EYE + [0.01, 0, 0], [6, 2.5, 1.5]), # 1cm away, pruned from its pose alone
+    look_at(EYE + [0.5, 0, 0], [6, 2.5, 1.5]), # 0.5m closer to the same wall, inside the first frustum
+    look_at(EYE, [0, 2.5, 1.5]), # facing the opposite wall, no overlap
+    np.full((4, 4), -np.inf), # failed tracking
+])
+
+
+def test_pose_overlap_and_hash_pruning():
+    reader = RoomReader(POSES)
+    any_hash = KeyframeConfig(max_hash_distance=64)
+    assert select_keyframes(FrameSequence(reader), any_hash).tolist() == [0, 3]
+    # the pruned pose is never decoded, the closer view is read for overlap and hash, the opposite one only for overlap
+    assert reader.reads == {'depth': 2, 'image': 2}
+
+    assert select_keyframes(FrameSequence(reader), KeyframeConfig(max_hash_distance=-1)).tolist() == [0, 2, 3]
+    assert select_keyframes(FrameSequence(reader), KeyframeConfig(max_overlap=1.0, max_hash_distance=64)).tolist() == [0, 2, 3]
+
+
+@pytest.mark.parametrize('window, expected', [(0, [0, 1, 2, 3, 5]), (1, [0, 3, 5]), (4, [0, 3])])
+def test_window(window, expected):
+    reader = RoomReader(np.concatenate([POSES, POSES[:1]])) # the first pose again, after the opposite view
+    config = KeyframeConfig(window=window, max_hash_distance=64)
+    assert select_keyframes(FrameSequence(reader), config).tolist() == expected
+
+
+def test_max_frames():
+    reader = RoomReader(POSES)
+    assert select_keyframes(FrameSequence(reader), KeyframeConfig(window=0, max_frames=2)).tolist() == [0, 3]
@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from tiny_eqa.utils.math import StreamingPCA, pca_fit, pca_transform, sign_flip
+
+
+def data(samples=300, dim=12, seed=0) -> torch.Tensor:
+    """
+    Samples with well separated variances along random orthogonal directions, offset from the origin.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    rotation, _ = torch.linalg.qr(torch.randn(dim, dim, generator=generator, dtype=torch.float64))
+    scales = 2.0 ** -torch.arange(dim, dtype=torch.float64)
+    return (torch.randn(samples, dim, generator=generator, dtype=torch.float64) * scales) @ rotation.T + 3
+
+
+def svd_reference(tensor: torch.Tensor, n: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the top `n` components (sign flipped like the library) and explained variances of a full SVD.
+    """
+    centered = tensor - tensor.mean(dim=0)
+    _, S, Vh = torch.linalg.svd(centered, full_matrices=False)
+    return sign_flip(Vh[:n]), S[:n] ** 2 / len(tensor)
+
+
+def test_pca_fit_matches_svd():
+    tensor = data()
+    components, variances = svd_reference(tensor, 3)
+    basis = pca_fit(tensor, 3)
+    assert torch.allclose(basis.components.double(), components, atol=1e-4)
+    projections = basis.transform(tensor.float()).double()
+    assert torch.allclose(projections.var(dim=0, unbiased=False), variances, rtol=1e-3)
+    assert torch.allclose(projections, (tensor - tensor.mean(dim=0)) @ components.T, atol=1e-3)
+
+
+def test_streaming_pca_over_chunks_matches_pca_fit():
+    tensor = data()
+    pca = StreamingPCA(tensor.shape[1])
+    for chunk in tensor.split(64): # uneven last chunk
+        pca.partial_fit(chunk)
+    streamed, fitted = pca.basis(3), pca_fit(tensor, 3)
+    assert torch.allclose(streamed.mean, fitted.mean, atol=1e-5)
+    assert torch.allclose(streamed.components, fitted.components, atol=1e-4)
+    assert torch.allclose(streamed.components.double(), svd_reference(tensor, 3)[0], atol=1e-4)
+
+
+def test_pca_transform_keeps_the_input_type():
+    tensor = data().float()
+    projected = pca_transform(tensor.numpy(), 2)
+    assert isinstance(projected, np.ndarray) and projected.shape == (len(tensor), 2)
+    assert np.allclose(projected, pca_transform(tensor, 2).numpy(), atol=1e-5)
+    components, _ = svd_reference(tensor.double(), 2)
+    assert np.allclose(projected, ((tensor.double() - tensor.double().mean(dim=0)) @ components.T).numpy(), atol=1e-3)
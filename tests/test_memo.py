@@ -0,0 +1,85 @@
+import pytest
+
+from tiny_eqa.agents import scene_patch_functions
+from tiny_eqa.agents.agent import Program
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.agents.memo import ProgramMemo
+from tiny_eqa.data.sequence_reader import read_scannet_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet, write_synthetic_scannet_instances
+
+
+class CountingLlava:
+    """
+    Stand-in for ModelLlava answering 'yes' to every question, counting its calls.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def answer_frames(self, frames, questions: list[str]) -> list[str]:
+        self.calls += 1
+        return ['Yes.'] * len(questions)
+
+
+def write_scene(path):
+    write_synthetic_scannet(path, num_frames=8, image_size=(48, 64), depth_size=(24, 32))
+    write_synthetic_scannet_instances(path, [[[0.5, 0.5, 0.0], [5.5, 4.5, 2.5]]], ['cabinet']) # seen by all frames
+    return read_scannet_sequence(path)
+
+
+@pytest.fixture
+def scenes(tmp_path, monkeypatch):
+    monkeypatch.setattr(scene_patch_functions, 'SCENE_FIND_LABELS', True)
+    return write_scene(tmp_path / 'a'), write_scene(tmp_path / 'b')
+
+
+def execute(memo: ProgramMemo, code: str, sequence):
+    program = Program(code)
+    return memo.run(sequence, program.canonical, lambda: program.execute_command(sequence))
+
+
+FIND = '''
+def execute_command(scene):
+    cabinets = ScenePatch(scene).find('cabinet')
+    return len(cabinets)
+'''
+
+FIND_RENAMED = '''
+def execute_command(room):
+    # the same program with other names and formatting
+    found   =   ScenePatch( room ).find( "cabinet" )
+
+    return len(found)
+'''
+
+
+def test_renamed_and_reformatted_programs_share_an_entry(scenes):
+    memo = ProgramMemo()
+    assert execute(memo, FIND, scenes[0]) == execute(memo, FIND_RENAMED, scenes[0]) == 1
+    assert (memo.stats.program_misses, memo.stats.program_hits) == (1, 1)
+
+
+def test_scenes_do_not_share_entries(scenes):
+    memo = ProgramMemo()
+    for scene in scenes:
+        assert execute(memo, FIND, scene) == 1
+    assert (memo.stats.program_misses, memo.stats.program_hits) == (2, 0)
+    assert (memo.stats.call_misses, memo.stats.call_hits) == (2, 0)
+    assert len(memo.programs) == len(memo.calls) == 2
+
+
+def test_calls_avoided_counts_model_calls_only(scenes):
+    model = CountingLlava()
+    register_model('ModelLlava', model)
+    memo = ProgramMemo()
+    ask = "def execute_command(scene):\n    return ScenePatch(scene).simple_qa('What is it?')\n"
+    ask_find = "def execute_command(scene):\n    return len(ScenePatch(scene).find('cabinet')), ScenePatch(scene).simple_qa('What is it?')\n"
+    find = "def execute_command(scene):\n    return len(ScenePatch(scene).find('cabinet')) + 1\n"
+
+    execute(memo, ask, scenes[0])
+    assert model.calls == 1 and memo.stats.calls_avoided == 0
+    execute(memo, ask, scenes[0]) # the program hit avoids its model call
+    assert model.calls == 1 and memo.stats.calls_avoided == 1
+    execute(memo, ask_find, scenes[0]) # the simple_qa call hit avoids its model call
+    assert model.calls == 1 and memo.stats.call_hits == 1 and memo.stats.calls_avoided == 2
+    execute(memo, find, scenes[0]) # the find call hit matches labels, without a model call to avoid
+    assert memo.stats.call_hits == 2 and memo.stats.calls_avoided == 2
@@ -0,0 +1,41 @@
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from tiny_eqa.models.model_clip import ModelClip, ModelClipConfig
+
+
+def crops(n: int) -> list[np.ndarray]:
+    return [np.random.default_rng(i).integers(0, 256, (20 + i, 30, 3), dtype=np.uint8) for i in range(n)]
+
+
+@contextmanager
+def count_forwards(module: torch.nn.Module):
+    forwards = []
+    handle = module.register_forward_hook(lambda *_: forwards.append(1))
+    try:
+        yield forwards
+    finally:
+        handle.remove()
+
+
+def test_match_is_the_diagonal_of_the_score_matrix(clip):
+    texts = ['a red chair', 'an open door', 'a red chair']
+    scores = clip(crops(3), texts)
+    assert scores.shape == (3, 3) and torch.all((0 <= scores) & (scores <= 1))
+    assert torch.allclose(clip.match(crops(3), texts), torch.diagonal(scores))
+
+
+def test_text_cache_hits_skip_the_text_encoder(clip_model, clip):
+    with count_forwards(clip_model.text_model) as forwards:
+        first = clip.encode_texts(['a red chair', 'an open door'])
+        assert len(forwards) == 1
+        clip.match(crops(4), ['an open door', 'a red chair', 'a red chair', 'an open door'])
+        assert len(forwards) == 1
+        assert torch.equal(clip.encode_texts(['an open door', 'a lamp'])[0], first[1])
+        assert len(forwards) == 2 and len(clip.text_cache) == 3
+
+    small = ModelClip(ModelClipConfig(text_cache_size=2), model=clip_model, tokenizer=clip.tokenizer)
+    small.encode_texts(['a', 'b', 'c'])
+    assert list(small.text_cache) == ['b', 'c']
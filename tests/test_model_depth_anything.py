@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.agents.image_patch import ImagePatch
+from tiny_eqa.agents.image_patch_functions import image_set_sensor_depth
+from tiny_eqa.models.model_depth_anything import DepthMap, ModelDepthAnything, ModelDepthAnythingConfig, image_to_depth
+
+
+class ConstantDepth(nn.Module):
+    """
+    Stand-in for Depth Anything predicting the mean intensity of each frame as its depth, counting frames.
+    """
+    def __init__(self):
+        super().__init__()
+        self.frames = 0
+
+    def forward(self, pixel_values: torch.Tensor) -> SimpleNamespace:
+        self.frames += len(pixel_values)
+        depth = pixel_values.mean(dim=(1, 2, 3))[:, None, None].expand(-1, *pixel_values.shape[-2:])
+        return SimpleNamespace(predicted_depth=depth.abs() + 1)
+
+
+# color and depth cameras with different fields of view and principal points
+INTRINSICS = np.array([[1170, 0, 648], [0, 1170, 484], [0, 0, 1]], dtype=np.float32)
+INTRINSICS_DEPTH = np.array([[500, 0, 300], [0, 500, 260], [0, 0, 1]], dtype=np.float32)
+
+
+def test_crops_map_through_intrinsics():
+    depth = np.ones((480, 640), dtype=np.float32)
+    transform = image_to_depth(INTRINSICS, INTRINSICS_DEPTH)
+    depth_map = DepthMap(depth, (968, 1296), transform=transform)
+    point1, point2 = np.array([300.0, 200.0]), np.array([700.0, 600.0])
+    crop = depth_map.crop(point1, point2)
+    expected = [INTRINSICS_DEPTH @ np.linalg.inv(INTRINSICS) @ [*point, 1] for point in [point1, point2]]
+    assert crop.bounds == (*np.floor(expected[0][:2]).astype(int), *np.ceil(expected[1][:2]).astype(int))
+    assert crop.bounds != DepthMap(depth, (968, 1296)).crop(point1, point2).bounds # not the resolution ratio
+
+
+
+@pytest.mark.parametrize('shape, stride, dtype', [((480, 640), 4, np.uint16), ((300, 300), 1, np.uint32)])
+def test_median_table_matches_sampled_median(shape, stride, dtype):
+    depth = np.random.default_rng(0).uniform(0.5, 5, shape).astype(np.float32)
+    depth[:50] = 0 # invalid pixels are ignored
+    depth_map = DepthMap(depth, shape, stride=stride)
+    assert depth_map.table.dtype == dtype # uint16 unless there are more samples than it counts
+    bin_width = depth_map.edges[1] - depth_map.edges[0]
+    for x1, y1, x2, y2 in [(0, 0, shape[1], shape[0]), (13, 30, 250, 201), (100, 100, 101, 101)]:
+        samples = depth[-(-y1 // stride) * stride:y2:stride, -(-x1 // stride) * stride:x2:stride]
+        samples = samples[samples > 0]
+        assert abs(depth_map.median(x1, y1, x2, y2) - np.median(samples)) <= bin_width
+    assert np.isnan(depth_map.median(0, 0, 40, 40))
+
+def test_sensor_depth_of_patches_uses_intrinsics():
+    engine = ModelDepthAnything(model=ConstantDepth())
+    register_model('ModelDepthAnything', engine)
+    image = np.zeros((968, 1296, 3), dtype=np.uint8)
+    depth = np.full((480, 640), 2.0, dtype=np.float32)
+    depth[:, 400:] = 5.0 # beyond x = 648 + 1170 / 500 * (400 - 300) = 882 in the image, or 810 by the resolution ratio
+    image_set_sensor_depth(image, depth, INTRINSICS, INTRINSICS_DEPTH)
+    assert ImagePatch(image).crop([820, 400], [870, 500]).depth() == pytest.approx(2.0, abs=0.05)
+    assert ImagePatch(image).crop([900, 400], [1000, 500]).depth() == pytest.approx(5.0, abs=0.05)
+    assert engine.stats.sensor == 1 and engine.model.frames == 0
+
+
+def test_frames_decoded_again_hit_the_cache():
+    model = ConstantDepth()
+    engine = ModelDepthAnything(ModelDepthAnythingConfig(image_size=28), model=model)
+    images = [np.full((30, 40, 3), i * 50, dtype=np.uint8) for i in range(3)]
+    first = engine.depth_maps(images)
+    second = engine.depth_maps([image.copy() for image in images[::-1]])
+    assert model.frames == 3
+    assert all(a is b for a, b in zip(first, second[::-1]))
+    assert (engine.stats.hits, engine.stats.misses) == (3, 3)
+    assert len(engine.keys) == 3 # hashes of freed copies are dropped
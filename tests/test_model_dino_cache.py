@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from tiny_eqa.models.model_dino import DinoModel, DinoModelConfig
+from tiny_eqa.models.model_dino_cache import CachedDinoModel, DinoFeatureCache, DinoFeatureCacheConfig, hash_image
+
+
+class PatchEmbed(nn.Module):
+    """
+    Stand-in for a dinov2 backbone, counting the frames it extracts.
+    """
+    def __init__(self, dim=8):
+        super().__init__()
+        self.conv = nn.Conv2d(3, dim, kernel_size=DinoModelConfig.PATCH_SIZE, stride=DinoModelConfig.PATCH_SIZE)
+        self.frames = 0
+
+    def forward_features(self, image: torch.Tensor) -> dict:
+        self.frames += len(image)
+        return {'x_norm_patchtokens': self.conv(image).flatten(2).transpose(1, 2)}
+
+
+def features(seed: int, shape=(4, 5, 8)) -> torch.Tensor:
+    return torch.randn(shape, generator=torch.Generator().manual_seed(seed))
+
+
+def disk_bytes(cache: DinoFeatureCache) -> int:
+    return sum(cache.filename(chunk).stat().st_size for chunk in cache.chunks)
+
+
+def test_hash_image_raw_pixels():
+    image = np.random.default_rng(0).integers(0, 256, (6, 7, 3), dtype=np.uint8)
+    assert hash_image(image) == hash_image(torch.from_numpy(image).permute(2, 0, 1))
+    assert hash_image(image) != hash_image(image[::-1])
+    assert hash_image(image) != hash_image(image.astype(np.float32))
+
+
+def test_put_get_persists(tmp_path):
+    with DinoFeatureCache(tmp_path) as cache:
+        cache.put('a', features(0))
+        cache.put('b', features(1))
+        assert cache.get('c') is None
+    cache = DinoFeatureCache(tmp_path, DinoFeatureCacheConfig(hot_size=0))
+    assert len(cache) == 2
+    assert torch.equal(cache.get('b'), features(1).half())
+    assert cache.nbytes == disk_bytes(cache)
+    assert (cache.stats.hits, cache.stats.misses) == (1, 0)
+
+
+def test_evicts_least_recently_used_chunks(tmp_path):
+    entry = features(0).numel() * 2
+    cache = DinoFeatureCache(tmp_path, DinoFeatureCacheConfig(max_bytes=4 * entry, chunk_bytes=2 * entry))
+    for i in range(4):
+        cache.put(str(i), features(i))
+    cache.get('0') # chunk of '0' and '1' becomes the most recently used
+    for i in range(4, 6):
+        cache.put(str(i), features(i))
+    assert set(cache.entries) == {'0', '1', '4', '5'}
+    assert cache.stats.evictions == 1
+    cache.flush()
+    assert cache.nbytes == disk_bytes(cache) <= 4 * entry
+
+
+def test_validate_invalidates_changed_options(tmp_path):
+    config = DinoModelConfig(backbone='dinov2_vits14')
+    with DinoFeatureCache(tmp_path) as cache:
+        cache.validate(config)
+        cache.put(cache.key('frame', config), features(0))
+    with DinoFeatureCache(tmp_path) as cache:
+        cache.validate(DinoModelConfig(backbone='dinov2_vits14', dtype='bfloat16'))
+        assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_cached_model_extracts_misses_only(tmp_path):
+    backbone = PatchEmbed()
+    model = DinoModel(DinoModelConfig(downsample=1, batch_size=2), device='cpu', model=backbone)
+    images = [np.random.default_rng(i).integers(0, 256, (28, 42, 3), dtype=np.uint8) for i in range(3)]
+    with DinoFeatureCache(tmp_path) as cache:
+        first = CachedDinoModel(model, cache).extract_sequence(images[:2])
+    with DinoFeatureCache(tmp_path) as cache:
+        second = CachedDinoModel(model, cache).extract_sequence(images)
+    assert backbone.frames == 3
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+    assert second[2].shape == (2, 3, 8) and second[2].dtype == torch.float16
+
+
+def test_prefetch_matches_inline_extraction():
+    backbone = PatchEmbed()
+    images = [np.random.default_rng(i).integers(0, 256, (28, 14 * (2 + i % 2), 3), dtype=np.uint8) for i in range(5)]
+    inline = DinoModel(DinoModelConfig(downsample=1, batch_size=2), device='cpu', model=backbone)
+    prefetch = DinoModel(DinoModelConfig(downsample=1, batch_size=2, prefetch=True), device='cpu', model=backbone)
+    assert all(torch.equal(a, b) for a, b in zip(inline.extract_sequence(images), prefetch.extract_sequence(images)))
+
+    def broken():
+        yield images[0]
+        raise ValueError('unreadable frame')
+    with pytest.raises(ValueError, match='unreadable'):
+        prefetch.extract_sequence(broken())
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from openai import RateLimitError
+from openai.types.chat import ChatCompletion
+from PIL import Image
+
+from tiny_eqa.models.model_gpt import (
+    Conversation, HistoryPolicy, ImageEncoder, ImageEncoderConfig, ModelGpt, ModelGptAsync, ModelGptAsyncConfig,
+    ModelGptInput, estimate_tokens, image_tokens,
+)
+
+
+@pytest.mark.parametrize('max_tokens', [None, 255, 425, 765, 1105])
+@pytest.mark.parametrize('size', [(1, 1), (640, 480), (1296, 968), (4000, 300), (50, 3000)])
+def test_target_size_within_tokens(size, max_tokens):
+    encoder = ImageEncoder(ImageEncoderConfig(max_tokens=max_tokens))
+    width, height = encoder.target_size(*size)
+    assert encoder.detail is None
+    assert 1 <= width <= max(size) and 1 <= height <= max(size)
+    if max_tokens is not None:
+        assert image_tokens(width, height) <= max_tokens
+
+
+@pytest.mark.parametrize('max_tokens', [85, 100, 254])
+def test_small_budgets_use_low_detail(max_tokens):
+    encoder = ImageEncoder(ImageEncoderConfig(max_tokens=max_tokens))
+    assert encoder.target_size(1296, 968) == (512, 382)
+    assert encoder.target_size(100, 80) == (100, 80)
+    input = ModelGptInput(encoder=encoder)
+    input.append(Image.new('RGB', (64, 48)))
+    assert input.content[0]['image_url']['detail'] == 'low'
+
+
+def test_rejects_budgets_below_low_detail():
+    with pytest.raises(AssertionError):
+        ImageEncoder(ImageEncoderConfig(max_tokens=84))
+
+
+@pytest.mark.parametrize('strategy', ['truncate', 'summarize'])
+def test_history_stays_within_tokens(strategy):
+    policy = HistoryPolicy(strategy=strategy, max_tokens=1000, summary_tokens=200)
+    conversation = Conversation(system='API prompt', policy=policy)
+    question = [{'type': 'text', 'text': 'question ' * 40}]
+    for turn in range(500):
+        messages = conversation.request(question)
+        assert estimate_tokens(messages[:-1]) <= estimate_tokens(messages[:1]) + policy.max_tokens + policy.summary_tokens
+        conversation.record(question, f'answer {turn} ' + 'x' * 300)
+    assert conversation.start > 0
+    if strategy == 'summarize':
+        summary = messages[1]['content']
+        assert estimate_tokens([messages[1]]) <= policy.summary_tokens
+        assert summary.startswith('Summary of earlier turns:') and f'answer {conversation.start // 2 - 1} ' in summary
+
+
+
+def test_model_gpt_reset_is_a_deprecated_no_op(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    model = ModelGpt('gpt-4-turbo')
+    with pytest.warns(DeprecationWarning):
+        model.reset()
+    with pytest.raises(TypeError): # max_tokens was the second positional argument before conversations
+        model(ModelGptInput(), 256)
+    with pytest.raises(TypeError):
+        model(ModelGptInput(), model.conversation(), 256)
+
+class FlakyTransport:
+    """
+    Stand-in for the chat completions endpoint failing the first `failures` requests with a rate limit error and
+    `retry-after`, and answering the others with 100 tokens of usage. Records the requests in flight.
+    """
+    def __init__(self, failures=0, retry_after='0.2'):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.requests = 0
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def __call__(self, model: str, messages: list[dict], max_tokens: int) -> ChatCompletion:
+        self.requests += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.inflight -= 1
+        if self.requests <= self.failures:
+            response = SimpleNamespace(status_code=429, headers={'retry-after': self.retry_after}, request=None)
+            raise RateLimitError('Rate limit reached', response=response, body=None)
+        return ChatCompletion.model_validate({
+            'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': model,
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'ok'}}],
+            'usage': {'prompt_tokens': 90, 'completion_tokens': 10, 'total_tokens': 100},
+        })
+
+
+def ask(model: ModelGptAsync, count: int):
+    async def run():
+        inputs = [ModelGptInput([{'type': 'text', 'text': f'question {i}'}]) for i in range(count)]
+        return await model.batch(inputs, max_tokens=50)
+    return asyncio.run(run())
+
+
+def test_requests_stay_within_concurrency():
+    transport = FlakyTransport()
+    model = ModelGptAsync('gpt-4-turbo', ModelGptAsyncConfig(max_concurrency=3), transport=transport)
+    assert len(ask(model, 12)) == 12
+    assert transport.requests == 12 and transport.max_inflight == 3
+
+
+def test_retries_after_the_server_delay():
+    transport = FlakyTransport(failures=1, retry_after='0.2')
+    model = ModelGptAsync('gpt-4-turbo', ModelGptAsyncConfig(backoff_base=30), transport=transport)
+    start = time.monotonic()
+    ask(model, 1)
+    assert 0.2 <= time.monotonic() - start < 5 # the backoff would wait at least 15 seconds
+    assert transport.requests == 2 and model.retries == 1
+
+
+def test_token_bucket_charges_requests_once():
+    transport = FlakyTransport(failures=2, retry_after='0')
+    config = ModelGptAsyncConfig(max_retries=2, tokens_per_minute=600) # refills 10 tokens per second
+    model = ModelGptAsync('gpt-4-turbo', config, transport=transport)
+    ask(model, 1) # two failed attempts and the answer cost only its usage
+    assert 500 - 1 <= model.bucket.available <= 500 + 5
+
+    transport.failures, transport.requests = 3, 0
+    with pytest.raises(RateLimitError):
+        ask(model, 1) # failed requests cost nothing
+    assert model.bucket.available >= 600 - 1
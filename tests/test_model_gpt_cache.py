@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from tiny_eqa.models import model_gpt_cache
+from tiny_eqa.models.model_gpt import ModelGptAsync, ModelGptInput
+from tiny_eqa.models.model_gpt_cache import GptResponseCache, GptResponseCacheConfig
+
+
+def completion(content: str) -> ChatCompletion:
+    return ChatCompletion.model_validate({
+        'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4-turbo',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+    })
+
+
+def messages(text: str) -> list[dict]:
+    return [{'role': 'user', 'content': [{'type': 'text', 'text': text}]}]
+
+
+class Clock:
+    """
+    Stand-in for the time module of the cache.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+class Transport:
+    """
+    Stand-in for the chat completions endpoint answering with the request text, counting requests.
+    """
+    def __init__(self):
+        self.requests = 0
+
+    async def __call__(self, model: str, messages: list[dict], max_tokens: int) -> ChatCompletion:
+        self.requests += 1
+        await asyncio.sleep(0.01)
+        return completion(messages[-1]['content'][-1]['text'].upper())
+
+
+def test_key_covers_request():
+    key = GptResponseCache.key('gpt-4-turbo', messages('a'), 512)
+    assert key == GptResponseCache.key('gpt-4-turbo', messages('a'), 512)
+    assert key != GptResponseCache.key('gpt-4o', messages('a'), 512)
+    assert key != GptResponseCache.key('gpt-4-turbo', messages('b'), 512)
+    assert key != GptResponseCache.key('gpt-4-turbo', messages('a'), 256)
+
+
+def test_put_get_persists(tmp_path):
+    with GptResponseCache(tmp_path / 'gpt.sqlite') as cache:
+        cache.put('a', completion('first'))
+        cache.put('a', completion('replaced'))
+        cache.put('b', completion('second'))
+        assert cache.get('c') is None
+    with GptResponseCache(tmp_path / 'gpt.sqlite') as cache:
+        assert len(cache) == 2
+        assert cache.get('a').choices[0].message.content == 'replaced'
+        assert cache.nbytes == len(completion('replaced').model_dump_json()) + len(completion('second').model_dump_json())
+        assert (cache.stats.hits, cache.stats.misses) == (1, 0)
+
+
+@pytest.mark.parametrize('mode, cached, stored', [
+    ('readwrite', True, True), ('write', False, True), ('replay', True, False), ('off', False, False),
+])
+def test_modes(tmp_path, mode, cached, stored):
+    with GptResponseCache(tmp_path / 'gpt.sqlite', GptResponseCacheConfig(mode=mode)) as cache:
+        cache.put('a', completion('cached'))
+        assert (cache.lookup('a') is not None) == cached
+        cache.store('b', completion('sent'))
+        assert (cache.get('b') is not None) == stored
+        if mode == 'replay':
+            with pytest.raises(KeyError):
+                cache.lookup('c')
+
+
+def test_ttl_expires(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(model_gpt_cache, 'time', clock)
+    with GptResponseCache(tmp_path / 'gpt.sqlite', GptResponseCacheConfig(ttl=10)) as cache:
+        cache.put('a', completion('old'))
+        clock.now += 5
+        cache.put('b', completion('new'))
+        clock.now += 6
+        assert cache.get('a') is None and cache.get('b') is not None
+        clock.now += 5
+        assert cache.expire() == 1
+        assert len(cache) == 0 and cache.nbytes == 0 and cache.stats.expired == 2
+
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(model_gpt_cache, 'time', clock)
+    size = len(completion('0').model_dump_json())
+    with GptResponseCache(tmp_path / 'gpt.sqlite', GptResponseCacheConfig(max_bytes=3 * size)) as cache:
+        for i in range(3):
+            cache.put(str(i), completion(str(i)))
+            clock.now += 1
+        cache.get('0')
+        clock.now += 1
+        cache.put('3', completion('3'))
+        assert [cache.get(str(i)) is not None for i in range(4)] == [True, False, True, True]
+        assert cache.nbytes == 3 * size and cache.stats.evictions == 1
+
+
+def test_model_sends_each_request_once(tmp_path):
+    def ask(model, texts):
+        async def run():
+            return await asyncio.gather(*[model(ModelGptInput([{'type': 'text', 'text': text}])) for text in texts])
+        return [response.choices[0].message.content for response in asyncio.run(run())]
+
+    transport = Transport()
+    with GptResponseCache(tmp_path / 'gpt.sqlite') as cache:
+        model = ModelGptAsync('gpt-4-turbo', transport=transport, cache=cache)
+        assert ask(model, ['a', 'b', 'a', 'a']) == ['A', 'B', 'A', 'A'] # concurrent identical requests share one send
+        assert transport.requests == 2
+    with GptResponseCache(tmp_path / 'gpt.sqlite', GptResponseCacheConfig(mode='replay')) as cache:
+        model = ModelGptAsync('gpt-4-turbo', transport=transport, cache=cache)
+        assert ask(model, ['b', 'a']) == ['B', 'A']
+        assert transport.requests == 2
+        with pytest.raises(KeyError):
+            ask(model, ['c'])
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.agents.image_patch import ImagePatch
+from tiny_eqa.models.model_grounding_dino import ModelGroundingDino, ModelGroundingDinoConfig
+
+
+LABELS = ['cabinet', 'office chair', 'door']
+
+
+def frames(n: int) -> list[np.ndarray]:
+    return [np.random.default_rng(i).integers(0, 256, (48, 64, 3), dtype=np.uint8) for i in range(n)]
+
+
+@pytest.fixture
+def engine(grounding_dino, grounding_dino_tokenizer):
+    def make(**config) -> ModelGroundingDino:
+        config = ModelGroundingDinoConfig(image_size=64, max_image_size=96, batch_size=2, **config)
+        return ModelGroundingDino(config, model=grounding_dino, tokenizer=grounding_dino_tokenizer)
+    return make
+
+
+def test_multi_label_call_matches_separate_calls(engine):
+    images = frames(3)
+    together = engine(joint_prompts=False)(images, LABELS)
+    for label in LABELS:
+        alone = engine(joint_prompts=False)(images, [label])
+        for frame_together, frame_alone in zip(together, alone):
+            assert len(frame_together[label]) == len(frame_alone[label]) > 0
+            assert torch.allclose(frame_together[label].boxes, frame_alone[label].boxes, atol=1e-4)
+            assert torch.allclose(frame_together[label].scores, frame_alone[label].scores, atol=1e-5)
+
+
+def test_joint_prompt_detects_every_label_in_one_forward_per_batch(engine):
+    model = engine()
+    assert len(model.prompts(LABELS)) == 1 and len(engine(joint_prompts=False).prompts(LABELS)) == 3
+    detections = model(frames(3), LABELS)
+    assert model.stats.forwards == 2 # micro-batches of 2 frames
+    assert all(set(frame_detections) == set(LABELS) for frame_detections in detections)
+    for frame_detections in detections:
+        for found in frame_detections.values():
+            assert torch.all(found.scores >= model.config.box_threshold)
+            assert torch.all(found.scores[:-1] >= found.scores[1:])
+
+
+def test_repeated_find_and_exists_run_no_forward(engine):
+    model = engine()
+    register_model('ModelGroundingDino', model)
+    image = ImagePatch(frames(1)[0])
+    cabinets = image.find('cabinet')
+    assert model.stats.forwards == 1
+    assert [patch.point1.tolist() for patch in image.find('cabinet')] == [patch.point1.tolist() for patch in cabinets]
+    image.exists('cabinet')
+    ImagePatch(frames(1)[0].copy()).find('cabinet') # copies of a frame share its detections
+    assert model.stats.forwards == 1 and model.stats.misses == 1
+    image.exists('door')
+    assert model.stats.forwards == 2
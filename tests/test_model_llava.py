@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import torch
+
+from tiny_eqa.models.model_dino import to_tensor
+from tiny_eqa.models.model_llava import ModelLlava, ModelLlavaConfig
+
+
+QUESTIONS = [
+    'What is this?',
+    'What color is the chair next to the wall on the left?',
+    'Is the door open?',
+    'How many pictures are hanging above the sofa in the living room?',
+]
+
+
+def reference_tokens(engine: ModelLlava, image: np.ndarray, question: str, max_new_tokens: int) -> list[int]:
+    """
+    Greedy tokens of `model.generate` on the full prompt of one question, without the end of sequence token.
+    """
+    tokenizer, config = engine.tokenizer, engine.config
+    pixel_values = engine.transform(to_tensor(image))[None]
+    vision_tokens = (engine.model.config.vision_config.image_size // engine.model.config.vision_config.patch_size) ** 2
+    input_ids = [
+        tokenizer.bos_token_id,
+        *tokenizer(f'{config.system} USER:')['input_ids'],
+        *[engine.model.config.image_token_id] * vision_tokens,
+        *tokenizer(config.question_template.format(question=question))['input_ids'],
+    ]
+    input_ids = torch.tensor([input_ids])
+    output = engine.model.generate(
+        input_ids=input_ids, attention_mask=torch.ones_like(input_ids), pixel_values=pixel_values,
+        max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    tokens = output[0, input_ids.shape[1]:].tolist()
+    return tokens[:tokens.index(tokenizer.eos_token_id)] if tokenizer.eos_token_id in tokens else tokens
+
+
+@pytest.mark.parametrize('reuse_prefix', [True, False])
+def test_greedy_tokens_match_generate(llava, llava_tokenizer, reuse_prefix):
+    engine = ModelLlava(ModelLlavaConfig(reuse_prefix=reuse_prefix, batch_size=3), model=llava, tokenizer=llava_tokenizer)
+    images = [np.random.default_rng(i).integers(0, 256, (40 + 20 * i, 70, 3), dtype=np.uint8) for i in range(2)]
+    for image in images:
+        expected = [reference_tokens(engine, image, question, 12) for question in QUESTIONS]
+        assert engine.generate(image, QUESTIONS, 12) == expected # batches of questions of different lengths
+        assert [engine.generate(image, [question], 12)[0] for question in QUESTIONS] == expected
+    assert engine.stats.hits == (2 * (2 + 4) - 2 if reuse_prefix else 0)
+
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from tiny_eqa.models.model_llava_multiframe import ModelLlavaMultiframe, ModelLlavaMultiframeConfig
+
+
+def random_frames(n: int) -> list[np.ndarray]:
+    return [np.random.default_rng(i).integers(0, 256, (48, 64, 3), dtype=np.uint8) for i in range(n)]
+
+
+QUESTIONS = ['What color is the chair?', 'Is the door open?', 'Where is the lamp?']
+
+
+@pytest.mark.parametrize('reuse_prefix', [True, False])
+def test_more_frames_than_the_frame_cache(llava, llava_tokenizer, clip, reuse_prefix):
+    frames = random_frames(6)
+    questions = QUESTIONS
+
+    def engine(frame_cache_size: int) -> ModelLlavaMultiframe:
+        config = ModelLlavaMultiframeConfig(
+            frame_tokens=4, max_tokens=16, frame_cache_size=frame_cache_size, reuse_prefix=reuse_prefix,
+        )
+        return ModelLlavaMultiframe(config, model=llava, tokenizer=llava_tokenizer, clip=clip)
+
+    small, large = engine(2), engine(1024)
+    for _ in range(2):
+        assert small.generate_frames(frames, questions, 4) == large.generate_frames(frames, questions, 4)
+    assert len(small.embedding_cache) == len(small.frame_cache) == 2
+    assert len(large.embedding_cache) == 6
+
+
+@pytest.mark.parametrize('frame_tokens, max_tokens', [(4, 16), (5, 10), (16, 20)])
+@pytest.mark.parametrize('with_clip', [True, False])
+def test_prefixes_stay_within_max_tokens(llava, llava_tokenizer, clip, frame_tokens, max_tokens, with_clip, monkeypatch):
+    config = ModelLlavaMultiframeConfig(frame_tokens=frame_tokens, max_tokens=max_tokens, max_new_tokens=2)
+    engine = ModelLlavaMultiframe(config, model=llava, tokenizer=llava_tokenizer, clip=clip if with_clip else None)
+    prefill, lengths = engine.prefill, []
+    monkeypatch.setattr(engine, 'prefill', lambda vision: lengths.append(len(vision)) or prefill(vision))
+    for num_frames in [1, 3, 10, 25]:
+        engine.generate_frames(random_frames(num_frames), QUESTIONS)
+    assert lengths and max(lengths) <= max_tokens
+
+
+def test_select_takes_the_best_frames_by_clip_score_in_order(llava, llava_tokenizer, clip):
+    config = ModelLlavaMultiframeConfig(frame_tokens=4, max_tokens=12) # 3 frames of 2x2 tokens
+    engine = ModelLlavaMultiframe(config, model=llava, tokenizer=llava_tokenizer, clip=clip)
+    frames = random_frames(8)
+    selections = engine.select(frames, [engine.key(frame) for frame in frames], QUESTIONS)
+    for question, selection in zip(QUESTIONS, selections):
+        text = clip.encode_texts([question])[0]
+        scores = [float(clip.encode_images([frame])[0] @ text) for frame in frames]
+        assert selection == sorted(np.argsort(scores)[::-1][:3].tolist())
+
+
+def test_questions_over_the_same_frames_encode_each_frame_once(llava, llava_tokenizer, clip, monkeypatch):
+    config = ModelLlavaMultiframeConfig(frame_tokens=4, max_tokens=12, max_new_tokens=2)
+    engine = ModelLlavaMultiframe(config, model=llava, tokenizer=llava_tokenizer, clip=clip)
+    encode_image, encoded = engine.encode_image, []
+    monkeypatch.setattr(engine, 'encode_image', lambda frame: encoded.append(engine.key(frame)) or encode_image(frame))
+    encode_images, clip_encoded = clip.encode_images, []
+    monkeypatch.setattr(clip, 'encode_images', lambda crops: clip_encoded.append(len(crops)) or encode_images(crops))
+
+    frames = random_frames(8)
+    engine.generate_frames(frames, QUESTIONS[:1])
+    assert clip_encoded == [8] and len(encoded) == 3
+    for question in QUESTIONS[1:]:
+        engine.generate_frames(frames, [question])
+    assert clip_encoded == [8] # CLIP embeddings of the frames are reused
+    assert len(encoded) == len(set(encoded)) # only frames no earlier question selected are encoded
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+import torch
+
+from tiny_eqa.agents import scene_patch_functions
+from tiny_eqa.agents.common_functions import register_model
+from tiny_eqa.agents.image_patch import ImagePatch
+from tiny_eqa.agents.lazy import lazy_mode
+from tiny_eqa.agents.scene_patch import ScenePatch
+from tiny_eqa.data.sequence_reader import read_scannet_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet, write_synthetic_scannet_instances
+from tiny_eqa.models.model_grounding_dino import Detections
+from tiny_eqa.utils.geometry import box_visibility
+
+
+class FakeLlava:
+    """
+    Stand-in for ModelLlava answering 'yes' to questions mentioning `positive`, recording its calls.
+    """
+    def __init__(self, positive: str):
+        self.positive = positive
+        self.calls = []
+
+    def answer(self, questions: list[str]) -> list[str]:
+        self.calls.append(questions)
+        return ['Yes.' if self.positive in question else 'No, it is not.' for question in questions]
+
+    def __call__(self, images: list[np.ndarray], questions: list[str]) -> list[str]:
+        assert len(images) == len(questions)
+        return self.answer(questions)
+
+    def answer_frames(self, frames: list[np.ndarray], questions: list[str]) -> list[str]:
+        assert frames
+        return self.answer(questions)
+
+
+def test_image_check_condition_batches():
+    model = FakeLlava('open')
+    register_model('ModelLlava', model)
+    image = ImagePatch(np.zeros((20, 30, 3), dtype=np.uint8))
+    assert image.check_condition('door', 'open') and not image.check_condition('door', 'closed')
+    with lazy_mode():
+        results = [image.crop([0, 0], [10, 10]).check_condition('door', condition) for condition in ['open', 'closed']]
+    assert [bool(result) for result in results] == [True, False]
+    assert model.calls[-1] == ['Is the door open? Answer yes or no.', 'Is the door closed? Answer yes or no.']
+
+
+class FakeGroundingDino:
+    """
+    Stand-in for ModelGroundingDino detecting the projected box of one 3D box in the frames seeing it, recording the
+    number of frames of its calls.
+    """
+    def __init__(self, sequence, label: str, bbox: np.ndarray):
+        visibility = box_visibility(
+            *torch.from_numpy(np.asarray(bbox, dtype=np.float64)),
+            torch.from_numpy(sequence.poses), torch.from_numpy(sequence.intrinsics), sequence.image_size,
+        )
+        self.boxes = {sequence[int(i)].image.tobytes(): box for i, box in zip(visibility.frames, visibility.bboxes)}
+        self.label = label
+        self.calls = []
+
+    def __call__(self, images: list[np.ndarray], labels: list[str]) -> list[dict[str, Detections]]:
+        self.calls.append(len(images))
+        results = []
+        for image in images:
+            box = self.boxes.get(image.tobytes())
+            boxes = box[None] if box is not None else torch.zeros(0, 4)
+            results.append({
+                label: Detections(boxes, torch.ones(len(boxes))) if label == self.label else Detections(torch.zeros(0, 4), torch.zeros(0))
+                for label in labels
+            })
+        return results
+
+
+ROOM_BBOXES = np.array([
+    [[5.85, 1.5, 1.0], [6.05, 3.5, 2.0]], # on the wall at x = 6 of the synthetic room
+    [[2.8, 2.3, 0.0], [3.2, 2.7, 0.5]], # in the middle of the room, never detected
+])
+
+
+def test_scene_find_lifts_detections(tmp_path):
+    write_synthetic_scannet(tmp_path, num_frames=20, image_size=(48, 64), depth_size=(24, 32))
+    write_synthetic_scannet_instances(tmp_path, ROOM_BBOXES, ['chair', 'painting'])
+    sequence = read_scannet_sequence(tmp_path)
+    model = FakeGroundingDino(sequence, 'painting', ROOM_BBOXES[0])
+    register_model('ModelGroundingDino', model)
+    scene = ScenePatch(sequence)
+    painting, = scene.find('painting') # labelled 'chair', detection does not look at labels
+    assert np.allclose(painting.point1, ROOM_BBOXES[0, 0]) and np.allclose(painting.point2, ROOM_BBOXES[0, 1])
+    assert scene.find('chair') == []
+    assert scene.crop([0, 0, 0], [4, 5, 3]).find('painting') == [] # detected, but not inside the patch
+
+
+def test_scene_find_detects_only_in_frames_seeing_the_patch(tmp_path):
+    write_synthetic_scannet(tmp_path, num_frames=20, image_size=(48, 64), depth_size=(24, 32))
+    write_synthetic_scannet_instances(tmp_path, ROOM_BBOXES, ['painting', 'chair'])
+    sequence = read_scannet_sequence(tmp_path)
+    model = FakeGroundingDino(sequence, 'painting', ROOM_BBOXES[0])
+    register_model('ModelGroundingDino', model)
+    patch = ScenePatch(sequence).crop(*ROOM_BBOXES[0])
+    assert len(patch.find('painting')) == 1
+    seen = len(scene_patch_functions.scene_visibility(patch))
+    assert 0 < seen < len(sequence) and model.calls == [seen] # the other frames are skipped
+    chair = ScenePatch(sequence).crop(*ROOM_BBOXES[1]) # behind the cameras looking outwards
+    assert chair.find('painting') == [] and len(scene_patch_functions.scene_visibility(chair)) == 0
+    assert model.calls == [seen] # no frame sees the chair, so nothing is detected
+
+
+def test_image_text_match_eager_and_deferred_share_match(clip, monkeypatch):
+    register_model('ModelClip', clip)
+    calls, match = [], clip.match
+    monkeypatch.setattr(clip, 'match', lambda crops, texts: calls.append(texts) or match(crops, texts))
+    image = ImagePatch(np.random.default_rng(0).integers(0, 256, (20, 30, 3), dtype=np.uint8))
+    texts = ['a red chair', 'an open door']
+    eager = [image.text_match(text) for text in texts]
+    with lazy_mode():
+        deferred = [image.text_match(text) for text in texts]
+    assert [float(score) for score in deferred] == pytest.approx(eager)
+    assert calls == [texts[:1], texts[1:], texts]
+
+
+def test_scene_check_condition(tmp_path, monkeypatch):
+    monkeypatch.setattr(scene_patch_functions, 'SCENE_FIND_LABELS', True)
+    model = FakeLlava('closed')
+    register_model('ModelLlava', model)
+    write_synthetic_scannet(tmp_path, num_frames=20, image_size=(48, 64), depth_size=(24, 32))
+    write_synthetic_scannet_instances(tmp_path, [[[-1, -1, 0], [1, 1, 1]]], ['cabinet'])
+    scene = ScenePatch(read_scannet_sequence(tmp_path))
+    cabinet, = scene.find('cabinets')
+    assert cabinet.check_condition('cabinet', 'closed')
+    assert not cabinet.check_condition('cabinet', 'open')
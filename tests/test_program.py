@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from tiny_eqa.agents.program import ProgramBudget, ProgramError, ProgramTimeout, compile_program, program_namespace
+
+
+def run(code: str, max_steps=100_000, timeout=60.0):
+    namespace = program_namespace(ProgramBudget(max_steps, timeout))
+    exec(compile_program(code), namespace)
+    return namespace['execute_command'](None)
+
+
+def program(*lines: str) -> str:
+    return '\n'.join(['def execute_command(scene):', *[f'    {line}' for line in lines]])
+
+
+def test_numpy_functions_of_the_prompt():
+    assert run(program('return int(np.argmax([1, 3, 2])), float(np.linalg.norm(np.asarray([3, 4])))')) == (1, 5.0)
+    assert run('import numpy as np\n' + program('return float(np.mean(np.array([1, 2, 3])))')) == 2.0
+
+
+@pytest.mark.parametrize('name', ['ctypeslib', 'load', 'save', 'fromfile', 'memmap', 'lib', 'loadtxt', 'random'])
+def test_numpy_file_io_and_ctypes_are_unreachable(name):
+    with pytest.raises((ProgramError, AttributeError)):
+        run(program(f'return np.{name}'))
+    with pytest.raises((ProgramError, AttributeError)):
+        run('import numpy\n' + program(f'return numpy.{name}'))
+    with pytest.raises((ProgramError, ImportError)):
+        run(f'from numpy import {name}\n' + program('return 0'))
+
+
+@pytest.mark.parametrize('expression', ["typing.sys", "np.linalg._umath_linalg", "np.zeros(1).tofile", "np.zeros(1).ctypes"])
+def test_module_internals_are_unreachable(expression):
+    with pytest.raises((ProgramError, AttributeError)):
+        run('import typing\n' + program(f'return {expression}'))
+
+
+def test_builtins_over_range_take_steps():
+    start = time.perf_counter()
+    with pytest.raises(ProgramTimeout, match='steps'):
+        run(program('return sum(range(10 ** 8))'), max_steps=10 ** 5)
+    with pytest.raises(ProgramTimeout, match='0.2s'):
+        run(program('return sum(range(10 ** 8))'), max_steps=10 ** 9, timeout=0.2)
+    with pytest.raises(ProgramTimeout, match='steps'):
+        run(program('r = range(10 ** 4)', 'return [sum(r) for _ in range(100)]'), max_steps=10 ** 5)
+    assert time.perf_counter() - start < 1
+
+
+def test_loops_over_range_take_one_step_per_item():
+    assert run(program('for i in range(900):', '    if i == 5:', '        return i'), max_steps=10) == 5
+    assert run(program('return [i for i in range(2, 8, 2)][::-1], len(range(10 ** 3)), 3 in range(5)'), max_steps=10) == (
+        [6, 4, 2], 1000, True,
+    )
+    with pytest.raises(ProgramTimeout, match='steps'):
+        run(program('for i in range(900):', '    pass'), max_steps=100)
+
+
+@pytest.mark.parametrize('lines', [
+    ['g = (i for i in [0])', 'return g.gi_frame.f_back.f_globals'],
+    ['g = (i for i in [0])', 'return g.gi_frame.f_builtins'],
+    ['g = (i for i in [0])', 'return g.gi_code.co_consts'],
+    ['return scene.find.__globals__'],
+    ["return '{0.__class__}'.format(scene)"],
+    ["return '{0.gi_frame}'.format_map({})"],
+    ["return {}.get('__builtins__')"],
+    ["d = {'__builtins__': 0}", "return d['__builtins__']"],
+])
+def test_frames_formats_and_dunder_strings_are_rejected(lines):
+    with pytest.raises(ProgramError):
+        compile_program(program(*lines))
@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+
+from tiny_eqa.agents.scene_cache import (
+    PATCH_DATABASE_CAPACITY, EmbeddingDatabase, SceneCache, ScenePatchData, ViewRef, patch_key,
+)
+
+
+def random_embeddings(n: int, dim=16, seed=0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, dim), dtype=np.float32)
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def test_search_matches_brute_force():
+    data, queries = random_embeddings(300), random_embeddings(5, seed=1)
+    database = EmbeddingDatabase(capacity=8) # grows several times
+    for batch in np.split(data, 3):
+        database.add(batch, list(range(len(batch))))
+    scores, ids = database.search(queries, k=4)
+    reference = normalize(queries) @ normalize(data).T
+    assert np.array_equal(ids, np.argsort(-reference, axis=1)[:, :4])
+    assert np.allclose(scores, np.take_along_axis(reference, ids, axis=1), atol=1e-5)
+
+
+def test_search_fewer_entries_than_k():
+    database = EmbeddingDatabase()
+    scores, ids = database.search(random_embeddings(1), k=3)
+    assert (ids == -1).all() and np.isinf(scores).all()
+    database.add(random_embeddings(2), ['a', 'b'])
+    _, ids = database.search(random_embeddings(1, seed=1), k=3)
+    assert sorted(ids[0, :2]) == [0, 1] and ids[0, 2] == -1
+
+
+def test_lookup_threshold():
+    database = EmbeddingDatabase()
+    database.add(np.eye(3), ['x', 'y', 'z'])
+    assert database.lookup([0.1, 1, 0], threshold=0.9) == 'y'
+    assert database.lookup([1, 1, 0], threshold=0.9) is None
+
+
+def test_remove_and_compact():
+    data = random_embeddings(10)
+    database = EmbeddingDatabase()
+    database.add(data, list(range(10)))
+    database.remove(np.array([0, 3, 4]))
+    assert len(database) == 7
+    _, ids = database.search(data, k=1)
+    assert not np.isin(ids, [0, 3, 4]).any()
+
+    mapping = database.compact()
+    assert np.array_equal(mapping, [-1, 0, 1, -1, -1, 2, 3, 4, 5, 6])
+    assert database.values == [1, 2, 5, 6, 7, 8, 9]
+    _, ids = database.search(data[9], k=1)
+    assert ids[0, 0] == mapping[9]
+
+
+def test_compact_without_embeddings():
+    database = EmbeddingDatabase()
+    assert len(database.compact()) == 0
+    database.add(random_embeddings(2), ['a', 'b'])
+    assert len(database) == 2
+
+
+def test_rejects_zero_embeddings():
+    database = EmbeddingDatabase()
+    with pytest.raises(AssertionError):
+        database.add(np.zeros((1, 4)), ['zero'])
+    database.add(np.eye(4), list('abcd'))
+    scores, ids = database.search(np.zeros(4), k=1)
+    assert np.isfinite(scores).all() and ids[0, 0] >= 0
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'float32'])
+def test_save_load(tmp_path, dtype):
+    data = random_embeddings(20)
+    database = EmbeddingDatabase(dtype=dtype)
+    database.add(data, [f'value{i}' for i in range(20)])
+    database.remove(np.array([5]))
+    database.save(tmp_path)
+
+    loaded = EmbeddingDatabase.load(tmp_path)
+    assert len(loaded) == 19 and loaded.embeddings.dtype == np.dtype(dtype)
+    assert np.array_equal(loaded.search(data, k=2)[1], database.search(data, k=2)[1])
+    assert loaded.lookup(data[7], threshold=0.99) == 'value7'
+
+
+def patch_data(name: str, n=4, seed=0) -> ScenePatchData:
+    data = ScenePatchData(name=name, views=[ViewRef(i, (0, 0), (10, 10)) for i in range(2)])
+    data.questions.add(random_embeddings(n, seed=seed), [f'answer{i}' for i in range(n)])
+    return data
+
+
+def test_scene_cache_evicts_least_recently_used():
+    one = patch_data('one').nbytes
+    cache = SceneCache(max_bytes=2 * one)
+    for i in range(3):
+        cache.put(patch_key([i] * 3, [i + 1] * 3), patch_data(f'patch{i}', seed=i))
+        if i == 1:
+            cache.get(patch_key([0] * 3, [1] * 3))
+    assert patch_key([0] * 3, [1] * 3) in cache and patch_key([1] * 3, [2] * 3) not in cache
+    assert set(cache.name2patch) == {'patch0', 'patch2'}
+    assert cache.nbytes == sum(data.nbytes for data in cache.patch2data.values()) <= 2 * one
+    assert cache.stats.evictions == 1
+
+
+def test_patch_databases_start_small():
+    assert ScenePatchData().questions.capacity == PATCH_DATABASE_CAPACITY
+    assert EmbeddingDatabase().capacity == 1024
+
+
+def test_scene_cache_save_load(tmp_path):
+    cache = SceneCache()
+    key = patch_key([0, 0, 0], [1, 1, 1])
+    cache.put(key, patch_data('chair'))
+    cache.save(tmp_path)
+
+    loaded = SceneCache.load(tmp_path, readonly=False)
+    data = loaded.get(key)
+    assert loaded.name2patch == {'chair': key} and data.views == cache.get(key).views
+    assert data.questions.lookup(random_embeddings(4)[2], threshold=0.99) == 'answer2'
+    data.questions.add(random_embeddings(1, seed=1), ['new']) # copy on write, the saved file is unchanged
+    loaded.update(key)
+    assert len(SceneCache.load(tmp_path).get(key).questions) == 4
+
+
+def test_scene_cache_readonly_load(tmp_path):
+    cache = SceneCache()
+    key = patch_key([0, 0, 0], [1, 1, 1])
+    cache.put(key, patch_data('chair'))
+    cache.save(tmp_path)
+
+    loaded = SceneCache.load(tmp_path)
+    questions = loaded.get(key).questions
+    assert not questions.embeddings.flags.writeable
+    for modify in [
+        lambda: loaded.put(key, patch_data('table')),
+        lambda: questions.add(random_embeddings(1), ['new']),
+        lambda: questions.remove(np.array([0])),
+        lambda: questions.compact(),
+    ]:
+        with pytest.raises(AssertionError):
+            modify()
+    assert questions.lookup(random_embeddings(4)[1], threshold=0.99) == 'answer1'
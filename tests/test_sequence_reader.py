@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from tiny_eqa.agents.scene_patch import ScenePatch
+from tiny_eqa.agents import scene_patch_functions
+from tiny_eqa.agents.scene_patch_functions import object_name_forms
+from tiny_eqa.data.sequence_reader import MemmapFrameSequenceReader, read_scannet_sequence
+from tiny_eqa.data.synthetic import write_synthetic_scannet, write_synthetic_scannet_instances
+
+
+BBOXES = np.array([
+    [[0.0, 0.0, 0.0], [1.0, 0.5, 2.0]],
+    [[2.0, 1.0, 0.0], [3.0, 2.0, 1.0]],
+    [[4.0, 3.0, 0.5], [4.5, 4.0, 1.5]],
+], dtype=np.float32)
+
+LABELS = ['cabinet', 'kitchen cabinet', 'Shelf']
+
+
+@pytest.fixture
+def scene_path(tmp_path):
+    path = tmp_path / 'scene'
+    write_synthetic_scannet(path, num_frames=3, image_size=(48, 64), depth_size=(24, 32))
+    write_synthetic_scannet_instances(path, BBOXES, LABELS)
+    return path
+
+
+def test_reads_instances(scene_path):
+    sequence = read_scannet_sequence(scene_path)
+    assert sequence.instances.labels == LABELS
+    assert np.allclose(sequence.instances.bboxes, BBOXES)
+    assert sequence[1:].instances is sequence.instances
+
+
+def test_packed_store_keeps_instances(scene_path, tmp_path):
+    read_scannet_sequence(scene_path, store=tmp_path / 'store')
+    sequence = read_scannet_sequence(scene_path, store=tmp_path / 'store')
+    assert isinstance(sequence.reader, MemmapFrameSequenceReader)
+    assert sequence.instances.labels == LABELS
+    assert np.allclose(sequence.instances.bboxes, BBOXES)
+
+
+def test_without_annotations(tmp_path):
+    write_synthetic_scannet(tmp_path, num_frames=2, image_size=(48, 64), depth_size=(24, 32))
+    sequence = read_scannet_sequence(tmp_path)
+    assert sequence.instances is None
+    with pytest.raises(AssertionError, match='no 3D instances'):
+        ScenePatch(sequence).find('cabinet')
+
+
+@pytest.mark.parametrize('name, label', [
+    ('cabinets', 'cabinet'), ('Cabinet', 'cabinet'), ('kitchen_cabinets', 'kitchen cabinet'), ('shelves', 'shelf'),
+    ('boxes', 'box'), ('libraries', 'library'), ('glasses', 'glass'), ('stoves', 'stove'),
+])
+def test_object_names_match_labels(name, label):
+    assert object_name_forms(name) & object_name_forms(label)
+
+
+def test_find_matches_plural_and_case(scene_path, monkeypatch):
+    monkeypatch.setattr(scene_patch_functions, 'SCENE_FIND_LABELS', True)
+    scene = ScenePatch(read_scannet_sequence(scene_path))
+    assert [patch.point1.tolist() for patch in scene.find('cabinets')] == [BBOXES[0, 0].tolist()]
+    assert len(scene.find('shelves')) == len(scene.find('shelf')) == 1
+    assert scene.find('table') == []
@@ -0,0 +1,48 @@
+import numpy as np
+
+from tiny_eqa.agents.scene_patch_functions import scene_render
+from tiny_eqa.data.sequence_reader import read_scannet_sequence
+from tiny_eqa.data.synthetic import intrinsics_from_fov, synthetic_trajectory, write_synthetic_scannet
+from tiny_eqa.utils.spatial_index import ViewIndex
+
+
+def brute_force_view(poses, intrinsics, image_size, camera, target, max_angle=45, distance_weight=1.0, direction_weight=0.5):
+    """
+    Best frame for a (camera, target) view scored one frame at a time, falling back to all frames if none faces the target.
+    """
+    H, W = image_size
+    cos_fov = np.cos(min(np.arctan(W / 2 / intrinsics[0, 0]), np.arctan(H / 2 / intrinsics[1, 1])))
+    view = (target - camera) / np.linalg.norm(target - camera)
+    scores, facing = [], []
+    for pose in poses.astype(np.float64):
+        center, direction = pose[:3, 3], pose[:3, 2] / np.linalg.norm(pose[:3, 2])
+        cos_target = direction @ (target - center) / np.linalg.norm(target - center)
+        visibility = np.clip((cos_target - cos_fov) / (1 - cos_fov), 0, 1)
+        scores.append(visibility + direction_weight * direction @ view - distance_weight * np.linalg.norm(camera - center))
+        facing.append(cos_target >= np.cos(np.radians(max_angle)))
+    scores = np.array(scores)
+    if any(facing):
+        scores[~np.array(facing)] = -np.inf
+    return int(np.argmax(scores))
+
+
+def test_view_index_matches_brute_force():
+    poses = synthetic_trajectory(60)
+    intrinsics = intrinsics_from_fov((48, 64))
+    index = ViewIndex(poses, intrinsics, (48, 64))
+    rng = np.random.default_rng(0)
+    cameras = rng.uniform([0.5, 0.5, 0.5], [5.5, 4.5, 2.5], (50, 3))
+    targets = rng.uniform([0.5, 0.5, 0.5], [5.5, 4.5, 2.5], (50, 3))
+    ids, scores = index.query(cameras, targets, k=3, chunk_size=7)
+    assert ids[:, 0].tolist() == [
+        brute_force_view(poses, intrinsics, (48, 64), camera, target) for camera, target in zip(cameras, targets)
+    ]
+    assert np.all(scores[:, :-1] >= scores[:, 1:]) # best first, frames not facing the target last at -inf
+
+
+def test_scene_render_returns_the_best_view(tmp_path):
+    write_synthetic_scannet(tmp_path, num_frames=20, image_size=(48, 64), depth_size=(24, 32))
+    sequence = read_scannet_sequence(tmp_path)
+    camera, target = np.array([3.0, 2.5, 1.5]), np.array([6.0, 4.0, 1.0])
+    best = brute_force_view(sequence.poses, sequence.intrinsics, sequence.image_size, camera, target)
+    assert np.array_equal(scene_render(camera, target, sequence).image, sequence[best].image)
@@ -0,0 +1,52 @@
+import torch
+
+from tiny_eqa.utils.spatial_quantization import pool_superpixel_features, region_adjacency
+
+
+def pool_per_label(features: torch.Tensor, labels: torch.Tensor) -> list[tuple[int, int, int, torch.Tensor]]:
+    """
+    Reference pooling: (batch, label, count, mean feature) of every label present in every image, in order, by nearest
+    upsampling the features to image resolution.
+    """
+    B, h, w, _ = features.shape
+    _, H, W = labels.shape
+    rows, cols = torch.arange(H) * h // H, torch.arange(W) * w // W
+    regions = []
+    for b in range(B):
+        upsampled = features[b][rows][:, cols]
+        for label in torch.unique(labels[b]).tolist():
+            mask = labels[b] == label
+            regions.append((b, label, int(mask.sum()), upsampled[mask].mean(dim=0)))
+    return regions
+
+
+def test_pooling_matches_per_label_loop():
+    generator = torch.Generator().manual_seed(0)
+    features = torch.randn(2, 3, 4, 5, generator=generator, dtype=torch.float64)
+    labels = torch.zeros(2, 7, 9, dtype=torch.long)
+    labels[0, :, 4:] = 9 # non-contiguous labels, with 1 to 8 absent
+    labels[0, 5:, :2] = 4
+    labels[1] = 2 # the second image has a single label that the first lacks
+    regions = pool_superpixel_features(features, labels, normalize=False)
+
+    expected = pool_per_label(features, labels)
+    assert len(regions) == len(expected) == 4
+    assert regions.batch.tolist() == [b for b, _, _, _ in expected]
+    assert regions.labels.tolist() == [label for _, label, _, _ in expected]
+    assert regions.counts.tolist() == [count for _, _, count, _ in expected]
+    assert torch.allclose(regions.features, torch.stack([feature for _, _, _, feature in expected]))
+    assert torch.equal(regions.unpool(torch.arange(len(regions)))[1], torch.full((7, 9), 3))
+    assert regions.adjacency.tolist() == [[0, 1], [0, 2]] # regions of different images are never adjacent
+
+    normalized = pool_superpixel_features(features, labels)
+    assert torch.allclose(normalized.features, regions.features / regions.features.norm(dim=-1, keepdim=True))
+
+
+def test_region_adjacency():
+    assignment = torch.tensor([[
+        [0, 0, 1],
+        [2, 2, 1],
+        [2, 3, 3],
+    ]])
+    assert region_adjacency(assignment, 4).tolist() == [[0, 1], [0, 2], [1, 2], [1, 3], [2, 3]]
+    assert region_adjacency(torch.zeros(1, 2, 2, dtype=torch.long), 1).tolist() == []